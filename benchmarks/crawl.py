@@ -0,0 +1,169 @@
+"""Crawler benchmarks against synthetic open directories
+
+Each case crawls a synthetic Apache or nginx directory tree with PageCrawler,
+in quick or standard mode, in a process of its own so its peak memory can be
+measured. Results can be saved as JSON and compared against a saved baseline,
+and the run fails if a case got slower or bigger by more than the tolerance.
+
+Run it from the top of the repository with python -m benchmarks.crawl
+
+Usage:
+    crawl [options]
+
+Options:
+    -h, --help               Show this help.
+    --width=<int>            Subdirectories in every directory [default: 3]
+    --depth=<int>            Directory levels below the root [default: 3]
+    --files=<int>            Files in every directory [default: 50]
+    --name-length=<int>      Length of every name, setting listing size [default: 24]
+    --styles=<list>          Comma separated listing styles [default: apache,nginx]
+    --modes=<list>           Comma separated crawl modes [default: quick,standard]
+    --repeat=<int>           Runs of every case, keeping the fastest [default: 3]
+    --output=<path>          Save the results to this JSON file.
+    --baseline=<path>        Compare the results to this saved JSON file.
+    --tolerance=<percent>    Allowed regression from the baseline [default: 10]
+"""
+import os
+import sys
+import json
+import time
+import resource
+import platform
+import tempfile
+import multiprocessing
+import docopt
+from opendir_dl.databasing import DatabaseWrapper
+from opendir_dl.models import FileIndex
+from opendir_dl.utils import PageCrawler
+from opendir_dl.progress import QUIET
+from benchmarks.synthetic import SyntheticTree
+from benchmarks.synthetic import SyntheticServer
+
+# Metrics where a higher value is better. For the rest, lower is better.
+HIGHER_IS_BETTER = ["pages_per_second", "files_per_second", "requests_per_second", "db_writes_per_second"]
+COMPARED = HIGHER_IS_BETTER + ["peak_rss_mb"]
+
+def run_case(tree_options, mode):
+    """Crawls a synthetic tree once and returns what it measured
+
+    This is meant to be run in a fresh process, since the peak memory is the
+    high water mark of the whole process.
+    """
+    tree = SyntheticTree(**tree_options)
+    with tempfile.NamedTemporaryFile(suffix=".db") as db_file:
+        db = DatabaseWrapper(db_file.name)
+        db.connect()
+        with SyntheticServer(tree) as server:
+            crawler = PageCrawler(db.db_conn, [server.url])
+            crawler.triage_mode = mode
+            crawler.reporter.level = QUIET
+            crawler.reporter.stream = open(os.devnull, "w")
+            started = time.monotonic()
+            crawler.run()
+            seconds = time.monotonic() - started
+            crawler.reporter.stream.close()
+        saved = db.query(FileIndex).count()
+        db.close()
+    counters = crawler.metrics.snapshot()["counters"]
+    # Files are saved in batches, so the write rate is files per second spent writing
+    writes = crawler.metrics.snapshot()["histograms"].get("db_write_seconds", {"count": 0, "sum": 0.0})
+    pages = counters.get("pages_scraped", 0)
+    files = counters.get("files_indexed", 0)
+    requests = counters.get("get_requests", 0) + counters.get("head_requests", 0)
+    # ru_maxrss is in kilobytes on Linux and in bytes on macOS
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == "darwin":
+        peak_rss /= 1024.0
+    return {"seconds": seconds,
+            "pages": pages,
+            "files": files,
+            "saved": saved,
+            "requests": requests,
+            "pages_per_second": pages / seconds,
+            "files_per_second": files / seconds,
+            "requests_per_second": requests / seconds,
+            "db_writes_per_second": files / writes["sum"] if writes["sum"] else 0.0,
+            "peak_rss_mb": peak_rss / 1024.0}
+
+def run_isolated(tree_options, mode):
+    context = multiprocessing.get_context("spawn")
+    with context.Pool(1) as pool:
+        return pool.apply(run_case, (tree_options, mode))
+
+def run_benchmarks(tree_options, styles, modes, repeat=1):
+    """Runs every style and mode as a case, keeping the fastest of each
+    """
+    results = {}
+    for style in styles:
+        for mode in modes:
+            options = dict(tree_options, style=style)
+            runs = [run_isolated(options, mode) for _ in range(repeat)]
+            results["{}-{}".format(style, mode)] = min(runs, key=lambda i: i["seconds"])
+    return results
+
+def compare(results, baseline, tolerance):
+    """Returns a description of every metric that regressed from the baseline
+
+    tolerance is the percentage a metric may get worse by before it counts.
+    Cases that aren't in both sets of results are ignored.
+    """
+    regressions = []
+    for case in sorted(set(results) & set(baseline)):
+        for metric in COMPARED:
+            old = baseline[case].get(metric)
+            new = results[case].get(metric)
+            if not old or new is None:
+                continue
+            change = (new - old) * 100.0 / old
+            if metric in HIGHER_IS_BETTER:
+                change = -change
+            if change > tolerance:
+                regressions.append("{} {} went from {:.2f} to {:.2f} ({:.1f}% worse)".format(
+                    case, metric, old, new, change))
+    return regressions
+
+def format_results(results):
+    lines = ["{:<18} {:>8} {:>9} {:>10} {:>9} {:>12} {:>8}".format(
+        "case", "pages/s", "files/s", "requests/s", "seconds", "db writes/s", "peak MB")]
+    for case, result in sorted(results.items()):
+        lines.append("{:<18} {:>8.1f} {:>9.1f} {:>10.1f} {:>9.2f} {:>12.1f} {:>8.1f}".format(
+            case, result["pages_per_second"], result["files_per_second"], result["requests_per_second"],
+            result["seconds"], result["db_writes_per_second"], result["peak_rss_mb"]))
+    return "\n".join(lines)
+
+def main(argv=None):
+    arguments = docopt.docopt(__doc__, argv=argv)
+    tree_options = {"width": int(arguments["--width"]),
+                    "depth": int(arguments["--depth"]),
+                    "files": int(arguments["--files"]),
+                    "name_length": int(arguments["--name-length"])}
+    styles = arguments["--styles"].split(",")
+    modes = arguments["--modes"].split(",")
+    for style in styles:
+        if style not in SyntheticTree.styles:
+            raise ValueError("Listing style must be one of: 'apache', 'nginx'. Got style '{}'.".format(style))
+    results = run_benchmarks(tree_options, styles, modes, int(arguments["--repeat"]))
+    print(format_results(results))
+    report = {"python": platform.python_version(),
+              "platform": platform.platform(),
+              "tree": tree_options,
+              "results": results}
+    if arguments["--output"]:
+        with open(arguments["--output"], "w") as output:
+            json.dump(report, output, indent=2, sort_keys=True)
+    if arguments["--baseline"]:
+        with open(arguments["--baseline"]) as baseline_file:
+            baseline = json.load(baseline_file)
+        if baseline["tree"] != tree_options:
+            print("The baseline crawled a different tree: {}".format(baseline["tree"]))
+            return 1
+        regressions = compare(results, baseline["results"], float(arguments["--tolerance"]))
+        for regression in regressions:
+            print(regression)
+        if regressions:
+            return 1
+        print("No regressions from {}".format(arguments["--baseline"]))
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,178 @@
+"""Synthetic open directories to benchmark the crawler against"""
+import socketserver
+from http.server import BaseHTTPRequestHandler
+from threading import Thread
+
+# Every file and listing claims the same date, so runs are identical
+LAST_MODIFIED = "Sun, 16 Oct 2016 21:14:09 GMT"
+APACHE_DATE = "2016-10-16 21:14"
+NGINX_DATE = "16-Oct-2016 21:14"
+
+APACHE_HEAD = """<!DOCTYPE HTML PUBLIC "-//W3C//DTD HTML 3.2 Final//EN">
+<html><head><title>Index of {path}</title></head><body><h1>Index of {path}</h1><table>
+<tr><th valign="top"><img src="/icons/blank.gif" alt="[ICO]"></th><th><a href="?C=N;O=D">Name</a></th><th><a href="?C=M;O=A">Last modified</a></th><th><a href="?C=S;O=A">Size</a></th></tr>
+<tr><th colspan="4"><hr></th></tr>
+<tr><td valign="top"><img src="/icons/back.gif" alt="[PARENTDIR]"></td><td><a href="../">Parent Directory</a></td><td>&nbsp;</td><td align="right">  - </td></tr>
+"""
+APACHE_ROW = """<tr><td valign="top"><img src="/icons/{icon}.gif" alt="[{alt}]"></td><td><a href="{name}">{name}</a></td><td align="right">{date}  </td><td align="right">{size}</td></tr>
+"""
+APACHE_FOOT = """<tr><th colspan="4"><hr></th></tr>
+</table></body></html>
+"""
+NGINX_HEAD = """<html>
+<head><title>Index of {path}</title></head>
+<body>
+<h1>Index of {path}</h1><hr><pre><a href="../">../</a>
+"""
+NGINX_ROW = """<a href="{name}">{name}</a>{padding} {date} {size:>19}
+"""
+NGINX_FOOT = """</pre><hr></body>
+</html>
+"""
+
+class SyntheticTree(object):
+    """A directory tree that only exists as the listings describing it
+
+    Every directory has width subdirectories, named d0, d1 and so on, and
+    files files, named f0.bin and so on, down to depth levels below the root.
+    Names are padded out to name_length characters, which sets the size of the
+    listings. Listings look like Apache's fancy index or nginx's autoindex,
+    depending on style.
+    """
+    styles = ["apache", "nginx"]
+
+    def __init__(self, width=3, depth=3, files=20, name_length=24, style="apache", file_size=1024):
+        if style not in self.styles:
+            raise ValueError("Listing style must be one of: 'apache', 'nginx'. Got style '{}'.".format(style))
+        self.width = width
+        self.depth = depth
+        self.files = files
+        self.name_length = name_length
+        self.style = style
+        self.file_size = file_size
+
+    def directory_count(self):
+        return sum(self.width ** i for i in range(self.depth + 1))
+
+    def file_count(self):
+        return self.directory_count() * self.files
+
+    def name(self, prefix, index, suffix=""):
+        name = "{}{}".format(prefix, index)
+        return name + "-" * max(0, self.name_length - len(name) - len(suffix)) + suffix
+
+    def parse_path(self, path):
+        """Returns 'directory' or 'file' for paths in the tree, otherwise None
+        """
+        parts = path.split("?")[0].split("/")[1:]
+        # Every part but the last is a directory, and the last is either a
+        # file name or empty for a directory
+        if len(parts) - 1 > self.depth:
+            return None
+        for part in parts[:-1]:
+            if not self.valid_name(part, "d", "", self.width):
+                return None
+        if parts[-1] == "":
+            return "directory"
+        if self.valid_name(parts[-1], "f", ".bin", self.files):
+            return "file"
+        return None
+
+    def valid_name(self, name, prefix, suffix, count):
+        if not name.startswith(prefix) or not name.endswith(suffix):
+            return False
+        index = name[len(prefix):len(name) - len(suffix)].rstrip("-")
+        return index.isdigit() and int(index) < count and name == self.name(prefix, int(index), suffix)
+
+    def listing(self, path):
+        """Renders the listing page for a directory path
+        """
+        level = path.count("/") - 1
+        directories = []
+        if level < self.depth:
+            directories = [self.name("d", i) + "/" for i in range(self.width)]
+        files = [self.name("f", i, ".bin") for i in range(self.files)]
+        if self.style == "nginx":
+            rows = [NGINX_HEAD.format(path=path)]
+            for name, size in [(i, "-") for i in directories] + [(i, self.file_size) for i in files]:
+                padding = " " * max(1, 50 - len(name))
+                rows.append(NGINX_ROW.format(name=name, padding=padding, date=NGINX_DATE, size=size))
+            rows.append(NGINX_FOOT)
+        else:
+            rows = [APACHE_HEAD.format(path=path)]
+            for name in directories:
+                rows.append(APACHE_ROW.format(icon="folder", alt="DIR", name=name, date=APACHE_DATE, size="  - "))
+            size = "{:.1f}K".format(self.file_size / 1024.0)
+            for name in files:
+                rows.append(APACHE_ROW.format(icon="unknown", alt="   ", name=name, date=APACHE_DATE, size=size))
+            rows.append(APACHE_FOOT)
+        return "".join(rows).encode("utf-8")
+
+class SyntheticHandler(BaseHTTPRequestHandler):
+    """Serves the tree of the server it belongs to
+    """
+    protocol_version = "HTTP/1.1"
+
+    def do_HEAD(self):
+        self.respond(send_body=False)
+
+    def do_GET(self):
+        self.respond(send_body=True)
+
+    def respond(self, send_body):
+        tree = self.server.tree
+        kind = tree.parse_path(self.path)
+        if kind == "directory":
+            # No last-modified, so the crawler treats it as a page to scrape
+            body = tree.listing(self.path.split("?")[0])
+            self.send_response(200)
+            self.send_header("Content-Type", "text/html;charset=UTF-8")
+        elif kind == "file":
+            body = b"\0" * tree.file_size
+            self.send_response(200)
+            self.send_header("Content-Type", "application/octet-stream")
+            self.send_header("Last-Modified", LAST_MODIFIED)
+        else:
+            body = b"Not Found"
+            self.send_response(404)
+            self.send_header("Content-Type", "text/plain")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        if send_body:
+            self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+class ThreadingServer(socketserver.ThreadingMixIn, socketserver.TCPServer):
+    daemon_threads = True
+    block_on_close = False
+    allow_reuse_address = True
+
+class SyntheticServer(object):
+    """Serves a SyntheticTree over HTTP on a free local port
+    """
+    def __init__(self, tree, host="localhost", port=0):
+        self.server = ThreadingServer((host, port), SyntheticHandler)
+        self.server.tree = tree
+        self.thread = Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+
+    @property
+    def url(self):
+        host, port = self.server.server_address[:2]
+        return "http://{}:{}/".format(host, port)
+
+    def start(self):
+        self.thread.start()
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.stop()
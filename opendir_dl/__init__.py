@@ -168,22 +168,25 @@ def main():
 
     Usage:
         opendir-dl help [options]
-        opendir-dl index [options] [--quick] [--depth=<int>] <resource>...
-        opendir-dl search [options] [--inclusive] [--rawsql] <terms>...
+        opendir-dl index [options] [--quick | --listing] [--depth=<int>] [--engine=<engine>] [--concurrency=<int>] [--parse-workers=<int>] [--visited-memory=<mb>] [--visited-error=<rate>] [--resume] [--retry] [--metrics=<path>] [--metrics-format=<format>] [--metrics-interval=<seconds>] [--workers=<int>] [--listen=<address>] [--authkey=<key>] [--max-pages=<int>] [--max-files=<int>] [--max-requests=<int>] [--max-bytes=<size>] [--max-time=<seconds>] [--record=<path> | --replay=<path> [--replay-latency]] <resource>...
+        opendir-dl worker [options] [--authkey=<key>] <address>
+        opendir-dl search [options] [--inclusive] [--rawsql] [--under=<url>] <terms>...
         opendir-dl download [options] <index>...
         opendir-dl tag list [options]
         opendir-dl tag create [options] <name>
         opendir-dl tag delete [options] <name>
         opendir-dl tag update [options] <name> <index>
         opendir-dl database list [options]
-        opendir-dl database create [options] <name> [--type=<type>] [--resource=<resource>]
+        opendir-dl database create [options] <name> [--type=<type>] [--resource=<resource>] [--workload=<workload>]
         opendir-dl database delete [options] <name>...
 
     Options:
         -d, --debug     Run the command in debug mode. This changes the
                         configuration path to use, preventing database polution.
-        -v, --verbose   How loud should we be? By default this can be a noisy
-                        application.
+        -v, --verbose   How loud should we be? By default an index shows a
+                        status line and failures. This adds a line for every
+                        page and link.
+        -q, --quiet     Only show the final summary of an index.
         --db <db>       This specifies the database to be used while executing
                         the command. The provided value can be a URL, a file
                         path, or a database profile. URLs and file paths must
@@ -201,6 +204,7 @@ def main():
     command_menu = CommandMenu()
     command_menu.register(['help'], print_help(main.__doc__), verbose=verbose)
     command_menu.register(['index'], commands.IndexCommand, verbose=verbose)
+    command_menu.register(['worker'], commands.WorkerCommand, verbose=verbose)
     command_menu.register(['search'], commands.SearchCommand, verbose=verbose)
     command_menu.register(['download'], commands.DownloadCommand, verbose=verbose)
     command_menu.register(['tag', 'list'], commands.TagListCommand, verbose=verbose)
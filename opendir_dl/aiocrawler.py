@@ -0,0 +1,527 @@
+import asyncio
+import ssl
+import time
+import queue
+import urllib
+import multiprocessing
+from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import ProcessPoolExecutor
+import httplib2
+from opendir_dl.models import FileIndex
+from opendir_dl.httppool import HttpPool
+from opendir_dl.frontier import visited_sets
+from opendir_dl.frontier import FrontierStore
+from opendir_dl.frontier import RetryItem
+from opendir_dl.throttle import AdaptiveLimit
+from opendir_dl.throttle import RetryPolicy
+from opendir_dl.throttle import CircuitBreaker
+from opendir_dl.throttle import HostUnavailable
+from opendir_dl.metrics import CrawlMetrics
+from opendir_dl.budget import CrawlBudget
+from opendir_dl.progress import ProgressReporter
+from opendir_dl.progress import QUIET
+from opendir_dl.progress import NORMAL
+from opendir_dl.progress import VERBOSE
+from opendir_dl.utils import HttpHead
+from opendir_dl.utils import parse_page
+from opendir_dl.utils import is_url
+from opendir_dl.autoindex import ListingFormats
+from opendir_dl.writer import IndexWriter
+
+class AsyncHttpClient(object):
+    """Minimal HTTP/1.1 client built on asyncio streams
+
+    Responses are returned in the same shape httplib2 uses, a tuple of
+    (httplib2.Response, content), so they can be handed straight to HttpHead.
+    Like HttpPool, connections are kept alive and reused per host, at most
+    max_per_host of them are open to one host, and connections idle for longer
+    than idle_timeout seconds are closed. Within max_per_host, an AdaptiveLimit
+    per host decides how many requests it gets at once.
+    """
+    redirect_codes = [301, 302, 303, 307, 308]
+    max_redirects = 5
+
+    def __init__(self, timeout=30, max_per_host=50, idle_timeout=30):
+        self.timeout = timeout
+        self.max_per_host = max_per_host
+        self.idle_timeout = idle_timeout
+        # Maps a host key to a list of (reader, writer, last_used) tuples
+        self._idle = {}
+        # Maps a host key to its AdaptiveLimit, the number of requests it has
+        # in flight, and the futures of requests waiting for a turn
+        self._host_limits = {}
+        self._host_active = {}
+        self._host_waiters = {}
+        # Mirrors disable_ssl_certificate_validation=True on httplib2.Http
+        self._ssl_context = ssl.create_default_context()
+        self._ssl_context.check_hostname = False
+        self._ssl_context.verify_mode = ssl.CERT_NONE
+
+    async def request(self, url, method="GET", headers=None):
+        requested_url = url
+        for _ in range(self.max_redirects + 1):
+            key = HttpPool.host_key(urllib.parse.urlparse(url))
+            # Time spent waiting for a turn on a busy host isn't the host being
+            # slow, so only the request itself is timed
+            await self._enter_host(key)
+            outcome = {}
+            try:
+                head, content = await asyncio.wait_for(self._request(url, method, headers, outcome),
+                                                       self.timeout)
+            finally:
+                # A timeout cancels the request, so it is recorded as a failure
+                self._exit_host(key, outcome.get("status"), outcome.get("latency"))
+            location = head.get("location")
+            if head.status not in self.redirect_codes or not location:
+                break
+            url = urllib.parse.urljoin(url, location)
+        if url != requested_url:
+            # Same as httplib2, report where a redirected response came from
+            head["content-location"] = url
+        return head, content
+
+    def _evict_idle(self):
+        cutoff = time.monotonic() - self.idle_timeout
+        for key in list(self._idle.keys()):
+            keep = []
+            for reader, writer, last_used in self._idle[key]:
+                if last_used < cutoff or reader.at_eof():
+                    writer.close()
+                else:
+                    keep.append((reader, writer, last_used))
+            if keep:
+                self._idle[key] = keep
+            else:
+                del self._idle[key]
+
+    async def _acquire(self, key):
+        self._evict_idle()
+        idle = self._idle.get(key)
+        if idle:
+            reader, writer, _ = idle.pop()
+            return reader, writer, True
+        scheme, host, port = key
+        reader, writer = await asyncio.open_connection(
+            host, port, ssl=self._ssl_context if scheme == "https" else None)
+        return reader, writer, False
+
+    async def _request(self, url, method, headers, outcome):
+        """Sends one request on a kept-alive connection, and reads the answer
+
+        The status and the time until the response head arrived are put in
+        outcome, for the host's limit.
+        """
+        parsed_url = urllib.parse.urlparse(url)
+        key = HttpPool.host_key(parsed_url)
+        path = parsed_url.path or "/"
+        if parsed_url.query:
+            path = "{}?{}".format(path, parsed_url.query)
+        request_lines = ["{} {} HTTP/1.1".format(method, path),
+                         "Host: {}".format(parsed_url.netloc),
+                         "User-Agent: opendir-dl",
+                         "Accept-Encoding: identity",
+                         "Connection: keep-alive"]
+        for name, value in (headers or {}).items():
+            request_lines.append("{}: {}".format(name, value))
+        request_lines.extend(["", ""])
+        request_data = "\r\n".join(request_lines).encode("latin-1")
+        while True:
+            reader, writer, reused = await self._acquire(key)
+            started = time.monotonic()
+            try:
+                writer.write(request_data)
+                await writer.drain()
+                head = await self._read_head(reader)
+                outcome["latency"] = time.monotonic() - started
+                content = await self._read_body(reader, head, method)
+            except (ConnectionError, asyncio.IncompleteReadError, ValueError):
+                writer.close()
+                # The server may have closed a kept-alive connection while
+                # it sat idle, so try again on a new one.
+                if reused:
+                    continue
+                raise
+            except BaseException:
+                writer.close()
+                raise
+            if self._reusable(head, method):
+                self._idle.setdefault(key, []).append((reader, writer, time.monotonic()))
+            else:
+                writer.close()
+            outcome["status"] = head.status
+            return head, content
+
+    async def _enter_host(self, key):
+        """Waits until the host's limit allows another request in flight
+        """
+        if key not in self._host_limits:
+            self._host_limits[key] = AdaptiveLimit(maximum=self.max_per_host)
+        limit = self._host_limits[key]
+        while self._host_active.get(key, 0) >= min(self.max_per_host, limit.current):
+            waiter = asyncio.get_event_loop().create_future()
+            self._host_waiters.setdefault(key, []).append(waiter)
+            try:
+                await waiter
+            finally:
+                if waiter in self._host_waiters.get(key, []):
+                    self._host_waiters[key].remove(waiter)
+        self._host_active[key] = self._host_active.get(key, 0) + 1
+
+    def _exit_host(self, key, status, latency):
+        self._host_active[key] -= 1
+        self._host_limits[key].record(status, latency)
+        # Wake every waiter, the ones that don't fit will wait again
+        for waiter in self._host_waiters.pop(key, []):
+            if not waiter.done():
+                waiter.set_result(None)
+
+    @staticmethod
+    def _reusable(head, method):
+        if "close" in head.get("connection", "").lower():
+            return False
+        if head.version < 11 and "keep-alive" not in head.get("connection", "").lower():
+            return False
+        # Without a length or chunked encoding the body ran to the end of the
+        # connection, so there is nothing left to reuse.
+        framed = "content-length" in head or "chunked" in head.get("transfer-encoding", "").lower()
+        return framed or method == "HEAD" or head.status in [204, 304] or head.status < 200
+
+    def close(self):
+        for idle in self._idle.values():
+            for _, writer, _ in idle:
+                writer.close()
+        self._idle = {}
+
+    @staticmethod
+    async def _read_head(reader):
+        status_line = (await reader.readline()).decode("latin-1").split(None, 2)
+        if len(status_line) < 2 or not status_line[0].startswith("HTTP/"):
+            raise ValueError("Invalid HTTP status line: '{}'".format(" ".join(status_line)))
+        head_dict = {"status": status_line[1]}
+        while True:
+            line = (await reader.readline()).decode("latin-1").rstrip("\r\n")
+            if not line:
+                break
+            key, _, value = line.partition(":")
+            key = key.strip().lower()
+            value = value.strip()
+            if key in head_dict:
+                value = ", ".join((head_dict[key], value))
+            head_dict[key] = value
+        head = httplib2.Response(head_dict)
+        head.version = 10 if status_line[0] == "HTTP/1.0" else 11
+        return head
+
+    @staticmethod
+    async def _read_body(reader, head, method):
+        if method == "HEAD" or head.status in [204, 304] or head.status < 200:
+            return b""
+        if "chunked" in head.get("transfer-encoding", "").lower():
+            chunks = []
+            while True:
+                size_line = await reader.readline()
+                chunk_size = int(size_line.split(b";")[0].strip() or b"0", 16)
+                if chunk_size == 0:
+                    # Discard any trailers up to the terminating blank line
+                    while (await reader.readline()).strip():
+                        pass
+                    break
+                chunks.append(await reader.readexactly(chunk_size))
+                await reader.readline()
+            return b"".join(chunks)
+        if "content-length" in head:
+            return await reader.readexactly(int(head["content-length"]))
+        return await reader.read()
+
+class AsyncPageCrawler(object):
+    def __init__(self, db_conn, url_targets=None):
+        """Prepare the AsyncPageCrawler
+
+        This is a drop in alternative to PageCrawler. Rather than a handful of
+        threads each blocking on a request, every GET and HEAD is a coroutine
+        on a single event loop, and the number of requests in flight is bounded
+        by self.concurrency instead of a thread count.
+        """
+        self.db_conn = db_conn
+        self.concurrency = 100
+        self.connections_per_host = 50
+        self.timeout = 30
+        # One of 'standard', 'quick' or 'listing', as on PageCrawler
+        self.triage_mode = "standard"
+        # Same meaning as PageCrawler.max_depth, None means no limit
+        self.max_depth = None
+        # URLs that have been triaged, and pages that have been scraped
+        self.visited, self._scraped = visited_sets(2)
+        self.url_targets = []
+        if url_targets:
+            self.url_targets = url_targets
+        self._client = None
+        self._semaphore = None
+        self._tasks = set()
+        # Database writes are synchronous, so they are handed off to a single
+        # worker thread to keep them off the event loop while still keeping the
+        # session confined to one thread. Once the crawl starts, that thread
+        # saves the queued heads and retries in batches with the writer.
+        self._db_executor = None
+        self._heads = queue.Queue()
+        self._writer_exit = False
+        # Parsing blocks the event loop, so with parse_workers above 0 pages
+        # are parsed in a pool of that many processes instead
+        self.parse_workers = 0
+        self._parse_executor = None
+        # Same as on PageCrawler, except the backoff between tries waits on
+        # the event loop rather than holding up a thread
+        self.retry_policy = RetryPolicy()
+        self.circuit_breaker = CircuitBreaker()
+        self.retry_queue = []
+        self.retry = False
+        self._frontier_store = None
+        self.metrics = CrawlMetrics()
+        self.metrics.gauge("tasks", lambda: len(self._tasks))
+        self.metrics.gauge("visited_urls", lambda: len(self.visited))
+        self.metrics.gauge("retry_queued", lambda: len(self.retry_queue))
+        self.metrics.gauge("fileindex_queued", lambda: self._heads.qsize())
+        self.reporter = ProgressReporter(self.metrics)
+        self.writer = IndexWriter(db_conn, self.metrics, reporter=self.reporter)
+        # Once a cap is reached no new requests are started, and the ones in
+        # flight are finished and saved
+        self.budget = CrawlBudget()
+        self.stopped_by = None
+        # Hosts serving json or xml listings are read without an html parser
+        self.listing_formats = ListingFormats()
+
+    @property
+    def quick(self):
+        return self.triage_mode == "quick"
+
+    @quick.setter
+    def quick(self, value):
+        if value:
+            self.triage_mode = "quick"
+        else:
+            self.triage_mode = "standard"
+
+    def spawn(self, coroutine):
+        task = asyncio.ensure_future(coroutine)
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+        return task
+
+    async def fetch(self, url, method="GET", headers=None):
+        """Makes a request, retrying it with backoff while it fails transiently
+        """
+        host = urllib.parse.urlparse(url).hostname
+        for attempt in range(self.retry_policy.attempts):
+            if not self.circuit_breaker.allow(host):
+                raise HostUnavailable("Host {} is failing".format(host))
+            try:
+                async with self._semaphore:
+                    started = time.monotonic()
+                    response = await self._client.request(url, method, headers)
+                    latency = time.monotonic() - started
+                self.metrics.count("{}_requests".format(method.lower()))
+                self.metrics.observe("{}_latency_seconds".format(method.lower()), latency)
+                self.metrics.count("bytes_received", len(response[1]))
+                self.retry_policy.check_status(response[0].status)
+            except Exception as error:
+                if not self.retry_policy.is_transient(error):
+                    self.circuit_breaker.record_success(host)
+                    raise
+                self.circuit_breaker.record_failure(host)
+                if attempt + 1 >= self.retry_policy.attempts:
+                    raise
+                await asyncio.sleep(self.retry_policy.delay(attempt))
+            else:
+                self.circuit_breaker.record_success(host)
+                return response
+
+    async def defer(self, url, depth, kind, error):
+        """Sets a url aside in the retry queue
+        """
+        self.reporter.log("Deferred ({}) URL: {}", VERBOSE, error, url)
+        self.metrics.count("deferred")
+        item = RetryItem(url, depth, kind, str(error))
+        self.retry_queue.append(item)
+        if self._frontier_store is not None:
+            self._heads.put(item)
+
+    def save(self, head):
+        self._heads.put(head)
+
+    def limit_visited(self, max_bytes=None, error_rate=None):
+        """Builds the visited sets, so together they use at most max_bytes
+        """
+        self.visited, self._scraped = visited_sets(2, max_bytes, error_rate)
+
+    def over_budget(self):
+        if self.stopped_by is None:
+            self.stopped_by = self.budget.exceeded(self.metrics)
+        return self.stopped_by is not None
+
+    def beyond_depth(self, depth):
+        return self.max_depth is not None and depth > self.max_depth
+
+    async def triage(self, url, depth=0):
+        if self.over_budget():
+            return
+        try:
+            if self.quick:
+                await self.triage_quick(url, depth)
+            else:
+                await self.triage_standard(url, depth)
+        except Exception as error:
+            if self.retry_policy.is_transient(error):
+                await self.defer(url, depth, "triage", error)
+            else:
+                self.reporter.log("Index failed ({}) URL: {}", NORMAL, error, url)
+
+    async def triage_standard(self, url, depth=0):
+        """Decides what to do with a URL based on its HEAD request
+        """
+        response = await self.fetch(url, "HEAD")
+        head = HttpHead(url, response[0])
+        if head.status != 200:
+            self.reporter.log("Index failed (HTTP Error {}) URL: {}", NORMAL, head.status, url)
+        elif head.is_listing() and (head.url[-1] == "/" or not head.last_modified):
+            # Directories are pages to crawl, and so is any other html page
+            # without a last-modified date
+            self.spawn(self.scrape(url, depth))
+        else:
+            self.save(head)
+
+    async def triage_quick(self, url, depth=0):
+        """Triages URLs without making HEAD requests
+        """
+        if url[-1] == "/":
+            self.spawn(self.scrape(url, depth))
+        else:
+            self.save(HttpHead(url, {}))
+
+    async def fetch_links(self, url, headers):
+        """Gets a page and parses its links as a tuple of (urls, hints)
+
+        Gives (None, None) if the page was an empty json or xml listing that
+        should be asked for again as html.
+        """
+        response = await self.fetch(url, headers=headers)
+        content_type = response[0].get("content-type")
+        self.listing_formats.record(url, content_type)
+        listing = self.triage_mode == "listing"
+        started = time.monotonic()
+        if self._parse_executor is not None:
+            loop = asyncio.get_event_loop()
+            new_urls, hints = await loop.run_in_executor(self._parse_executor, parse_page,
+                                                         url, response[1], listing, content_type)
+        else:
+            new_urls, hints = parse_page(url, response[1], listing, content_type)
+        self.metrics.observe("parse_seconds", time.monotonic() - started)
+        if self.listing_formats.retry_as_html(url, headers, content_type, new_urls):
+            return None, None
+        return new_urls, hints
+
+    async def scrape(self, url, depth=0):
+        if self.beyond_depth(depth) or self.over_budget() or not self._scraped.add(url):
+            return
+        headers = self.listing_formats.headers(url)
+        try:
+            new_urls, hints = await self.fetch_links(url, headers)
+            if new_urls is None:
+                # The structured listing was empty, so ask for html instead
+                new_urls, hints = await self.fetch_links(url, {})
+        except Exception as error:
+            if self.retry_policy.is_transient(error):
+                await self.defer(url, depth, "page", error)
+            else:
+                self.reporter.log("Index failed ({}) URL: {}", NORMAL, error, url)
+            return
+        self.metrics.count("pages_scraped")
+        for new_url in new_urls:
+            if new_url[-1] == "/" and self.beyond_depth(depth + 1):
+                continue
+            if not self.visited.add(new_url):
+                continue
+            hint = hints.get(new_url)
+            if hint is not None and hint.is_complete():
+                # The listing said everything a HEAD request would have
+                if hint.is_directory:
+                    self.spawn(self.scrape(new_url, depth + 1))
+                else:
+                    self.save(HttpHead(new_url, hint.as_head_dict()))
+            else:
+                self.spawn(self.triage(new_url, depth + 1))
+
+    def index_target_urls(self):
+        url_list = []
+        for item in self.url_targets:
+            if is_url(item):
+                url_list.append(item)
+            elif isinstance(item, int) or item.isdigit():
+                index_entry = self.db_conn.query(FileIndex).get(int(item))
+                url_list.append(index_entry.url)
+        if self.db_conn is not None:
+            # End the read, so the database thread takes over a clean session
+            self.db_conn.commit()
+        return url_list
+
+    async def crawl(self):
+        self._client = AsyncHttpClient(timeout=self.timeout,
+                                       max_per_host=self.connections_per_host)
+        self._semaphore = asyncio.Semaphore(self.concurrency)
+        try:
+            if self.retry and self.db_conn is not None:
+                await self.load_retries()
+            urls = self.index_target_urls()
+            self._db_executor.submit(self.writer.drain, self._heads, lambda: self._writer_exit)
+            for url in urls:
+                if self.visited.add(url):
+                    self.spawn(self.triage(url))
+            # Tasks spawn further tasks as pages are scraped, so keep waiting
+            # until the set has been drained completely.
+            while self._tasks:
+                await asyncio.wait(list(self._tasks))
+        finally:
+            self._client.close()
+
+    async def load_retries(self):
+        """Triages and scrapes the urls an earlier crawl set aside
+        """
+        loop = asyncio.get_event_loop()
+        retries = await loop.run_in_executor(self._db_executor, self._frontier_store.take_retries)
+        for item in retries:
+            self.visited.add(item.url)
+            if item.kind == "page":
+                self.spawn(self.scrape(item.url, item.depth))
+            else:
+                self.spawn(self.triage(item.url, item.depth))
+
+    def run(self):
+        """Runs the crawl to completion on a new event loop
+        """
+        self._db_executor = ThreadPoolExecutor(max_workers=1)
+        if self.db_conn is not None:
+            self._frontier_store = FrontierStore(self.db_conn)
+        if self.parse_workers > 0:
+            self._parse_executor = ProcessPoolExecutor(max_workers=self.parse_workers,
+                                                       mp_context=multiprocessing.get_context("spawn"))
+        loop = asyncio.new_event_loop()
+        self.reporter.start()
+        try:
+            loop.run_until_complete(self.crawl())
+        except KeyboardInterrupt:
+            self.reporter.log("\nCancelling outstanding requests...", NORMAL)
+            for task in list(self._tasks):
+                task.cancel()
+            loop.run_until_complete(asyncio.gather(*self._tasks, return_exceptions=True))
+        finally:
+            loop.close()
+            self._writer_exit = True
+            self._db_executor.shutdown(wait=True)
+            if self._parse_executor is not None:
+                self._parse_executor.shutdown(wait=True)
+                self._parse_executor = None
+            self.reporter.stop()
+        if self.stopped_by is not None:
+            self.reporter.log("Stopped after reaching the {} budget.", QUIET, self.stopped_by)
+        if self.retry_queue:
+            message = "{} urls were set aside after failing. Index with --retry to try them again."
+            self.reporter.log(message, QUIET, len(self.retry_queue))
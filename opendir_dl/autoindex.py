@@ -0,0 +1,277 @@
+import re
+import json
+import datetime
+import mimetypes
+import urllib.parse
+from collections import OrderedDict
+import lxml.html
+import lxml.etree
+
+# Last modified formats used by Apache (both orders), nginx and lighttpd
+DATE_PATTERNS = [
+    (re.compile(r"\d{4}-\d{2}-\d{2} \d{2}:\d{2}:\d{2}"), "%Y-%m-%d %H:%M:%S"),
+    (re.compile(r"\d{4}-\d{2}-\d{2} \d{2}:\d{2}"), "%Y-%m-%d %H:%M"),
+    (re.compile(r"\d{2}-[A-Za-z]{3}-\d{4} \d{2}:\d{2}:\d{2}"), "%d-%b-%Y %H:%M:%S"),
+    (re.compile(r"\d{2}-[A-Za-z]{3}-\d{4} \d{2}:\d{2}"), "%d-%b-%Y %H:%M"),
+    (re.compile(r"\d{4}-[A-Za-z]{3}-\d{2} \d{2}:\d{2}:\d{2}"), "%Y-%b-%d %H:%M:%S"),
+]
+# Sizes are either exact byte counts (nginx) or rounded with a unit (Apache,
+# lighttpd). A dash is used in the size column for directories.
+SIZE_PATTERN = re.compile(r"^\s*(\d+(?:\.\d+)?)\s*([KMGTP])?(?:i?B)?(?:\s|$)", re.IGNORECASE)
+SIZE_UNITS = {"": 1, "K": 1024, "M": 1024 ** 2, "G": 1024 ** 3, "T": 1024 ** 4, "P": 1024 ** 5}
+HTTP_DATE_FORMAT = "%a, %d %b %Y %H:%M:%S GMT"
+# Asked for on the first page of each host. Caddy answers with a JSON listing,
+# and servers that don't negotiate ignore it. text/html is still acceptable,
+# so nothing that does negotiate is refused.
+STRUCTURED_ACCEPT = "application/json, application/xml;q=0.9, text/html;q=0.8, */*;q=0.5"
+ISO_FRACTION_PATTERN = re.compile(r"(\.\d{6})\d+")
+
+class ListingEntry(object):
+    """A link on a directory listing page, and whatever the listing said about it
+    """
+    def __init__(self, url, size=None, last_modified=None, content_type=None, exact=False):
+        self.url = url
+        self.size = size
+        self.last_modified = last_modified
+        self.content_type = content_type
+        # Structured listings give exact sizes and times, so they are trusted
+        # outside of listing mode as well
+        self.exact = exact
+
+    @property
+    def is_directory(self):
+        return self.url[-1] == "/"
+
+    def is_complete(self):
+        """True if the entry can be triaged without a HEAD request
+        """
+        if self.is_directory:
+            return True
+        return self.size is not None and self.last_modified is not None
+
+    def as_head_dict(self):
+        """Builds the dict a HEAD request for this entry would have returned
+
+        Listings don't state a content type (lighttpd aside), so it's guessed
+        from the file extension. Rounded sizes such as '1.2K' are approximate.
+        """
+        content_type = self.content_type
+        if not content_type:
+            content_type = mimetypes.guess_type(self.url)[0] or "application/octet-stream"
+        head_dict = {"status": "200", "content-type": content_type}
+        if self.size is not None:
+            head_dict["content-length"] = str(self.size)
+        if self.last_modified is not None:
+            head_dict["last-modified"] = self.last_modified.strftime(HTTP_DATE_FORMAT)
+        return head_dict
+
+def parse_date(text):
+    """Returns the first listing style date found in text, or None
+
+    Listings show the server's local time without a zone, so it's taken as UTC.
+    """
+    for pattern, date_format in DATE_PATTERNS:
+        match = pattern.search(text)
+        if match:
+            try:
+                return datetime.datetime.strptime(match.group(0), date_format), match.end()
+            except ValueError:
+                continue
+    return None, 0
+
+def parse_size(text):
+    """Converts a listing size such as '13', '1.2K' or '4 MiB' to bytes
+    """
+    match = SIZE_PATTERN.match(text)
+    if not match:
+        return None
+    unit = (match.group(2) or "").upper()
+    return int(float(match.group(1)) * SIZE_UNITS[unit])
+
+def anchor_context(anchor):
+    """Returns the listing text describing the file the anchor links to
+
+    The result is a tuple of (text, content_type), where content_type is only
+    set for listings with a type column.
+    """
+    # <pre> listings (nginx, plain Apache) put the date and size after the link
+    if anchor.tail and anchor.tail.strip():
+        return anchor.tail, None
+    # Table listings (fancy Apache, lighttpd) put them in the following cells
+    cell = anchor.getparent()
+    while cell is not None and cell.tag not in ("td", "th"):
+        cell = cell.getparent()
+    if cell is None:
+        return "", None
+    texts = []
+    content_type = None
+    for sibling in cell.itersiblings("td", "th"):
+        texts.append(sibling.text_content())
+        if sibling.get("class") == "t":
+            content_type = sibling.text_content().strip() or None
+    return " ".join(texts), content_type
+
+def parse_listing(url, html):
+    """Gets every useful link on a listing page, with any size and date shown
+
+    Returns an ordered dict mapping each url, built and filtered the same way
+    as parse_urls, to a ListingEntry.
+    """
+    # Imported here since utils imports this module
+    from opendir_dl.utils import bad_anchor
+    from opendir_dl.utils import decode_html
+    entries = OrderedDict()
+    try:
+        document = lxml.html.document_fromstring(decode_html(html))
+    except (lxml.etree.ParserError, ValueError):
+        return entries
+    for anchor in document.iter("a"):
+        href = anchor.get("href")
+        if not href or bad_anchor(href):
+            continue
+        new_url = url + href
+        text, content_type = anchor_context(anchor)
+        last_modified, date_end = parse_date(text)
+        size = None
+        if last_modified is not None:
+            size = parse_size(text[date_end:])
+        entries[new_url] = ListingEntry(new_url, size, last_modified, content_type)
+    return entries
+
+class ListingFormats(object):
+    """Remembers which hosts answer with structured listings
+
+    The first page of every host is asked for with STRUCTURED_ACCEPT. Hosts
+    that answer with html aren't asked again, while hosts that answer with
+    json or xml keep being asked, since nginx and Caddy only differ by path.
+    """
+    def __init__(self):
+        self._formats = {}
+
+    def headers(self, url):
+        """Returns the headers to ask for a page with, or an empty dict
+        """
+        host = urllib.parse.urlparse(url).netloc
+        if self._formats.get(host) == "html":
+            return {}
+        return {"Accept": STRUCTURED_ACCEPT}
+
+    def record(self, url, content_type):
+        host = urllib.parse.urlparse(url).netloc
+        self._formats[host] = listing_format(content_type) or "html"
+
+    def retry_as_html(self, url, headers, content_type, entries):
+        """Checks if a page should be asked for again without STRUCTURED_ACCEPT
+
+        Some servers answer it with an empty json or xml listing even for
+        directories that have files. When a page asked for as a structured
+        listing gives no entries, its host is marked as html and True is
+        returned.
+        """
+        if entries or "Accept" not in headers or not listing_format(content_type):
+            return False
+        self._formats[urllib.parse.urlparse(url).netloc] = "html"
+        return True
+
+    def get(self, url):
+        return self._formats.get(urllib.parse.urlparse(url).netloc)
+
+def listing_format(content_type):
+    """Returns 'json' or 'xml' for structured listing responses, otherwise None
+    """
+    content_type = (content_type or "").split(";")[0].strip().lower()
+    if content_type == "application/json" or content_type.endswith("+json"):
+        return "json"
+    if content_type in ("application/xml", "text/xml"):
+        return "xml"
+    return None
+
+def parse_iso_date(text):
+    """Converts an ISO 8601 time, as nginx's xml and Caddy give, to naive UTC
+    """
+    text = ISO_FRACTION_PATTERN.sub(r"\1", text.strip())
+    if text.endswith("Z"):
+        text = text[:-1] + "+00:00"
+    try:
+        value = datetime.datetime.fromisoformat(text)
+    except ValueError:
+        return None
+    if value.tzinfo is not None:
+        value = value.astimezone(datetime.timezone.utc).replace(tzinfo=None)
+    return value
+
+def parse_any_date(text):
+    if not text:
+        return None
+    try:
+        return datetime.datetime.strptime(text, HTTP_DATE_FORMAT)
+    except ValueError:
+        return parse_iso_date(text)
+
+def structured_entry(url, name, href, is_directory, size, mtime):
+    if name in (".", "..", "") and not href:
+        return None
+    if href:
+        # Caddy gives each entry's link, relative to the listing
+        new_url = urllib.parse.urljoin(url, href)
+    else:
+        new_url = url + urllib.parse.quote(name)
+    if is_directory and new_url[-1] != "/":
+        new_url += "/"
+    if new_url == url or not new_url.startswith(url):
+        return None
+    if is_directory:
+        size = None
+    elif size is not None:
+        size = int(size)
+    return ListingEntry(new_url, size, parse_any_date(mtime), exact=True)
+
+def parse_json_listing(url, body):
+    """Reads an nginx (autoindex_format json) or Caddy JSON listing
+    """
+    entries = OrderedDict()
+    try:
+        items = json.loads(body)
+    except ValueError:
+        return entries
+    if not isinstance(items, list):
+        return entries
+    for item in items:
+        if not isinstance(item, dict):
+            continue
+        # Caddy 2 uses snake case, Caddy 1 capitalizes, nginx has a type
+        name = item.get("name", item.get("Name", ""))
+        href = item.get("url", item.get("URL"))
+        is_directory = item.get("is_dir", item.get("IsDir", item.get("type") == "directory"))
+        size = item.get("size", item.get("Size"))
+        mtime = item.get("mtime", item.get("mod_time", item.get("ModTime")))
+        entry = structured_entry(url, name, href, is_directory, size, mtime)
+        if entry is not None:
+            entries[entry.url] = entry
+    return entries
+
+def parse_xml_listing(url, body):
+    """Reads an nginx (autoindex_format xml) listing
+    """
+    entries = OrderedDict()
+    if isinstance(body, str):
+        body = body.encode("utf-8")
+    try:
+        document = lxml.etree.fromstring(body, lxml.etree.XMLParser(resolve_entities=False, no_network=True))
+    except lxml.etree.XMLSyntaxError:
+        return entries
+    for element in document:
+        if element.tag not in ("directory", "file"):
+            continue
+        entry = structured_entry(url, element.text or "", None, element.tag == "directory",
+                                 element.get("size"), element.get("mtime"))
+        if entry is not None:
+            entries[entry.url] = entry
+    return entries
+
+def parse_structured_listing(url, body, structured_format):
+    """Gets every entry of a json or xml listing, as parse_listing does for html
+    """
+    if structured_format == "json":
+        return parse_json_listing(url, body)
+    return parse_xml_listing(url, body)
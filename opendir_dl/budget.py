@@ -0,0 +1,36 @@
+import time
+
+class CrawlBudget(object):
+    """Caps on how much a crawl may do, checked against its CrawlMetrics
+
+    Each cap is None for no limit. Pages counts the pages scraped, files the
+    files indexed, requests every HEAD and GET, bytes the bytes received and
+    seconds the time since the metrics were started. Caps are checked as the
+    crawl goes, so it can go over one by the work that was already in flight.
+    """
+    def __init__(self, pages=None, files=None, requests=None, bytes=None, seconds=None):
+        self.pages = pages
+        self.files = files
+        self.requests = requests
+        self.bytes = bytes
+        self.seconds = seconds
+
+    def is_limited(self):
+        return any(i is not None for i in [self.pages, self.files, self.requests, self.bytes, self.seconds])
+
+    def exceeded(self, metrics):
+        """Returns the name of the first cap the crawl has reached, or None
+        """
+        if self.pages is not None and metrics.counter("pages_scraped") >= self.pages:
+            return "pages"
+        if self.files is not None and metrics.counter("files_indexed") >= self.files:
+            return "files"
+        if self.requests is not None:
+            requests = metrics.counter("get_requests") + metrics.counter("head_requests")
+            if requests >= self.requests:
+                return "requests"
+        if self.bytes is not None and metrics.counter("bytes_received") >= self.bytes:
+            return "bytes"
+        if self.seconds is not None and time.monotonic() - metrics.started >= self.seconds:
+            return "time"
+        return None
@@ -0,0 +1,143 @@
+import gzip
+import json
+import time
+import base64
+import contextlib
+from threading import Lock
+import httplib2
+from opendir_dl.throttle import RetryPolicy
+from opendir_dl.throttle import TransientError
+
+# Request headers that can change the response, and have to match for a
+# recorded response to be replayed
+MATCHED_HEADERS = ["accept", "if-none-match", "if-modified-since", "range"]
+# The headers a request falls back to matching on when nothing was recorded
+# with the same MATCHED_HEADERS. Conditional headers depend on the validators
+# in the database and Accept on which hosts answered first, so they can differ
+# from the recording even for the same crawl.
+LOOSE_HEADERS = ["range"]
+
+class CassetteMiss(Exception):
+    """A replayed crawl made a request that was never recorded
+    """
+
+def interaction_key(method, uri, headers=None, names=MATCHED_HEADERS):
+    """Builds the key a request is recorded and looked up under
+    """
+    headers = dict((k.lower(), v) for k, v in (headers or {}).items())
+    matched = [[name, headers[name]] for name in names if name in headers]
+    return json.dumps([method.upper(), uri, matched])
+
+def loose_key(key):
+    """Turns a key from interaction_key into one matching only LOOSE_HEADERS
+    """
+    method, uri, matched = json.loads(key)
+    return interaction_key(method, uri, dict(matched), LOOSE_HEADERS)
+
+def chunked(content, chunk_size):
+    for i in range(0, len(content), chunk_size):
+        yield content[i:i + chunk_size]
+
+class RecordingSession(object):
+    """Wraps an http_session, saving every request and response to a cassette
+
+    The cassette is a gzipped file with one JSON object per line, holding the
+    request, the response head and body, and how long the response took. Lines
+    are written as requests finish, so an interrupted crawl keeps what it got
+    through. stream() reads the whole body from the wrapped session, and then
+    hands it out in chunks.
+    """
+    def __init__(self, http_session, path):
+        self.http_session = http_session
+        self.path = path
+        self._lock = Lock()
+        self._file = gzip.open(path, "wt", encoding="utf-8")
+
+    def request(self, uri, method="GET", body=None, headers=None):
+        started = time.monotonic()
+        try:
+            head, content = self.http_session.request(uri, method, body, headers)
+        except Exception as error:
+            # Timeouts and refused connections are replayed too, so retries
+            # happen the same way
+            if isinstance(error, RetryPolicy.transient_errors):
+                self.write({"key": interaction_key(method, uri, headers), "error": str(error),
+                            "latency": round(time.monotonic() - started, 6)})
+            raise
+        self.record(uri, method, headers, head, content, time.monotonic() - started)
+        return head, content
+
+    @contextlib.contextmanager
+    def stream(self, uri, chunk_size=65536, headers=None):
+        head, content = self.request(uri, headers=headers)
+        yield head, chunked(content, chunk_size)
+
+    def record(self, uri, method, headers, head, content, latency):
+        self.write({"key": interaction_key(method, uri, headers),
+                    "head": dict(head),
+                    "body": base64.b64encode(content).decode("ascii"),
+                    "latency": round(latency, 6)})
+
+    def write(self, interaction):
+        line = json.dumps(interaction)
+        with self._lock:
+            self._file.write(line + "\n")
+
+    def close(self):
+        with self._lock:
+            self._file.close()
+
+class ReplaySession(object):
+    """An http_session answering from a cassette made by RecordingSession
+
+    Requests made the same number of times they were recorded get the
+    recorded responses in order, and the last one is repeated after that.
+    Requests that don't match any recording exactly are answered from those
+    matching on LOOSE_HEADERS instead. Responses come back at once, or after the time they took when recorded if
+    latency is set. Recorded failures raise TransientError, and requests that
+    were never recorded raise CassetteMiss.
+    """
+    def __init__(self, path, latency=False):
+        self.path = path
+        self.latency = latency
+        self._lock = Lock()
+        self._interactions = {}
+        self._loose = {}
+        self._positions = {}
+        with gzip.open(path, "rt", encoding="utf-8") as cassette:
+            for line in cassette:
+                interaction = json.loads(line)
+                self._interactions.setdefault(interaction["key"], []).append(interaction)
+                self._loose.setdefault(loose_key(interaction["key"]), []).append(interaction)
+
+    def __len__(self):
+        return sum(len(i) for i in self._interactions.values())
+
+    def lookup(self, uri, method="GET", headers=None):
+        key = interaction_key(method, uri, headers)
+        exact = key in self._interactions
+        if not exact:
+            key = loose_key(key)
+        with self._lock:
+            interactions = (self._interactions if exact else self._loose).get(key)
+            if not interactions:
+                raise CassetteMiss("No recorded response for {} {}".format(method, uri))
+            position = self._positions.get((exact, key), 0)
+            self._positions[(exact, key)] = position + 1
+        return interactions[min(position, len(interactions) - 1)]
+
+    def request(self, uri, method="GET", body=None, headers=None):
+        interaction = self.lookup(uri, method, headers)
+        if self.latency:
+            time.sleep(interaction["latency"])
+        if "error" in interaction:
+            raise TransientError(interaction["error"])
+        return httplib2.Response(interaction["head"]), base64.b64decode(interaction["body"])
+
+    @contextlib.contextmanager
+    def stream(self, uri, chunk_size=65536, headers=None):
+        head, content = self.request(uri, headers=headers)
+        yield head, chunked(content, chunk_size)
+
+    def close(self):
+        pass
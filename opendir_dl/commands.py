@@ -1,8 +1,21 @@
 import sqlalchemy
 from prettytable import PrettyTable
 from opendir_dl.databasing import database_opener
+from opendir_dl.databasing import sqlite_pragmas
 from opendir_dl.utils import SearchEngine
 from opendir_dl.utils import PageCrawler
+from opendir_dl.aiocrawler import AsyncPageCrawler
+from opendir_dl.distributed import Coordinator
+from opendir_dl.distributed import ShardWorker
+from opendir_dl.distributed import parse_address
+from opendir_dl.metrics import MetricsWriter
+from opendir_dl.httppool import shared_pool
+from opendir_dl.cassette import RecordingSession
+from opendir_dl.cassette import ReplaySession
+from opendir_dl.budget import CrawlBudget
+from opendir_dl.autoindex import parse_size
+from opendir_dl.progress import QUIET
+from opendir_dl.progress import VERBOSE
 from opendir_dl.utils import DownloadManager
 from opendir_dl.utils import create_table
 from opendir_dl.utils import format_tags
@@ -182,7 +195,6 @@ its ID, and that you can reference all databases at once.
         self.db_connect()
     # Make the download manager, configure it, start it
     values = self.get_argument("index")
-    print(values)
     dlman = DownloadManager(self.db_wrapper, values)
     dlman.no_index = self.has_flag("no-index")
     dlman.start()
@@ -225,15 +237,268 @@ quicker, but may be less accurate.
 
     $ opendir-dl index --debug --quick http://remotehost/somepath/
 
+Apache, nginx and lighttpd listings show the size and modified
+date of each file beside its link. The listing flag indexes
+files using those values, and only makes HEAD requests for links
+it can't make sense of. This is nearly as fast as the quick
+index, though sizes shown rounded (like '1.2K') are approximate
+and content types are guessed from the file extension.
+
+.. code::
+
+    $ opendir-dl index --debug --listing http://remotehost/somepath/
+
+Listings served as json or xml, by nginx with autoindex_format
+set or by Caddy, are read directly whatever the index mode. They
+give exact sizes and dates, so their files are indexed without
+HEAD requests.
+
+Deep trees can be pruned with the depth option. The pages given
+on the command line are at depth 0, so a depth of 1 indexes the
+files on those pages and in the directories they link to, but
+goes no further.
+
+.. code::
+
+    $ opendir-dl index --debug --depth 1 http://remotehost/somepath/
+
+Every URL is only requested once per crawl. Past 100,000 URLs the
+records of seen links and pages become bloom filters, sharing a
+fixed memory budget (64 MB for each by default) and false
+positive rate (0.001 by default). A false positive is a URL skipped as already seen, so
+very large crawls should raise the budget or accept the rate.
+
+.. code::
+
+    $ opendir-dl index --debug --visited-memory 256 --visited-error 0.0001 http://remotehost/
+
+Large mirrors spend most of their crawl time waiting on the
+network. The async engine runs every request on a single event
+loop, keeping as many requests in flight as the concurrency
+option allows (100 by default) rather than one per thread.
+
+.. code::
+
+    $ opendir-dl index --debug --engine async --concurrency 300 http://remotehost/
+
+Parsing listing pages is CPU bound, and only one thread can
+parse at a time. On a fast network the parse workers option moves
+parsing into that many processes, so it can use every core. Pages
+are then read whole rather than parsed as they download.
+
+.. code::
+
+    $ opendir-dl index --debug --parse-workers 4 http://remotehost/
+
+The state of a crawl is saved in the database as it goes. If it
+is interrupted, running it again with the resume flag picks up
+the pages it hadn't finished rather than starting over. Only the
+threaded engine can resume.
+
+.. code::
+
+    $ opendir-dl index --debug --resume http://remotehost/
+
+Requests that time out, fail to connect or get a 429 or 5xx
+answer are tried again a few times. URLs that still fail, and
+those on hosts that keep failing, are set aside in the database.
+The retry flag tries them again along with the given pages.
+
+.. code::
+
+    $ opendir-dl index --debug --retry http://remotehost/
+
+To find out which stage of a long crawl is the bottleneck, the
+metrics option writes request counts and rates, HEAD, GET, parse
+and database write timings, queue depths and bytes received to a
+file every 10 seconds (or every metrics interval). The format is
+either 'jsonl' with one line per interval, or 'prometheus' for
+the node exporter's textfile collector.
+
+.. code::
+
+    $ opendir-dl index --debug --metrics crawl.jsonl http://remotehost/
+    $ opendir-dl index --debug --metrics crawl.prom --metrics-format prometheus http://remotehost/
+
+While it runs, the index shows a single status line with the
+pages scraped, files indexed, URLs queued, requests per second
+and bytes received, along with any URLs that failed. The verbose
+flag adds a line for every page and link, and the quiet flag
+shows nothing but the final summary.
+
+.. code::
+
+    $ opendir-dl index --debug --verbose http://remotehost/
+    $ opendir-dl index --debug --quiet http://remotehost/
+
+Targets too big for one process can be split between workers.
+The workers option starts that many worker processes, each given
+the pages of its own share of hosts, while this process keeps
+track of what is left to crawl and saves what they find. With
+listen, workers on other machines can join with the worker
+command, given the same address and authkey.
+
+.. code::
+
+    $ opendir-dl index --debug --workers 4 http://remotehost/
+    $ opendir-dl index --debug --workers 2 --listen 0.0.0.0:9100 --authkey secret http://remotehost/
+    $ opendir-dl worker --authkey secret crawlhost:9100
+
+A crawl can be given a budget, so sampling an unknown target
+costs a known amount. Once the pages scraped, files indexed,
+requests made, bytes received (a size like '500M') or seconds
+taken reach their cap, the crawl stops as it would for Ctrl-C,
+saving everything found so far. Work already in flight is
+finished, so a cap can be passed by a little.
+
+.. code::
+
+    $ opendir-dl index --debug --max-pages 100 --max-time 300 http://remotehost/
+    $ opendir-dl index --debug --max-requests 5000 --max-bytes 500M http://remotehost/
+
+To benchmark or profile an index offline, the record option
+saves every request and response it makes to a cassette file.
+Indexing again with replay answers every request from the
+cassette instead of the network, at full speed, or taking as
+long as each response did when recorded with replay latency.
+Only the threaded engine can record or replay.
+
+.. code::
+
+    $ opendir-dl index --debug --record crawl.cassette http://remotehost/
+    $ opendir-dl index --debug --replay crawl.cassette --replay-latency http://remotehost/
+
+Listing pages served with an ETag or Last-Modified header are
+requested conditionally when they are crawled again. A page the
+server says hasn't changed is skipped along with everything
+below it, keeping the rows already in the database. Pages an
+interrupted crawl hadn't finished, and the pages above them, are
+always requested in full.
+
 """
+    engine = self.get_option("engine")
+    if not engine:
+        engine = "threaded"
+    if engine not in ['threaded', 'async']:
+        message = "Index engine must be one of: 'threaded', 'async'. Got engine '{}'.".format(engine)
+        raise ValueError(message)
+    if self.has_flag("resume") and engine != "threaded":
+        message = "Only the 'threaded' index engine can resume. Got engine '{}'.".format(engine)
+        raise ValueError(message)
+    distributed = self.get_option("workers") or self.get_option("listen")
+    if distributed and engine != "threaded":
+        message = "Only the 'threaded' index engine can use workers. Got engine '{}'.".format(engine)
+        raise ValueError(message)
+    if distributed and self.has_flag("resume"):
+        raise ValueError("An index split between workers can't resume.")
+    recording = self.get_option("record") or self.get_option("replay")
+    if recording and (engine != "threaded" or distributed):
+        message = "Only the 'threaded' index engine can record or replay. Got engine '{}'.".format(engine)
+        if distributed:
+            message = "An index split between workers can't record or replay."
+        raise ValueError(message)
+    if self.get_option("listen") and not self.get_option("authkey"):
+        raise ValueError("Listening for workers on other machines needs an authkey.")
     # Prepare the database connection
     if not self.db_connected():
         self.db_connect()
     # Make the crawler, configure it, start it
     resource = self.get_argument("resource")
-    crawler = PageCrawler(self.db_wrapper.db_conn, resource)
+    if distributed:
+        address = None
+        if self.get_option("listen"):
+            address = parse_address(self.get_option("listen"))
+        authkey = None
+        if self.get_option("authkey"):
+            authkey = self.get_option("authkey").encode("utf-8")
+        workers = int(self.get_option("workers") or 0)
+        crawler = Coordinator(self.db_wrapper.db_conn, resource, address, authkey, max(workers, 1))
+        crawler.local_workers = workers
+    elif engine == "async":
+        crawler = AsyncPageCrawler(self.db_wrapper.db_conn, resource)
+        if self.get_option("concurrency"):
+            crawler.concurrency = int(self.get_option("concurrency"))
+    else:
+        http_session = None
+        if self.get_option("record"):
+            http_session = RecordingSession(shared_pool(), self.get_option("record"))
+        elif self.get_option("replay"):
+            http_session = ReplaySession(self.get_option("replay"), self.has_flag("replay-latency"))
+        crawler = PageCrawler(self.db_wrapper.db_conn, resource, http_session)
+        crawler.resume = self.has_flag("resume")
+    crawler.retry = self.has_flag("retry")
+    if self.get_option("parse-workers"):
+        crawler.parse_workers = int(self.get_option("parse-workers"))
     crawler.quick = self.has_flag("quick")
-    crawler.run()
+    if self.has_flag("listing"):
+        crawler.triage_mode = "listing"
+    if self.get_option("depth") is not None:
+        crawler.max_depth = int(self.get_option("depth"))
+    if self.get_option("visited-memory") or self.get_option("visited-error"):
+        max_bytes = None
+        if self.get_option("visited-memory"):
+            max_bytes = int(self.get_option("visited-memory")) * 1024 * 1024
+        error_rate = None
+        if self.get_option("visited-error"):
+            error_rate = float(self.get_option("visited-error"))
+        crawler.limit_visited(max_bytes, error_rate)
+    budget = CrawlBudget()
+    if self.get_option("max-pages"):
+        budget.pages = int(self.get_option("max-pages"))
+    if self.get_option("max-files"):
+        budget.files = int(self.get_option("max-files"))
+    if self.get_option("max-requests"):
+        budget.requests = int(self.get_option("max-requests"))
+    if self.get_option("max-bytes"):
+        budget.bytes = parse_size(self.get_option("max-bytes"))
+        if budget.bytes is None:
+            message = "Max bytes must be a size like '500M'. Got '{}'.".format(self.get_option("max-bytes"))
+            raise ValueError(message)
+    if self.get_option("max-time"):
+        budget.seconds = float(self.get_option("max-time"))
+    crawler.budget = budget
+    if self.has_flag("quiet"):
+        crawler.reporter.level = QUIET
+    elif self.has_flag("verbose"):
+        crawler.reporter.level = VERBOSE
+    metrics_writer = None
+    if self.get_option("metrics"):
+        metrics_writer = MetricsWriter(crawler.metrics, self.get_option("metrics"),
+                                       self.get_option("metrics-format") or "jsonl",
+                                       float(self.get_option("metrics-interval") or 10))
+        metrics_writer.start()
+    try:
+        crawler.run()
+    finally:
+        if metrics_writer is not None:
+            metrics_writer.stop()
+        if recording:
+            crawler.http_session.close()
+
+@BaseCommand.factory
+def WorkerCommand(self):
+    """
+Worker
+
+Joins an index started with the listen option, scraping the pages
+it hands out until the index is finished. The address is the
+host and port the index is listening on, and the authkey must
+match the index's.
+
+.. code::
+
+    $ opendir-dl worker --authkey secret crawlhost:9100
+
+"""
+    if not self.get_option("authkey"):
+        raise ValueError("A worker needs the authkey of the index it joins.")
+    address = parse_address(self.get_argument("address"))
+    worker = ShardWorker(address, self.get_option("authkey").encode("utf-8"))
+    if self.has_flag("quiet"):
+        worker.reporter.level = QUIET
+    elif self.has_flag("verbose"):
+        worker.reporter.level = VERBOSE
+    worker.run()
 
 @BaseCommand.factory
 def SearchCommand(self):
@@ -242,6 +507,13 @@ Search
 
 This command provides search functionality within the specified database.
 
+The under option limits the results to files in a directory and
+every directory below it.
+
+.. code::
+
+    $ opendir-dl search --under http://localhost:8000/isos/ debian
+
 """
     # Prepare the database connection
     if not self.db_connected():
@@ -254,6 +526,8 @@ This command provides search functionality within the specified database.
         terms = self.get_argument("terms")
         search = SearchEngine(self.db_wrapper.db_conn, terms)
         search.exclusive = self.has_flag("inclusive")
+        if self.get_option("under"):
+            search.add_subtree(self.get_option("under"))
         results = search.query()
         cleaned_results = []
         for i in results:
@@ -344,6 +618,17 @@ an alias to the database 'redditdb' simply called 'r'.
     | example_alias | alias      | default    |
     +----------------+------------+-----------+
 
+The workload tunes SQLite for how the database will be used. It is
+one of 'default', 'crawl', 'search' or 'plain', which keeps SQLite's
+own settings. Individual settings (journal_mode, synchronous,
+cache_size, mmap_size, temp_store, wal_autocheckpoint and
+busy_timeout) can be overridden under the profile's 'sqlite' key in
+config.yml.
+
+.. code::
+
+    $ opendir-dl database create --debug --workload search archive
+
 """
 
     disallowed_db_names = ['default']
@@ -375,8 +660,13 @@ an alias to the database 'redditdb' simply called 'r'.
     if db_type == "alias" and db_resource not in self.config.databases.keys():
         message = "Cannot create alias to database- no database named '%s'." % db_resource
         raise ValueError(message)
+    database_dict = {'type': db_type, 'resource': db_resource}
+    if self.get_option('workload'):
+        database_dict['workload'] = self.get_option('workload')
+        # Raises for an unknown workload
+        sqlite_pragmas(database_dict)
     # Save the new configuration
-    self.config.databases[db_name] = {'type': db_type, 'resource': db_resource}
+    self.config.databases[db_name] = database_dict
     self.config.save()
 
 @BaseCommand.factory
@@ -1,18 +1,99 @@
 import os
+import sqlite3
 import tempfile
 import sqlalchemy
 from sqlalchemy.orm import sessionmaker
 from opendir_dl.utils import http_get
 from opendir_dl.utils import is_url
 from opendir_dl.models import MODELBASE
+from opendir_dl.migrations import migrate
+
+# SQLite settings for the workload a database profile in config.yml is used
+# for, set as pragmas on every connection. WAL lets searches read while a crawl
+# is writing, and with synchronous at normal a commit doesn't wait on fsync.
+# The crawl workload leaves more room between WAL checkpoints for its stream of
+# writes, and the search workload reads big indexes from a large page cache and
+# memory map. Plain keeps SQLite's own defaults.
+SQLITE_WORKLOADS = {
+    "default": {"journal_mode": "wal", "synchronous": "normal", "cache_size": -16384,
+                "temp_store": "memory", "busy_timeout": 5000},
+    "crawl": {"journal_mode": "wal", "synchronous": "normal", "cache_size": -65536,
+              "temp_store": "memory", "mmap_size": 268435456, "wal_autocheckpoint": 10000,
+              "busy_timeout": 5000},
+    "search": {"journal_mode": "wal", "synchronous": "normal", "cache_size": -262144,
+               "temp_store": "memory", "mmap_size": 2147483648, "busy_timeout": 5000},
+    "plain": {},
+}
+
+# The values each setting takes. Integer settings take any integer. The
+# journal mode is set first, since it can't change inside a transaction.
+SQLITE_SETTINGS = [("journal_mode", ["delete", "truncate", "persist", "memory", "wal", "off"]),
+                   ("synchronous", ["off", "normal", "full", "extra"]),
+                   ("temp_store", ["default", "file", "memory"]),
+                   ("cache_size", int),
+                   ("mmap_size", int),
+                   ("wal_autocheckpoint", int),
+                   ("busy_timeout", int)]
+
+# Index rows are saved with upserts (INSERT ... ON CONFLICT), which SQLite
+# added in 3.24.0
+MIN_SQLITE_VERSION = (3, 24, 0)
+
+def check_sqlite_version(version=sqlite3.sqlite_version):
+    """Raises ValueError if the SQLite library Python uses is too old
+    """
+    if tuple(int(i) for i in version.split(".")) < MIN_SQLITE_VERSION:
+        minimum = ".".join(str(i) for i in MIN_SQLITE_VERSION)
+        raise ValueError("SQLite must be version {} or newer. Got version '{}'.".format(minimum, version))
+
+def sqlite_pragmas(database_dict):
+    """Returns the SQLite settings for a database profile from config.yml
+
+    The profile's workload, 'default' if it doesn't name one, gives the
+    starting settings. Anything under the profile's 'sqlite' key overrides them.
+    """
+    workload = database_dict.get("workload", "default")
+    if workload not in SQLITE_WORKLOADS:
+        names = ", ".join("'{}'".format(i) for i in sorted(SQLITE_WORKLOADS))
+        raise ValueError("Database workload must be one of: {}. Got workload '{}'.".format(names, workload))
+    pragmas = dict(SQLITE_WORKLOADS[workload])
+    pragmas.update(database_dict.get("sqlite") or {})
+    allowed = dict(SQLITE_SETTINGS)
+    for name, value in pragmas.items():
+        if name not in allowed:
+            names = ", ".join("'{}'".format(i[0]) for i in SQLITE_SETTINGS)
+            raise ValueError("SQLite setting must be one of: {}. Got setting '{}'.".format(names, name))
+        if allowed[name] is int:
+            if isinstance(value, bool) or not isinstance(value, int):
+                raise ValueError("SQLite setting '{}' must be an integer. Got '{}'.".format(name, value))
+        elif str(value).lower() not in allowed[name]:
+            values = ", ".join("'{}'".format(i) for i in allowed[name])
+            message = "SQLite setting '{}' must be one of: {}. Got '{}'.".format(name, values, value)
+            raise ValueError(message)
+    return pragmas
+
+def apply_pragmas(database_engine, pragmas):
+    """Sets the pragmas on every connection the engine opens
+    """
+    statements = ["PRAGMA {} = {}".format(name, str(pragmas[name]).lower())
+                  for name, _ in SQLITE_SETTINGS if name in pragmas]
+
+    @sqlalchemy.event.listens_for(database_engine, "connect")
+    def set_pragmas(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        for statement in statements:
+            cursor.execute(statement)
+        cursor.close()
 
 class DatabaseWrapper(object):
     default_db = 'default.db'
 
-    def __init__(self, source):
+    def __init__(self, source, pragmas=None):
         self.db_conn = None
         self.tempfile = None
         self.source = source
+        # SQLite settings applied to every connection, see sqlite_pragmas
+        self.pragmas = pragmas or {}
 
     def query(self, *args, **kwargs):
         # This is meant to be overwritten with a reference to
@@ -29,8 +110,12 @@ class DatabaseWrapper(object):
     def connect(self):
         """ Establish the database session given the set values
         """
+        check_sqlite_version()
         database_engine = sqlalchemy.create_engine('sqlite:///%s' % self.source)
-        MODELBASE.metadata.create_all(database_engine)
+        if self.pragmas:
+            apply_pragmas(database_engine, self.pragmas)
+        # Creates the tables of a new database, and upgrades an older one
+        migrate(database_engine)
         MODELBASE.metadata.bind = database_engine
         database_session = sessionmaker(bind=database_engine)
         self.db_conn = database_session()
@@ -47,19 +132,20 @@ class DatabaseWrapper(object):
         object where self.db_conn is already an established database session
         """
         source = config.get_storage_path(cls.default_db)
-        dbw_inst = cls(source)
+        database_dict = config.databases.get(config.default_database_name, {})
+        dbw_inst = cls(source, sqlite_pragmas(database_dict))
         dbw_inst.connect()
         return dbw_inst
 
     @classmethod
-    def from_fs(cls, path):
+    def from_fs(cls, path, pragmas=None):
         """ Gets a database session from a cache of a remote database
 
         TODO: This method will need additional sanitation on the `path` value.
         relative and absolute paths *should* work, but anything referecing `~`
         will need to be expanded first.
         """
-        dbw_inst = cls(path)
+        dbw_inst = cls(path, pragmas)
         dbw_inst.connect()
         return dbw_inst
 
@@ -91,7 +177,7 @@ class DatabaseWrapper(object):
             message = "Cound not find database with the name '%s'." % name
             raise ValueError(message)
         database_path = os.path.join(config.parent_dir, config.databases[name]['resource'])
-        return cls.from_fs(database_path)
+        return cls.from_fs(database_path, sqlite_pragmas(config.databases[name]))
 
 def database_opener(config, database_string="default"):
     """Creates an instance of DatabaseWrapper
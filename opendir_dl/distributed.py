@@ -0,0 +1,495 @@
+import os
+import zlib
+import time
+import queue
+import urllib
+import collections
+import multiprocessing
+import concurrent.futures
+from multiprocessing.connection import Listener
+from multiprocessing.connection import Client
+from multiprocessing.connection import wait
+from threading import Lock
+from threading import Thread
+from opendir_dl.models import FileIndex
+from opendir_dl.frontier import visited_sets
+from opendir_dl.frontier import FrontierStore
+from opendir_dl.frontier import RetryItem
+from opendir_dl.metrics import CrawlMetrics
+from opendir_dl.budget import CrawlBudget
+from opendir_dl.progress import ProgressReporter
+from opendir_dl.progress import QUIET
+from opendir_dl.progress import NORMAL
+from opendir_dl.writer import IndexWriter
+from opendir_dl.utils import PageCrawler
+from opendir_dl.utils import is_url
+
+# Messages are tuples whose first item says what they are. The coordinator
+# sends workers 'config', 'work' and 'stop'. Workers send back 'ready' with
+# how many pages they can take, 'page' for each directory they find, 'heads'
+# with batches of files to index, 'retry' for work they gave up on, 'done'
+# once a piece of work is finished along with the requests it took, and 'bye'
+# once they have stopped.
+
+def shard_for(url, shards):
+    """Picks the shard a url belongs to from its host
+
+    Python's hash() is salted differently in every process, so crc32 is used
+    to give every process the same answer.
+    """
+    host = urllib.parse.urlparse(url).hostname or ""
+    return zlib.crc32(host.encode("utf-8")) % shards
+
+def parse_address(value):
+    """Turns 'host:port' into a TCP address, and anything else into a socket path
+    """
+    host, separator, port = value.rpartition(":")
+    if separator and port.isdigit():
+        return (host or "localhost", int(port))
+    return value
+
+def run_worker(address, authkey, level=NORMAL):
+    """Runs a ShardWorker, as the target of a local worker process
+    """
+    worker = ShardWorker(address, authkey)
+    worker.reporter.level = level
+    try:
+        worker.run()
+    except (ConnectionRefusedError, FileNotFoundError):
+        # The crawl finished before this worker got started
+        pass
+
+class WorkerSlot(object):
+    """The coordinator's side of one connected worker
+    """
+    def __init__(self, connection, shard):
+        self.connection = connection
+        self.shard = shard
+        self.credits = 0
+        # Maps (kind, url) to the work item, so it can be handed to another
+        # worker if this one goes away before finishing it
+        self.in_flight = {}
+
+class Coordinator(object):
+    """Owns the frontier of a crawl that is split between worker processes
+
+    Workers connect over a unix socket or TCP, and the coordinator hands each
+    of them the pages on its shard of hosts, so one host is only crawled by one
+    worker and its connection limits hold. Shards without a connected worker
+    are shared out between the others. Everything the workers find comes back
+    here, where a single writer thread saves it to the index database.
+
+    Local workers are started as processes on run(). Others can be started on
+    any machine with ShardWorker (or 'opendir-dl worker') given the address and
+    authkey, and may join at any time. Work a worker took when it disconnects
+    is handed to the others.
+    """
+    def __init__(self, db_conn, url_targets=None, address=None, authkey=None, shards=1):
+        self.db_conn = db_conn
+        self.url_targets = url_targets or []
+        self.address = address
+        self.authkey = authkey or os.urandom(16)
+        self.shards = max(shards, 1)
+        self.local_workers = 0
+        self.triage_mode = "standard"
+        self.max_depth = None
+        self.parse_workers = 0
+        self.retry = False
+        self.retry_queue = []
+        self.limit_visited()
+        self._queues = [collections.deque() for i in range(self.shards)]
+        self._outstanding = 0
+        self._slots = []
+        self._connections = queue.Queue()
+        self._heads = queue.Queue()
+        self._writer_exit = False
+        self._listener = None
+        self._accept_thread = None
+        self._closing = False
+        self._processes = []
+        self.metrics = CrawlMetrics()
+        self.metrics.gauge("frontier_queued", lambda: sum(len(i) for i in self._queues))
+        self.metrics.gauge("frontier_outstanding", lambda: self._outstanding)
+        self.metrics.gauge("fileindex_queued", lambda: self._heads.qsize())
+        self.metrics.gauge("workers", lambda: len(self._slots))
+        self.reporter = ProgressReporter(self.metrics)
+        self.writer = IndexWriter(db_conn, self.metrics, reporter=self.reporter)
+        self.budget = CrawlBudget()
+        self.stopped_by = None
+
+    @property
+    def quick(self):
+        return self.triage_mode == "quick"
+
+    @quick.setter
+    def quick(self, value):
+        if value:
+            self.triage_mode = "quick"
+        else:
+            self.triage_mode = "standard"
+
+    def limit_visited(self, max_bytes=None, error_rate=None):
+        """Builds the set of links seen, using at most max_bytes
+        """
+        self.visited, = visited_sets(1, max_bytes, error_rate)
+
+    def over_budget(self):
+        if self.stopped_by is None:
+            self.stopped_by = self.budget.exceeded(self.metrics)
+        return self.stopped_by is not None
+
+    def put(self, kind, url, depth=0):
+        """Queues a piece of work on its shard
+
+        Kind is 'page' for a page to scrape, or 'triage' for a url to look at
+        first. Returns False for pages that were already found or are too deep.
+        """
+        if kind == "page":
+            if self.max_depth is not None and depth > self.max_depth:
+                return False
+            if not self.visited.add(url):
+                return False
+        self._queues[shard_for(url, self.shards)].append((kind, url, depth))
+        self._outstanding += 1
+        return True
+
+    def next_item(self, slot):
+        """Takes the next piece of work for a worker off of its shard
+
+        A worker with nothing left on its shard takes work from a shard that
+        no worker owns, starting with the longest.
+        """
+        if slot.shard is not None and self._queues[slot.shard]:
+            return self._queues[slot.shard].popleft()
+        owned = set(i.shard for i in self._slots)
+        orphans = [self._queues[i] for i in range(self.shards) if i not in owned and self._queues[i]]
+        if not orphans:
+            return None
+        return max(orphans, key=len).popleft()
+
+    def add_index_targets(self):
+        for item in self.url_targets:
+            if is_url(item):
+                self.put("triage", item)
+            elif isinstance(item, int) or item.isdigit():
+                self.put("triage", self.db_conn.query(FileIndex).get(int(item)).url)
+        if self.db_conn is not None and self.retry:
+            for item in FrontierStore(self.db_conn).take_retries():
+                self.put(item.kind if item.kind == "page" else "triage", item.url, item.depth)
+        if self.db_conn is not None:
+            # The writer thread takes the session over from here
+            self.db_conn.commit()
+
+    def accept(self):
+        while not self._closing:
+            try:
+                connection = self._listener.accept()
+            except multiprocessing.AuthenticationError:
+                continue
+            except OSError:
+                break
+            if self._closing:
+                connection.close()
+                break
+            self._connections.put(connection)
+
+    def stop_accepting(self):
+        self._closing = True
+        try:
+            # A blocked accept() is only woken up by a connection
+            Client(self.address, authkey=self.authkey).close()
+        except OSError:
+            pass
+        self._accept_thread.join()
+        self._listener.close()
+
+    def add_workers(self):
+        """Gives the workers that connected since the last call a shard
+        """
+        while True:
+            try:
+                connection = self._connections.get_nowait()
+            except queue.Empty:
+                return
+            owned = set(i.shard for i in self._slots)
+            free = [i for i in range(self.shards) if i not in owned]
+            slot = WorkerSlot(connection, free[0] if free else None)
+            config = {"triage_mode": self.triage_mode, "max_depth": self.max_depth,
+                      "parse_workers": self.parse_workers}
+            if self.send(slot, ("config", config)):
+                self._slots.append(slot)
+
+    def send(self, slot, message):
+        try:
+            slot.connection.send(message)
+        except (OSError, EOFError):
+            self.drop(slot)
+            return False
+        return True
+
+    def drop(self, slot):
+        """Forgets a worker that went away, and queues its work again
+        """
+        for kind, url, depth in slot.in_flight.values():
+            self._queues[shard_for(url, self.shards)].appendleft((kind, url, depth))
+        slot.in_flight = {}
+        if slot in self._slots:
+            self._slots.remove(slot)
+        slot.connection.close()
+
+    def dispatch(self):
+        for slot in list(self._slots):
+            while slot.credits > 0:
+                item = self.next_item(slot)
+                if item is None:
+                    break
+                slot.in_flight[item[:2]] = item
+                slot.credits -= 1
+                if not self.send(slot, ("work",) + item):
+                    break
+
+    def receive(self, slot):
+        try:
+            message = slot.connection.recv()
+        except (OSError, EOFError):
+            self.drop(slot)
+            return
+        if message[0] == "ready":
+            slot.credits += message[1]
+        elif message[0] == "page":
+            self.put("page", message[1], message[2])
+        elif message[0] == "heads":
+            for head in message[1]:
+                self._heads.put(head)
+        elif message[0] == "retry":
+            self.retry_queue.append(message[1])
+            self.metrics.count("deferred")
+            self._heads.put(message[1])
+        elif message[0] == "done":
+            # Workers count their own requests, and send what they made along
+            for name, amount in message[3].items():
+                self.metrics.count(name, amount)
+            if slot.in_flight.pop((message[1], message[2]), None) is not None:
+                self._outstanding -= 1
+                slot.credits += 1
+                if message[1] == "page":
+                    self.metrics.count("pages_scraped")
+        elif message[0] == "bye":
+            self.drop(slot)
+
+    def fileindex_creator(self):
+        # The only thread to use the database session once the crawl starts
+        self.writer.drain(self._heads, lambda: self._writer_exit)
+
+    def workers_lost(self):
+        """True if every local worker exited, and none are connected
+        """
+        if self._slots or not self._processes or not self._connections.empty():
+            return False
+        return not any(i.is_alive() for i in self._processes)
+
+    def start_local_workers(self):
+        context = multiprocessing.get_context("spawn")
+        for i in range(self.local_workers):
+            process = context.Process(target=run_worker,
+                                      args=(self.address, self.authkey, self.reporter.level))
+            process.start()
+            self._processes.append(process)
+
+    def listen(self):
+        """Starts accepting workers, before run() if the address is needed
+        """
+        self._listener = Listener(self.address, authkey=self.authkey)
+        # Port 0 and no address both have the listener pick one
+        self.address = self._listener.address
+
+    def run(self):
+        """Hands out work until none is left, then stops the workers
+        """
+        self.add_index_targets()
+        if self._listener is None:
+            self.listen()
+        self._accept_thread = Thread(target=self.accept)
+        self._accept_thread.start()
+        writer_thread = Thread(target=self.fileindex_creator)
+        writer_thread.start()
+        self.start_local_workers()
+        self.reporter.start()
+        try:
+            while self._outstanding > 0 and not self.over_budget():
+                self.add_workers()
+                self.dispatch()
+                if not self._slots:
+                    if self.workers_lost():
+                        self.reporter.log("Every worker exited before the crawl was finished.", NORMAL)
+                        break
+                    time.sleep(.1)
+                    continue
+                for connection in wait([i.connection for i in self._slots], timeout=.1):
+                    slot = [i for i in self._slots if i.connection is connection]
+                    if slot:
+                        self.receive(slot[0])
+        except KeyboardInterrupt:
+            self.reporter.log("\nStopping workers...", NORMAL)
+        finally:
+            self.stop_workers()
+            self._writer_exit = True
+            writer_thread.join()
+            self.reporter.stop()
+        if self.stopped_by is not None:
+            self.reporter.log("Stopped after reaching the {} budget.", QUIET, self.stopped_by)
+        if self.retry_queue:
+            message = "{} urls were set aside after failing. Index with --retry to try them again."
+            self.reporter.log(message, QUIET, len(self.retry_queue))
+
+    def stop_workers(self, timeout=30):
+        """Tells every worker to stop, and saves what they send before leaving
+        """
+        self.stop_accepting()
+        self.add_workers()
+        for slot in list(self._slots):
+            self.send(slot, ("stop",))
+        deadline = time.monotonic() + timeout
+        while self._slots and time.monotonic() < deadline:
+            for connection in wait([i.connection for i in self._slots], timeout=.1):
+                slot = [i for i in self._slots if i.connection is connection]
+                if slot:
+                    self.receive(slot[0])
+        for slot in list(self._slots):
+            self.drop(slot)
+        for process in self._processes:
+            process.join(timeout)
+            if process.is_alive():
+                process.terminate()
+
+class ShardWorker(PageCrawler):
+    """Scrapes the pages a Coordinator hands out, and sends back what it finds
+
+    The coordinator decides which pages are new, so directories are sent back
+    rather than put on a local frontier, and triaged files are sent back in
+    batches of batch_size rather than saved. Settings that have to match
+    across workers, like the triage mode and max depth, come from the
+    coordinator.
+    """
+    # Counters the coordinator can't see for itself, for its budget
+    forwarded_counters = ["get_requests", "head_requests", "bytes_received"]
+
+    def __init__(self, address, authkey, http_session=None):
+        PageCrawler.__init__(self, None, http_session=http_session)
+        self.address = address
+        self.authkey = authkey
+        self.batch_size = 100
+        self._connection = None
+        self._send_lock = Lock()
+        self._work = queue.Queue()
+        self._counts_lock = Lock()
+        self._counts_sent = {}
+
+    def send(self, message):
+        with self._send_lock:
+            try:
+                self._connection.send(message)
+            except (OSError, EOFError):
+                # The coordinator is gone, so there's nobody to work for
+                self._thread_exit = True
+
+    def configure(self, config):
+        self.triage_mode = config["triage_mode"]
+        self.max_depth = config["max_depth"]
+        self.parse_workers = config["parse_workers"]
+
+    def schedule_page(self, url, depth=0):
+        if not self._urls_to_scrape.beyond_depth(depth):
+            self.send(("page", url, depth))
+
+    def defer(self, url, depth, kind, error):
+        PageCrawler.defer(self, url, depth, kind, error)
+        self.send(("retry", RetryItem(url, depth, kind, str(error))))
+
+    def fileindex_creator(self):
+        # Heads are sent once a batch fills, or as soon as none are waiting
+        batch = []
+        while not self._thread_exit or not self._fileindex_heads.empty():
+            try:
+                batch.append(self._fileindex_heads.get(timeout=.1))
+                if len(batch) < self.batch_size and not self._fileindex_heads.empty():
+                    continue
+            except queue.Empty:
+                pass
+            if batch:
+                self.send(("heads", batch))
+                batch = []
+        if batch:
+            self.send(("heads", batch))
+
+    def work_taker(self, thread_num):
+        while not self._thread_exit:
+            try:
+                kind, url, depth = self._work.get(timeout=.1)
+            except queue.Empty:
+                continue
+            if kind == "triage":
+                self.triage_one(url, depth)
+            else:
+                self.scrape_one(thread_num, url, depth)
+            # Anything found on the page was sent before this, so the
+            # coordinator can't run out of work while it's still on its way
+            self.send(("done", kind, url, self.take_counts()))
+
+    def take_counts(self):
+        """Returns the request and byte counts made since the last call
+        """
+        with self._counts_lock:
+            counts = {}
+            for name in self.forwarded_counters:
+                total = self.metrics.counter(name)
+                counts[name] = total - self._counts_sent.get(name, 0)
+                self._counts_sent[name] = total
+            return counts
+
+    def receive(self):
+        while not self._thread_exit:
+            try:
+                message = self._connection.recv()
+            except (OSError, EOFError):
+                break
+            if message[0] == "work":
+                self._work.put(message[1:])
+            elif message[0] == "stop":
+                break
+        self._thread_exit = True
+
+    def run(self):
+        """Connects to the coordinator and works until it says to stop
+        """
+        self._connection = Client(self.address, authkey=self.authkey)
+        try:
+            message = self._connection.recv()
+        except EOFError:
+            # The crawl finished before this worker joined
+            return
+        self.configure(message[1])
+        self._triage_executor = concurrent.futures.ThreadPoolExecutor(max_workers=self.triage_fanout)
+        if self.parse_workers > 0:
+            self._parse_executor = concurrent.futures.ProcessPoolExecutor(
+                max_workers=self.parse_workers, mp_context=multiprocessing.get_context("spawn"))
+        self._fileindex_creator_thread = Thread(target=self.fileindex_creator)
+        self._fileindex_creator_thread.start()
+        for i in range(self.scraper_threads_max):
+            scraper_thread = Thread(target=self.work_taker, args=(i,))
+            self._scraper_threads.append(scraper_thread)
+            scraper_thread.start()
+        self.send(("ready", self.scraper_threads_max))
+        try:
+            self.receive()
+        except KeyboardInterrupt:
+            self._thread_exit = True
+        for i in self._scraper_threads:
+            i.join()
+        self._triage_executor.shutdown(wait=True)
+        if self._parse_executor is not None:
+            self._parse_executor.shutdown(wait=True)
+            self._parse_executor = None
+        self._fileindex_creator_thread.join()
+        self.send(("bye",))
+        self._connection.close()
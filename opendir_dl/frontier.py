@@ -0,0 +1,304 @@
+import math
+import queue
+import hashlib
+import datetime
+import collections
+from threading import Lock
+from threading import Condition
+from opendir_dl.models import FrontierEntry
+from opendir_dl.models import CrawledPage
+from opendir_dl.models import RetryEntry
+
+# A change to the state of one page, queued for the thread writing to the database
+FrontierUpdate = collections.namedtuple("FrontierUpdate", ["url", "depth", "state"])
+# The ETag and Last-Modified headers a page was served with
+PageValidators = collections.namedtuple("PageValidators", ["url", "etag", "last_modified"])
+# A URL given up on after transient failures, to be tried again later
+RetryItem = collections.namedtuple("RetryItem", ["url", "depth", "kind", "error"])
+
+class BloomFilter(object):
+    """Fixed size probabilistic set
+
+    Membership tests can return false positives at roughly error_rate once
+    capacity items have been added, but never false negatives. The bit array is
+    sized for capacity items, and never grows past max_bytes when it is given.
+    """
+    def __init__(self, capacity, error_rate=0.001, max_bytes=None):
+        num_bits = int(math.ceil(-capacity * math.log(error_rate) / math.log(2) ** 2))
+        if max_bytes is not None:
+            num_bits = min(num_bits, max_bytes * 8)
+        self.num_bits = max(num_bits, 8)
+        self.num_hashes = max(1, int(round(self.num_bits / float(capacity) * math.log(2))))
+        self.capacity = capacity
+        self.error_rate = error_rate
+        self.count = 0
+        self._bits = bytearray((self.num_bits + 7) // 8)
+
+    @classmethod
+    def for_memory(cls, max_bytes, error_rate=0.001):
+        """Builds the filter holding the most items in max_bytes at error_rate
+        """
+        capacity = int(max_bytes * 8 * math.log(2) ** 2 / -math.log(error_rate))
+        return cls(max(capacity, 1), error_rate, max_bytes)
+
+    def _positions(self, item):
+        # Double hashing: k positions derived from the two halves of one digest
+        digest = hashlib.blake2b(item.encode("utf-8"), digest_size=16).digest()
+        first = int.from_bytes(digest[:8], "little")
+        second = int.from_bytes(digest[8:], "little") | 1
+        for i in range(self.num_hashes):
+            yield (first + i * second) % self.num_bits
+
+    def add(self, item):
+        """Adds an item, returning True if it was not already present
+        """
+        added = False
+        for position in self._positions(item):
+            mask = 1 << (position & 7)
+            if not self._bits[position >> 3] & mask:
+                self._bits[position >> 3] |= mask
+                added = True
+        if added:
+            self.count += 1
+        return added
+
+    def __contains__(self, item):
+        for position in self._positions(item):
+            if not self._bits[position >> 3] & (1 << (position & 7)):
+                return False
+        return True
+
+    def __len__(self):
+        return self.count
+
+    @property
+    def size_bytes(self):
+        return len(self._bits)
+
+class VisitedSet(object):
+    """Thread safe record of the URLs a crawl has already seen
+
+    URLs are kept in an exact set until there are more than exact_limit of
+    them. At that point they are moved into a BloomFilter that never uses more
+    than max_bytes, trading a false positive rate of about error_rate (a URL
+    wrongly treated as seen and skipped) for a fixed memory budget.
+    """
+    def __init__(self, exact_limit=100000, max_bytes=64 * 1024 * 1024, error_rate=0.001):
+        self.exact_limit = exact_limit
+        self.max_bytes = max_bytes
+        self.error_rate = error_rate
+        self._lock = Lock()
+        self._exact = set()
+        self._bloom = None
+
+    @staticmethod
+    def url_key(url):
+        # Fragments never change the resource the server returns
+        return url.split("#", 1)[0]
+
+    @property
+    def probabilistic(self):
+        return self._bloom is not None
+
+    def add(self, url):
+        """Marks a URL as seen, returning True if it had not been seen before
+        """
+        key = self.url_key(url)
+        with self._lock:
+            if self._bloom is not None:
+                return self._bloom.add(key)
+            if key in self._exact:
+                return False
+            self._exact.add(key)
+            if len(self._exact) > self.exact_limit:
+                self._switch_to_bloom()
+            return True
+
+    def _switch_to_bloom(self):
+        # Must be called while holding self._lock
+        self._bloom = BloomFilter.for_memory(self.max_bytes, self.error_rate)
+        for key in self._exact:
+            self._bloom.add(key)
+        self._exact = set()
+
+    def __contains__(self, url):
+        key = self.url_key(url)
+        with self._lock:
+            if self._bloom is not None:
+                return key in self._bloom
+            return key in self._exact
+
+    def __len__(self):
+        with self._lock:
+            if self._bloom is not None:
+                return len(self._bloom)
+            return len(self._exact)
+
+def visited_sets(count, max_bytes=None, error_rate=None):
+    """Returns count VisitedSets sharing one memory budget
+
+    Each gets an equal share of max_bytes, so together they never use more
+    than it. Leaving max_bytes or error_rate unset keeps VisitedSet's default.
+    """
+    options = {}
+    if max_bytes is not None:
+        options["max_bytes"] = max_bytes // count
+    if error_rate is not None:
+        options["error_rate"] = error_rate
+    return [VisitedSet(**options) for i in range(count)]
+
+class CrawlFrontier(object):
+    """Queue of pages waiting to be scraped, with outstanding work tracking
+
+    Every entry is stored with its depth, counted from the index targets at
+    depth 0. Entries deeper than max_depth are refused by put(). Each entry is a
+    unit of work that is outstanding from the moment it is put until the worker
+    that got it calls task_done(), so wait() returns as soon as the last unit
+    finishes instead of polling for idle workers. When given a VisitedSet, a
+    page that has already been put once is refused.
+    """
+    def __init__(self, max_depth=None, visited=None):
+        self.max_depth = max_depth
+        self.visited = visited
+        self._entries = collections.deque()
+        self._condition = Condition()
+        self._outstanding = 0
+        self._closed = False
+
+    def __len__(self):
+        with self._condition:
+            return len(self._entries)
+
+    @property
+    def outstanding(self):
+        with self._condition:
+            return self._outstanding
+
+    def beyond_depth(self, depth):
+        """True if pages at the given depth should not be scraped
+        """
+        return self.max_depth is not None and depth > self.max_depth
+
+    def put(self, url, depth=0):
+        """Adds a page to be scraped, returning False if it was refused
+        """
+        if self.beyond_depth(depth):
+            return False
+        if self.visited is not None and not self.visited.add(url):
+            return False
+        with self._condition:
+            self._entries.append((url, depth))
+            self._outstanding += 1
+            self._condition.notify_all()
+        return True
+
+    def get(self, timeout=None):
+        """Returns the next (url, depth) tuple
+
+        Raises queue.Empty if nothing became available within the timeout, or
+        if the frontier has been closed.
+        """
+        with self._condition:
+            self._condition.wait_for(lambda: self._entries or self._closed, timeout)
+            if self._closed or not self._entries:
+                raise queue.Empty
+            return self._entries.popleft()
+
+    def task_done(self):
+        """Marks a unit of work returned by get() as finished
+        """
+        with self._condition:
+            self._outstanding -= 1
+            if self._outstanding <= 0:
+                self._condition.notify_all()
+
+    def wait(self, timeout=None):
+        """Blocks until all outstanding work is finished or the frontier closes
+
+        Returns True if there is no outstanding work left.
+        """
+        with self._condition:
+            self._condition.wait_for(lambda: self._outstanding <= 0 or self._closed, timeout)
+            return self._outstanding <= 0
+
+    def close(self):
+        """Wakes every waiting thread so workers can exit
+        """
+        with self._condition:
+            self._closed = True
+            self._condition.notify_all()
+
+class FrontierStore(object):
+    """Keeps the state of every page a crawl has found in the index database
+
+    Pages are 'pending' once they are put on the frontier, 'in_flight' while
+    they are being scraped and 'done' once every link on them has been
+    triaged. The validators each page was served with are kept across crawls
+    so unchanged pages can be skipped, along with the URLs given up on so they
+    can be tried again. The session is not thread safe, so only
+    one thread may use this. Writes are committed at once unless commit is
+    False, which leaves them for the caller to commit as a batch.
+    """
+    pending = "pending"
+    in_flight = "in_flight"
+    done = "done"
+
+    def __init__(self, db_conn):
+        self.db_conn = db_conn
+
+    def record(self, url, depth, state, commit=True):
+        entry = self.db_conn.query(FrontierEntry).filter_by(url=url).first()
+        if entry is None:
+            entry = FrontierEntry(url=url, depth=depth, state=state)
+            self.db_conn.add(entry)
+        else:
+            entry.depth = depth
+            entry.state = state
+        if commit:
+            self.db_conn.commit()
+
+    def entries(self):
+        """Returns a list of (url, depth, state) tuples for every saved page
+        """
+        query = self.db_conn.query(FrontierEntry.url, FrontierEntry.depth, FrontierEntry.state)
+        entries = [tuple(i) for i in query]
+        # End the transaction, so the connection isn't held by this thread
+        self.db_conn.commit()
+        return entries
+
+    def clear(self):
+        self.db_conn.query(FrontierEntry).delete()
+        self.db_conn.commit()
+
+    def record_validators(self, url, etag, last_modified, commit=True):
+        page = self.db_conn.query(CrawledPage).filter_by(url=url).first()
+        if page is None:
+            page = CrawledPage(url=url)
+            self.db_conn.add(page)
+        page.etag = etag
+        page.last_modified = last_modified
+        page.last_crawled = datetime.datetime.utcnow()
+        if commit:
+            self.db_conn.commit()
+
+    def validators(self):
+        """Returns a dict mapping page urls to PageValidators
+        """
+        query = self.db_conn.query(CrawledPage.url, CrawledPage.etag, CrawledPage.last_modified)
+        validators = dict((i[0], PageValidators(*i)) for i in query)
+        self.db_conn.commit()
+        return validators
+
+    def record_retry(self, url, depth, kind, error, commit=True):
+        self.db_conn.add(RetryEntry(url=url, depth=depth, kind=kind, error=error))
+        if commit:
+            self.db_conn.commit()
+
+    def take_retries(self):
+        """Removes every saved RetryItem from the database and returns them
+        """
+        query = self.db_conn.query(RetryEntry.url, RetryEntry.depth, RetryEntry.kind, RetryEntry.error)
+        retries = [RetryItem(*i) for i in query]
+        self.db_conn.query(RetryEntry).delete()
+        self.db_conn.commit()
+        return retries
@@ -0,0 +1,289 @@
+import ssl
+import time
+import contextlib
+import urllib
+import http.client
+from threading import Lock
+from threading import Condition
+import httplib2
+from opendir_dl.throttle import AdaptiveLimit
+
+class HttpPool(object):
+    """A thread safe pool of keep-alive HTTP connections keyed by host
+
+    The pool can be used anywhere an httplib2.Http instance was used as an
+    http_session, since request() takes the same arguments and returns the same
+    (httplib2.Response, content) tuple. Connections to a host are reused until
+    they sit idle for longer than idle_timeout seconds, and no more than
+    max_per_host connections to a single host are ever open at once. Threads
+    requesting a connection to a host at its limit wait for one to be released.
+
+    When adaptive is set, each host starts with fewer connections and an
+    AdaptiveLimit moves its limit between one and max_per_host, backing off
+    when the host times out or answers 429 or 503.
+
+    A thread holding a streamed connection while it waits on other requests
+    to the same host can lend its slot for the wait, so it never waits on
+    itself.
+    """
+    redirect_codes = [301, 302, 303, 307, 308]
+    max_redirects = 5
+
+    def __init__(self, max_per_host=10, idle_timeout=30, timeout=30, adaptive=True):
+        self.max_per_host = max_per_host
+        self.idle_timeout = idle_timeout
+        self.timeout = timeout
+        self.adaptive = adaptive
+        # Maps a host key to its AdaptiveLimit
+        self._limits = {}
+        self._condition = Condition()
+        # Maps a host key to a list of (connection, last_used) tuples
+        self._idle = {}
+        # Maps a host key to the number of connections currently checked out
+        self._active = {}
+        # Maps a host key to how many of its checked out connections have
+        # lent their slot, and don't count against its limit
+        self._lent = {}
+        # Mirrors disable_ssl_certificate_validation=True on httplib2.Http
+        self._ssl_context = ssl.create_default_context()
+        self._ssl_context.check_hostname = False
+        self._ssl_context.verify_mode = ssl.CERT_NONE
+
+    @staticmethod
+    def host_key(parsed_url):
+        is_https = parsed_url.scheme == "https"
+        port = parsed_url.port or (443 if is_https else 80)
+        return (parsed_url.scheme, parsed_url.hostname, port)
+
+    def connection_count(self, key=None):
+        """Returns the number of open connections, optionally for a single host
+        """
+        with self._condition:
+            if key is not None:
+                return self._active.get(key, 0) + len(self._idle.get(key, []))
+            return sum(self._active.values()) + sum(len(i) for i in self._idle.values())
+
+    def host_limit(self, key):
+        """Returns how many connections to a host may be checked out at once
+        """
+        with self._condition:
+            return self._host_limit(key)
+
+    def _host_limit(self, key):
+        # Must be called while holding self._condition
+        if not self.adaptive:
+            return self.max_per_host
+        if key not in self._limits:
+            self._limits[key] = AdaptiveLimit(maximum=self.max_per_host)
+        return min(self.max_per_host, self._limits[key].current)
+
+    def report(self, key, status, latency=None):
+        """Records how a request to a host went, adjusting its limit
+        """
+        if not self.adaptive:
+            return
+        with self._condition:
+            self._host_limit(key)
+            self._limits[key].record(status, latency)
+            # The limit may have gone up, so waiting threads might get a turn
+            self._condition.notify_all()
+
+    def evict_idle(self):
+        """Closes every connection that has been idle for too long
+        """
+        with self._condition:
+            self._evict_idle()
+
+    def _evict_idle(self):
+        # Must be called while holding self._condition
+        cutoff = time.monotonic() - self.idle_timeout
+        for key in list(self._idle.keys()):
+            keep = []
+            for connection, last_used in self._idle[key]:
+                if last_used < cutoff:
+                    connection.close()
+                else:
+                    keep.append((connection, last_used))
+            if keep:
+                self._idle[key] = keep
+            else:
+                del self._idle[key]
+        # Waiting threads might be able to open a connection now
+        self._condition.notify_all()
+
+    def _counted(self, key):
+        # Must be called while holding self._condition
+        return self._active.get(key, 0) - self._lent.get(key, 0)
+
+    def acquire(self, key):
+        """Checks out a connection for the given host key
+
+        Returns a tuple of (connection, reused) where reused indicates the
+        connection came from the idle list rather than being newly opened.
+        """
+        with self._condition:
+            while True:
+                self._evict_idle()
+                if self._counted(key) < self._host_limit(key):
+                    self._active[key] = self._active.get(key, 0) + 1
+                    idle = self._idle.get(key)
+                    if idle:
+                        connection, _ = idle.pop()
+                        return connection, True
+                    break
+                self._condition.wait(self.idle_timeout)
+        # Opening the connection is lazy, so this does not block under the lock
+        return self._new_connection(key), False
+
+    def release(self, key, connection, reusable=True):
+        with self._condition:
+            self._active[key] -= 1
+            if reusable:
+                self._idle.setdefault(key, []).append((connection, time.monotonic()))
+            else:
+                connection.close()
+            self._condition.notify_all()
+
+    @contextlib.contextmanager
+    def lend(self, uri):
+        """Lends the host slot of a connection the caller holds, for the block
+
+        A page streamed from a host keeps its connection while its links are
+        triaged, and those requests go to the same host. Lending the slot
+        while waiting on them lets them through. When the block exits the
+        slot is taken back, waiting until the host's limit allows it.
+        """
+        key = self.host_key(urllib.parse.urlparse(uri))
+        with self._condition:
+            self._lent[key] = self._lent.get(key, 0) + 1
+            self._condition.notify_all()
+        try:
+            yield
+        finally:
+            with self._condition:
+                while self._counted(key) >= self._host_limit(key):
+                    self._condition.wait(self.idle_timeout)
+                self._lent[key] -= 1
+
+    def _new_connection(self, key):
+        scheme, host, port = key
+        if scheme == "https":
+            return http.client.HTTPSConnection(host, port, timeout=self.timeout,
+                                               context=self._ssl_context)
+        return http.client.HTTPConnection(host, port, timeout=self.timeout)
+
+    def request(self, uri, method="GET", body=None, headers=None):
+        """Makes a request, following redirects the same way httplib2 does
+        """
+        key, connection, response, final_uri = self._open(uri, method, body, headers)
+        try:
+            content = response.read()
+        except:
+            self.release(key, connection, reusable=False)
+            raise
+        self.release(key, connection, reusable=not response.will_close)
+        return self._response_head(response, uri, final_uri), content
+
+    @contextlib.contextmanager
+    def stream(self, uri, chunk_size=65536, headers=None):
+        """Makes a GET request without reading the whole body into memory
+
+        Used as a context manager, this gives a tuple of (httplib2.Response,
+        chunks) where chunks is an iterator over the body. The connection goes
+        back into the pool when the block exits, and is only kept alive if the
+        body was read to the end.
+        """
+        key, connection, response, final_uri = self._open(uri, "GET", None, headers)
+        def read_chunks():
+            while True:
+                chunk = response.read(chunk_size)
+                if not chunk:
+                    break
+                yield chunk
+        try:
+            yield self._response_head(response, uri, final_uri), read_chunks()
+        except:
+            self.release(key, connection, reusable=False)
+            raise
+        finished = response.isclosed()
+        self.release(key, connection, reusable=finished and not response.will_close)
+
+    @staticmethod
+    def _response_head(response, requested_uri, final_uri):
+        head = httplib2.Response(response)
+        if final_uri != requested_uri:
+            head["content-location"] = final_uri
+        return head
+
+    def _open(self, uri, method, body, headers):
+        """Sends a request and returns once the response headers are in
+
+        Redirects are followed, and a tuple of (key, connection, response,
+        final_uri) is returned for the final response. The body has not been
+        read, and the caller must release the connection back to the pool.
+        """
+        for _ in range(self.max_redirects + 1):
+            key, connection, response = self._send(uri, method, body, headers)
+            location = response.getheader("location")
+            if response.status not in self.redirect_codes or not location:
+                break
+            # Discard the redirect's body so the connection can be reused
+            try:
+                response.read()
+            except:
+                self.release(key, connection, reusable=False)
+                raise
+            self.release(key, connection, reusable=not response.will_close)
+            uri = urllib.parse.urljoin(uri, location)
+        return key, connection, response, uri
+
+    def _send(self, uri, method, body, headers):
+        parsed_url = urllib.parse.urlparse(uri)
+        key = self.host_key(parsed_url)
+        path = parsed_url.path or "/"
+        if parsed_url.query:
+            path = "{}?{}".format(path, parsed_url.query)
+        request_headers = {"User-Agent": "opendir-dl"}
+        if headers:
+            request_headers.update(headers)
+        while True:
+            connection, reused = self.acquire(key)
+            started = time.monotonic()
+            try:
+                connection.request(method, path, body, request_headers)
+                response = connection.getresponse()
+            except (http.client.HTTPException, ConnectionError):
+                self.release(key, connection, reusable=False)
+                # The server may have closed a kept-alive connection while it
+                # sat idle. That is not an error, so try again on a new one.
+                if reused:
+                    continue
+                self.report(key, None)
+                raise
+            except:
+                self.release(key, connection, reusable=False)
+                self.report(key, None)
+                raise
+            self.report(key, response.status, time.monotonic() - started)
+            return key, connection, response
+
+    def close(self):
+        """Closes every idle connection in the pool
+        """
+        with self._condition:
+            for idle in self._idle.values():
+                for connection, _ in idle:
+                    connection.close()
+            self._idle = {}
+
+_SHARED_POOL = None
+_SHARED_POOL_LOCK = Lock()
+
+def shared_pool():
+    """Returns the process wide HttpPool, creating it on first use
+    """
+    global _SHARED_POOL
+    with _SHARED_POOL_LOCK:
+        if _SHARED_POOL is None:
+            _SHARED_POOL = HttpPool()
+        return _SHARED_POOL
@@ -0,0 +1,188 @@
+import os
+import json
+import time
+import datetime
+import contextlib
+from threading import Lock
+from threading import Event
+from threading import Thread
+
+# Upper bounds, in seconds, of the latency histogram buckets
+LATENCY_BUCKETS = [0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30]
+
+class Histogram(object):
+    """Counts observed values into buckets by their upper bound
+    """
+    def __init__(self, buckets=None):
+        self.buckets = list(buckets or LATENCY_BUCKETS)
+        # The extra slot counts the values above the largest bound
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[i] += 1
+                break
+        else:
+            self.counts[-1] += 1
+        self.count += 1
+        self.sum += value
+
+    def cumulative(self):
+        """Returns a list of (upper bound, count) tuples, as Prometheus has them
+        """
+        total = 0
+        result = []
+        for bound, count in zip(self.buckets + [float("inf")], self.counts):
+            total += count
+            result.append((bound, total))
+        return result
+
+    def as_dict(self):
+        mean = self.sum / self.count if self.count else 0.0
+        buckets = dict((format_bound(bound), count) for bound, count in self.cumulative())
+        return {"count": self.count, "sum": self.sum, "mean": mean, "buckets": buckets}
+
+def format_bound(bound):
+    if bound == float("inf"):
+        return "+Inf"
+    return repr(bound)
+
+class CrawlMetrics(object):
+    """Thread safe counters, histograms and gauges describing a running crawl
+
+    Counters only go up, histograms record timings, and gauges are functions
+    that are called each time a snapshot is taken, such as the length of a
+    queue.
+    """
+    def __init__(self):
+        self._lock = Lock()
+        self._counters = {}
+        self._histograms = {}
+        self._gauges = {}
+        self.started = time.monotonic()
+
+    def count(self, name, amount=1):
+        with self._lock:
+            self._counters[name] = self._counters.get(name, 0) + amount
+
+    def observe(self, name, value):
+        with self._lock:
+            if name not in self._histograms:
+                self._histograms[name] = Histogram()
+            self._histograms[name].observe(value)
+
+    @contextlib.contextmanager
+    def timer(self, name):
+        """Observes how many seconds the with block took into a histogram
+        """
+        started = time.monotonic()
+        try:
+            yield
+        finally:
+            self.observe(name, time.monotonic() - started)
+
+    def gauge(self, name, function):
+        with self._lock:
+            self._gauges[name] = function
+
+    def counter(self, name):
+        with self._lock:
+            return self._counters.get(name, 0)
+
+    def snapshot(self):
+        """Returns the current value of every metric as a dict
+        """
+        with self._lock:
+            counters = dict(self._counters)
+            histograms = dict((k, v.as_dict()) for k, v in self._histograms.items())
+            gauges = dict(self._gauges)
+        return {"time": datetime.datetime.utcnow().isoformat(),
+                "elapsed": time.monotonic() - self.started,
+                "counters": counters,
+                "gauges": dict((k, v()) for k, v in gauges.items()),
+                "histograms": histograms}
+
+    def prometheus(self, prefix="opendir_dl"):
+        """Returns every metric in the Prometheus text exposition format
+        """
+        with self._lock:
+            counters = sorted(self._counters.items())
+            histograms = sorted((k, v.cumulative(), v.sum, v.count) for k, v in self._histograms.items())
+            gauges = sorted(self._gauges.items())
+        lines = []
+        for name, value in counters:
+            lines.append("# TYPE {}_{}_total counter".format(prefix, name))
+            lines.append("{}_{}_total {}".format(prefix, name, value))
+        for name, function in gauges:
+            lines.append("# TYPE {}_{} gauge".format(prefix, name))
+            lines.append("{}_{} {}".format(prefix, name, function()))
+        for name, buckets, total, count in histograms:
+            lines.append("# TYPE {}_{} histogram".format(prefix, name))
+            for bound, bucket_count in buckets:
+                lines.append('{}_{}_bucket{{le="{}"}} {}'.format(prefix, name, format_bound(bound), bucket_count))
+            lines.append("{}_{}_sum {}".format(prefix, name, total))
+            lines.append("{}_{}_count {}".format(prefix, name, count))
+        return "\n".join(lines) + "\n"
+
+class MetricsWriter(object):
+    """Writes a crawl's metrics to a file every interval seconds
+
+    The jsonl format appends one snapshot per line, with requests_per_second
+    worked out over the last interval. The prometheus format replaces the file
+    each time, for the node exporter's textfile collector to pick up.
+    """
+    formats = ["jsonl", "prometheus"]
+
+    def __init__(self, metrics, path, output_format="jsonl", interval=10):
+        if output_format not in self.formats:
+            message = "Metrics format must be one of: 'jsonl', 'prometheus'. Got format '{}'.".format(output_format)
+            raise ValueError(message)
+        self.metrics = metrics
+        self.path = path
+        self.output_format = output_format
+        self.interval = interval
+        self._stop = Event()
+        self._thread = None
+        self._last_requests = 0
+        self._last_time = time.monotonic()
+
+    def requests(self):
+        return self.metrics.counter("head_requests") + self.metrics.counter("get_requests")
+
+    def write(self):
+        if self.output_format == "prometheus":
+            # Write then rename, so a reader never sees a half written file
+            temp_path = "{}.tmp".format(self.path)
+            with open(temp_path, "w") as metrics_file:
+                metrics_file.write(self.metrics.prometheus())
+            os.replace(temp_path, self.path)
+            return
+        snapshot = self.metrics.snapshot()
+        now = time.monotonic()
+        requests = self.requests()
+        elapsed = now - self._last_time
+        snapshot["requests_per_second"] = (requests - self._last_requests) / elapsed if elapsed > 0 else 0.0
+        self._last_requests = requests
+        self._last_time = now
+        with open(self.path, "a") as metrics_file:
+            metrics_file.write(json.dumps(snapshot, sort_keys=True) + "\n")
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            self.write()
+
+    def start(self):
+        self._thread = Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        """Stops the writer thread, and writes the final values
+        """
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+        self.write()
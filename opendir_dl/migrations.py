@@ -0,0 +1,140 @@
+import datetime
+import sqlalchemy
+from opendir_dl.models import MODELBASE
+from opendir_dl.models import SchemaVersion
+from opendir_dl.models import FileIndex
+from opendir_dl.writer import IndexKeys
+
+# Every migration, in the order they're applied. Each is a (version,
+# description, function) tuple, and the function is given a connection inside
+# the transaction that records its version.
+MIGRATIONS = []
+
+def migration(version, description):
+    """Registers the decorated function as the migration to the given version
+    """
+    def decorator(function):
+        MIGRATIONS.append((version, description, function))
+        MIGRATIONS.sort(key=lambda i: i[0])
+        return function
+    return decorator
+
+@migration(1, "Unique url key on fileindex")
+def unique_url_key(connection):
+    # Older versions could save a file more than once, so every url's
+    # duplicates are dropped first. The newest row is kept, and the
+    # duplicates' tags are moved to it.
+    indexes = sqlalchemy.inspect(connection).get_indexes("fileindex")
+    if any(i["column_names"] == ["url"] and i["unique"] for i in indexes):
+        return
+    connection.execute("""
+        UPDATE associations SET left_pkid = (
+            SELECT MAX(newest.pkid) FROM fileindex AS newest JOIN fileindex AS old
+            ON newest.url = old.url WHERE old.pkid = associations.left_pkid)
+        WHERE left_pkid NOT IN (SELECT MAX(pkid) FROM fileindex GROUP BY url)""")
+    connection.execute("DELETE FROM fileindex WHERE pkid NOT IN (SELECT MAX(pkid) FROM fileindex GROUP BY url)")
+    connection.execute("DROP INDEX IF EXISTS ix_fileindex_url")
+    connection.execute("CREATE UNIQUE INDEX ix_fileindex_url ON fileindex (url)")
+
+@migration(2, "Indexes for search, upserts and tag joins")
+def search_indexes(connection):
+    # Named the way SQLAlchemy names the indexes it creates for a new database
+    connection.execute("CREATE INDEX IF NOT EXISTS ix_fileindex_name ON fileindex (name)")
+    connection.execute("CREATE INDEX IF NOT EXISTS ix_fileindex_domain ON fileindex (domain)")
+    connection.execute("CREATE INDEX IF NOT EXISTS ix_fileindex_last_indexed ON fileindex (last_indexed)")
+    connection.execute("CREATE INDEX IF NOT EXISTS ix_tags_name ON tags (name)")
+    connection.execute("CREATE INDEX IF NOT EXISTS ix_associations_left_pkid ON associations (left_pkid)")
+    connection.execute("CREATE INDEX IF NOT EXISTS ix_associations_right_pkid ON associations (right_pkid)")
+
+# Rows are copied with their pkid, so tags still point at the same files. The
+# datetimes are copied as they were stored.
+COPY_FILEINDEX = sqlalchemy.text("""
+    INSERT INTO fileindex (pkid, directory_pkid, name, leaf, content_type_pkid, last_indexed, last_modified, content_length)
+    VALUES (:pkid, :directory_pkid, :name, :leaf, :content_type_pkid, :last_indexed, :last_modified, :content_length)
+    ON CONFLICT DO NOTHING""")
+MOVE_TAGS = sqlalchemy.text("""
+    UPDATE associations SET left_pkid = (
+        SELECT pkid FROM fileindex WHERE directory_pkid = :directory_pkid AND name = :name
+        AND coalesce(leaf, '/') = coalesce(:leaf, '/'))
+    WHERE left_pkid = :pkid""")
+
+# Files as they were stored before hosts, directories and content types had
+# tables of their own, for raw SQL searches
+FILES_VIEW = """
+    CREATE VIEW IF NOT EXISTS files AS
+    SELECT fileindex.pkid, hosts.name || directories.path || coalesce(fileindex.leaf, fileindex.name) AS url,
+        fileindex.name, hosts.domain, fileindex.last_indexed, content_types.name AS content_type,
+        fileindex.last_modified, fileindex.content_length
+    FROM fileindex JOIN directories ON directories.pkid = fileindex.directory_pkid
+    JOIN hosts ON hosts.pkid = directories.host_pkid
+    LEFT JOIN content_types ON content_types.pkid = fileindex.content_type_pkid"""
+
+@migration(3, "Hosts, directories and content types stored once")
+def normalized_files(connection):
+    # The old table is renamed out of the way without touching the
+    # associations that point at it, since its rows keep their pkids
+    for index in sqlalchemy.inspect(connection).get_indexes("fileindex"):
+        connection.execute("DROP INDEX {}".format(index["name"]))
+    connection.execute("PRAGMA legacy_alter_table = ON")
+    connection.execute("ALTER TABLE fileindex RENAME TO fileindex_old")
+    connection.execute("PRAGMA legacy_alter_table = OFF")
+    FileIndex.__table__.create(connection)
+    keys = IndexKeys(connection)
+    result = connection.execute("""
+        SELECT pkid, url, name, domain, content_type, last_indexed, last_modified, content_length
+        FROM fileindex_old ORDER BY pkid""")
+    rows = result.fetchmany(1000)
+    while rows:
+        for row in rows:
+            values = keys.file_row(row.url or "", row.name, row.domain, row.content_type)
+            values.update({"pkid": row.pkid,
+                           "last_indexed": row.last_indexed,
+                           "last_modified": row.last_modified,
+                           "content_length": row.content_length})
+            # Urls that only differed by a fragment are now the same file
+            if connection.execute(COPY_FILEINDEX, values).rowcount == 0:
+                connection.execute(MOVE_TAGS, values)
+        rows = result.fetchmany(1000)
+    connection.execute("DROP TABLE fileindex_old")
+
+def latest_version():
+    return MIGRATIONS[-1][0] if MIGRATIONS else 0
+
+def schema_version(connection):
+    """Returns the version of the last migration applied, or 0 for none
+    """
+    version = connection.execute(sqlalchemy.select([sqlalchemy.func.max(SchemaVersion.version)])).scalar()
+    return version or 0
+
+def record_version(connection, version, description):
+    connection.execute(SchemaVersion.__table__.insert(),
+                       version=version, description=description, applied=datetime.datetime.utcnow())
+
+def migrate(database_engine):
+    """Creates any missing tables and brings the schema up to the latest version
+
+    New databases are created with the latest schema, so they're only stamped
+    with every version. Each migration runs in its own transaction along with
+    the record of its version, so an interrupted upgrade picks up where it
+    stopped. The files view is created last, once fileindex has its latest
+    shape. Returns the list of versions that were applied.
+    """
+    is_new = "fileindex" not in sqlalchemy.inspect(database_engine).get_table_names()
+    MODELBASE.metadata.create_all(database_engine)
+    with database_engine.connect() as connection:
+        version = schema_version(connection)
+    if version > latest_version():
+        message = "Database schema version {} is newer than the latest this version of opendir-dl knows ({})."
+        raise ValueError(message.format(version, latest_version()))
+    applied = []
+    for number, description, function in MIGRATIONS:
+        if number <= version:
+            continue
+        with database_engine.begin() as connection:
+            if not is_new:
+                function(connection)
+            record_version(connection, number, description)
+        applied.append(number)
+    with database_engine.begin() as connection:
+        connection.execute(FILES_VIEW)
+    return applied
@@ -4,34 +4,185 @@ from sqlalchemy import Integer
 from sqlalchemy import DateTime
 from sqlalchemy import Table
 from sqlalchemy import ForeignKey
+from sqlalchemy import Index
+from sqlalchemy import select
+from sqlalchemy import func
 from sqlalchemy.orm import relationship
+from sqlalchemy.ext.hybrid import hybrid_property
 from sqlalchemy.ext.declarative import declarative_base
 
 MODELBASE = declarative_base()
 
 # The association table relates file indexes with tags
 ASSOCIATION_TABLE = Table('associations', MODELBASE.metadata,
-                          Column('left_pkid', Integer, ForeignKey('fileindex.pkid')),
-                          Column('right_pkid', Integer, ForeignKey('tags.pkid')))
+                          Column('left_pkid', Integer, ForeignKey('fileindex.pkid'), index=True),
+                          Column('right_pkid', Integer, ForeignKey('tags.pkid'), index=True))
+
+class Host(MODELBASE):
+    """This represents a server files are indexed from
+
+    The name is the url's scheme and network location, like
+    'http://example.com:8000', and the domain is just its hostname.
+    """
+    __tablename__ = "hosts"
+    pkid = Column(Integer, primary_key=True)
+    name = Column(String, unique=True)
+    domain = Column(String, index=True)
+
+class Directory(MODELBASE):
+    """This represents a directory on a host that holds indexed files
+
+    The path starts and ends with '/', and every directory points to the one
+    above it. Directories are unique by host and path, so everything under a
+    directory is a range scan on that index.
+    """
+    __tablename__ = "directories"
+    __table_args__ = (Index("ux_directories_host_path", "host_pkid", "path", unique=True),)
+    pkid = Column(Integer, primary_key=True)
+    host_pkid = Column(Integer, ForeignKey('hosts.pkid'))
+    parent_pkid = Column(Integer, ForeignKey('directories.pkid'), index=True)
+    path = Column(String)
+    host = relationship("Host", lazy="joined")
+    parent = relationship("Directory", remote_side=[pkid])
+
+    @property
+    def url(self):
+        return self.host.name + self.path
+
+class ContentType(MODELBASE):
+    """This represents a content type, stored once for every file that has it
+    """
+    __tablename__ = "content_types"
+    pkid = Column(Integer, primary_key=True)
+    name = Column(String, unique=True)
 
 class FileIndex(MODELBASE):
     """This represents a remote file
+
+    Files are stored by their directory, name and content type, and the url,
+    domain and content type are put back together when they're read. Leaf is
+    the url's last path segment and query as they were served, and is only
+    kept when it isn't the same as the name. A new FileIndex holds the values
+    it was made with until it's saved, see writer.upsert_fileindexes.
     """
     __tablename__ = "fileindex"
     pkid = Column(Integer, primary_key=True)
-    url = Column(String)
-    name = Column(String)
-    domain = Column(String)
-    last_indexed = Column(DateTime)
-    content_type = Column(String)
+    directory_pkid = Column(Integer, ForeignKey('directories.pkid'))
+    name = Column(String, index=True)
+    leaf = Column(String)
+    content_type_pkid = Column(Integer, ForeignKey('content_types.pkid'))
+    last_indexed = Column(DateTime, index=True)
     last_modified = Column(DateTime)
     content_length = Column(Integer)
+    directory = relationship("Directory", lazy="joined")
+    content_type_entry = relationship("ContentType", lazy="joined")
     tags = relationship("Tags", secondary=ASSOCIATION_TABLE, back_populates="indexes")
+    # Values of a FileIndex that hasn't been saved yet
+    _url = None
+    _domain = None
+    _content_type = None
+
+    @hybrid_property
+    def url(self):
+        if self.directory is None:
+            return self._url
+        return self.directory.url + (self.leaf if self.leaf is not None else self.name)
+
+    @url.setter
+    def url(self, value):
+        self._url = value
+
+    @url.expression
+    def url(cls):
+        prefix = select([Host.name + Directory.path]).where(Directory.pkid == cls.directory_pkid)
+        prefix = prefix.where(Host.pkid == Directory.host_pkid).as_scalar()
+        return prefix + func.coalesce(cls.leaf, cls.name)
+
+    @hybrid_property
+    def domain(self):
+        if self.directory is None:
+            return self._domain
+        return self.directory.host.domain
+
+    @domain.setter
+    def domain(self, value):
+        self._domain = value
+
+    @domain.expression
+    def domain(cls):
+        return select([Host.domain]).where(Directory.pkid == cls.directory_pkid).where(
+            Host.pkid == Directory.host_pkid).as_scalar()
+
+    @hybrid_property
+    def content_type(self):
+        if self.content_type_pkid is None:
+            return self._content_type
+        return self.content_type_entry.name
+
+    @content_type.setter
+    def content_type(self, value):
+        self._content_type = value
+
+    @content_type.expression
+    def content_type(cls):
+        return select([ContentType.name]).where(ContentType.pkid == cls.content_type_pkid).as_scalar()
+
+# A file is unique by its directory, name and leaf. Leaf is null when it's the
+# same as the name, and '/' never appears in a leaf, so it stands in for null.
+Index("ux_fileindex_file", FileIndex.directory_pkid, FileIndex.name, func.coalesce(FileIndex.leaf, "/"), unique=True)
 
 class Tags(MODELBASE):
     """This represents a tag
     """
     __tablename__ = "tags"
     pkid = Column(Integer, primary_key=True)
-    name = Column(String)
+    name = Column(String, index=True)
     indexes = relationship("FileIndex", secondary=ASSOCIATION_TABLE, back_populates="tags")
+
+class FrontierEntry(MODELBASE):
+    """This represents a page found by a crawl, and how far it got with it
+
+    State is one of 'pending', 'in_flight' or 'done'. The entries are kept so an
+    interrupted crawl can be resumed.
+    """
+    __tablename__ = "frontier"
+    pkid = Column(Integer, primary_key=True)
+    url = Column(String, index=True)
+    depth = Column(Integer)
+    state = Column(String)
+
+class CrawledPage(MODELBASE):
+    """This represents a directory page, and the validators it was served with
+
+    The etag and last_modified values are kept as the server sent them, so they
+    can be sent back as-is in a conditional request.
+    """
+    __tablename__ = "crawledpages"
+    pkid = Column(Integer, primary_key=True)
+    url = Column(String, index=True)
+    etag = Column(String)
+    last_modified = Column(String)
+    last_crawled = Column(DateTime)
+
+class RetryEntry(MODELBASE):
+    """This represents a URL a crawl gave up on after transient failures
+
+    Kind is 'page' for a page that still has to be scraped, and 'triage' for a
+    link that still has to be triaged.
+    """
+    __tablename__ = "retries"
+    pkid = Column(Integer, primary_key=True)
+    url = Column(String)
+    depth = Column(Integer)
+    kind = Column(String)
+    error = Column(String)
+
+class SchemaVersion(MODELBASE):
+    """This represents a migration that has been applied to the database
+
+    The highest version is the database's schema version, see migrations.py
+    """
+    __tablename__ = "schema_version"
+    version = Column(Integer, primary_key=True)
+    description = Column(String)
+    applied = Column(DateTime)
@@ -0,0 +1,126 @@
+import sys
+import time
+import queue
+from threading import Event
+from threading import Thread
+
+# Output levels, from only errors and the summary up to a line per URL
+QUIET = 0
+NORMAL = 1
+VERBOSE = 2
+
+class ProgressReporter(object):
+    """Shows how a crawl is going on a single status line
+
+    Worker threads hand their messages to log() instead of printing them, and
+    a single reporter thread writes them out along with a status line built
+    from the crawl's metrics, a few times per second. Workers never wait on
+    the console. log() takes a format string and its arguments, so messages
+    above the reporter's level are dropped before they are formatted, and the
+    rest are formatted on the reporter thread. When the reporter isn't
+    running, log() writes straight to the stream.
+
+    On a terminal the status line is redrawn in place. Otherwise a plain
+    status line is written every status_interval seconds.
+    """
+    def __init__(self, metrics=None, level=NORMAL, interval=0.25, stream=None):
+        self.metrics = metrics
+        self.level = level
+        self.interval = interval
+        self.status_interval = 10
+        self.stream = stream or sys.stdout
+        self._messages = queue.Queue()
+        self._stop = Event()
+        self._thread = None
+        self._status_shown = False
+        self._last_status = time.monotonic()
+        self._rate_sample = (time.monotonic(), 0)
+        self._rate = 0.0
+
+    def log(self, message, level=VERBOSE, *args):
+        if level > self.level:
+            return
+        if self._thread is None:
+            self.stream.write("{}\n".format(message.format(*args)))
+            self.stream.flush()
+        else:
+            self._messages.put((message, args))
+
+    def is_tty(self):
+        return hasattr(self.stream, "isatty") and self.stream.isatty()
+
+    def requests(self, counters):
+        return counters.get("get_requests", 0) + counters.get("head_requests", 0)
+
+    def status_line(self):
+        """Sums up the crawl so far from its metrics
+        """
+        snapshot = self.metrics.snapshot()
+        counters = snapshot["counters"]
+        gauges = snapshot["gauges"]
+        now = time.monotonic()
+        requests = self.requests(counters)
+        sample_time, sample_requests = self._rate_sample
+        # The rate is taken over about a second, so it doesn't flicker
+        if now - sample_time >= 1:
+            self._rate = (requests - sample_requests) / (now - sample_time)
+            self._rate_sample = (now, requests)
+        queued = gauges.get("frontier_queued", gauges.get("tasks", 0))
+        line = "{} pages, {} files indexed, {} queued, {:.1f} req/s, {:.1f} MB"
+        line = line.format(counters.get("pages_scraped", 0), counters.get("files_indexed", 0),
+                           queued, self._rate, counters.get("bytes_received", 0) / 1024.0 / 1024.0)
+        if counters.get("deferred"):
+            line += ", {} deferred".format(counters["deferred"])
+        return line
+
+    def refresh(self, final=False):
+        """Writes out the waiting messages, then the status line
+        """
+        lines = []
+        while True:
+            try:
+                message, args = self._messages.get_nowait()
+                lines.append(message.format(*args))
+            except queue.Empty:
+                break
+        show_status = self.metrics is not None and self.level >= NORMAL
+        if self.is_tty():
+            output = "".join("{}\n".format(i) for i in lines)
+            if self._status_shown:
+                # Clear the status line before writing over it
+                output = "\r\x1b[K" + output
+            if show_status:
+                output += self.status_line()
+                self._status_shown = True
+                if final:
+                    output += "\n"
+            self.stream.write(output)
+        else:
+            output = "".join("{}\n".format(i) for i in lines)
+            now = time.monotonic()
+            if show_status and (final or now - self._last_status >= self.status_interval):
+                output += "{}\n".format(self.status_line())
+                self._last_status = now
+            self.stream.write(output)
+        self.stream.flush()
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            self.refresh()
+
+    def start(self):
+        self._stop.clear()
+        self._last_status = time.monotonic()
+        self._thread = Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        """Stops the reporter thread, writing any last messages and the status
+        """
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+        self.refresh(final=True)
+        self._thread = None
+        self._status_shown = False
@@ -0,0 +1,147 @@
+import time
+import random
+import asyncio
+import http.client
+from threading import Lock
+import httplib2
+
+class AdaptiveLimit(object):
+    """Number of requests to allow in flight to one host, adjusted as they finish
+
+    The limit is raised additively, by about one for every limit requests that
+    come back quickly, and cut by the backoff factor when a request times out,
+    fails to connect or is answered with one of backoff_statuses. Responses
+    that come back much slower than the fastest one seen so far mean requests
+    are queueing on the server, so they hold the limit where it is.
+
+    After a cut, the requests that were already in flight are allowed to
+    finish before another failure can cut it again. Nothing here is thread
+    safe, so callers must serialize calls to record().
+    """
+    backoff_statuses = [429, 503]
+
+    def __init__(self, initial=2, minimum=1, maximum=10, backoff=0.5,
+                 latency_tolerance=2.0, latency_slack=0.05):
+        self.limit = float(initial)
+        self.minimum = minimum
+        self.maximum = maximum
+        self.backoff = backoff
+        self.latency_tolerance = latency_tolerance
+        self.latency_slack = latency_slack
+        self.min_latency = None
+        self._cooldown = 0
+
+    @property
+    def current(self):
+        return max(self.minimum, min(self.maximum, int(self.limit)))
+
+    def record(self, status, latency=None):
+        """Adjusts the limit for a finished request
+
+        Status is the HTTP status the request was answered with, or None if it
+        failed without an answer. Latency is the number of seconds until the
+        response headers arrived.
+        """
+        if self._cooldown > 0:
+            self._cooldown -= 1
+        if status is None or status in self.backoff_statuses:
+            self._decrease()
+        elif latency is not None:
+            self._increase(latency)
+
+    def _decrease(self):
+        if self._cooldown > 0:
+            return
+        self._cooldown = self.current
+        self.limit = max(self.minimum, self.limit * self.backoff)
+
+    def _increase(self, latency):
+        if self.min_latency is None or latency < self.min_latency:
+            self.min_latency = latency
+        if latency > self.min_latency * self.latency_tolerance + self.latency_slack:
+            return
+        self.limit = min(self.maximum, self.limit + 1.0 / self.limit)
+
+class TransientError(Exception):
+    """A request failed in a way that may not happen if it is tried again
+    """
+
+class HostUnavailable(TransientError):
+    """A request wasn't sent because the host's circuit breaker is open
+    """
+
+class RetryPolicy(object):
+    """Decides which failures are retried, and how long to wait between tries
+
+    Connection errors, timeouts and the statuses in retry_statuses are
+    transient. They are tried up to attempts times in all, waiting a random
+    time of up to base_delay doubled for every try so far, capped at max_delay.
+    The randomness keeps workers that failed together from retrying together.
+    """
+    retry_statuses = [429, 500, 502, 503, 504]
+    transient_errors = (TransientError, OSError, http.client.HTTPException,
+                        httplib2.HttpLib2Error, asyncio.TimeoutError)
+
+    def __init__(self, attempts=3, base_delay=0.5, max_delay=30):
+        self.attempts = attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+
+    def delay(self, attempt):
+        """Seconds to wait after the given try, counted from 0
+        """
+        return random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+
+    def is_transient(self, error):
+        return isinstance(error, self.transient_errors)
+
+    def check_status(self, status):
+        """Raises TransientError if a response status is worth retrying
+        """
+        if int(status) in self.retry_statuses:
+            raise TransientError("HTTP Error {}".format(status))
+
+class CircuitBreaker(object):
+    """Stops sending requests to hosts that keep failing
+
+    A host's breaker opens after failure_threshold transient failures in a
+    row, and requests to it are refused for reset_timeout seconds. After that
+    a single request is let through to probe the host. If it succeeds the
+    breaker closes, and if it fails the breaker opens again. Thread safe.
+    """
+    def __init__(self, failure_threshold=5, reset_timeout=60):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self._lock = Lock()
+        self._failures = {}
+        self._opened = {}
+        self._probing = set()
+
+    def is_open(self, host):
+        with self._lock:
+            return host in self._opened
+
+    def allow(self, host):
+        """True if a request to the host may be sent now
+        """
+        with self._lock:
+            opened = self._opened.get(host)
+            if opened is None:
+                return True
+            if time.monotonic() - opened < self.reset_timeout or host in self._probing:
+                return False
+            self._probing.add(host)
+            return True
+
+    def record_success(self, host):
+        with self._lock:
+            self._failures.pop(host, None)
+            self._opened.pop(host, None)
+            self._probing.discard(host)
+
+    def record_failure(self, host):
+        with self._lock:
+            self._failures[host] = self._failures.get(host, 0) + 1
+            if host in self._probing or self._failures[host] >= self.failure_threshold:
+                self._opened[host] = time.monotonic()
+                self._probing.discard(host)
@@ -1,26 +1,60 @@
-from time import sleep
+import time
 import urllib
+import codecs
+import contextlib
 import datetime
 import queue
+import multiprocessing
+import concurrent.futures
 from threading import Thread
-from threading import Lock
-import httplib2
 import sqlalchemy
+import lxml.etree
 from bs4 import BeautifulSoup
+from bs4 import UnicodeDammit
 from prettytable import PrettyTable
 from opendir_dl.models import FileIndex
+from opendir_dl.models import Directory
+from opendir_dl.models import Host
+from opendir_dl.httppool import shared_pool
+from opendir_dl.frontier import CrawlFrontier
+from opendir_dl.frontier import visited_sets
+from opendir_dl.frontier import FrontierStore
+from opendir_dl.frontier import FrontierUpdate
+from opendir_dl.frontier import PageValidators
+from opendir_dl.frontier import RetryItem
+from opendir_dl.throttle import RetryPolicy
+from opendir_dl.throttle import CircuitBreaker
+from opendir_dl.throttle import HostUnavailable
+from opendir_dl.metrics import CrawlMetrics
+from opendir_dl.budget import CrawlBudget
+from opendir_dl.progress import ProgressReporter
+from opendir_dl.progress import QUIET
+from opendir_dl.progress import NORMAL
+from opendir_dl.progress import VERBOSE
+from opendir_dl.autoindex import parse_listing
+from opendir_dl.autoindex import parse_structured_listing
+from opendir_dl.autoindex import listing_format
+from opendir_dl.autoindex import ListingFormats
+from opendir_dl.writer import IndexWriter
+from opendir_dl.writer import upsert_fileindexes
+from opendir_dl.writer import canonical_url
+from opendir_dl.writer import split_url
 
 class PageCrawler(object):
-    def __init__(self, db_conn, url_targets=None):
+    def __init__(self, db_conn, url_targets=None, http_session=None):
         """Prepare the PageCrawler
 
         Required initial values are a database connection to save file entries
         to as well as a list of URLs to search. This list can contain any
-        number of URLs.
+        number of URLs. All requests are made through http_session, which
+        defaults to the shared connection pool.
         """
         self.db_conn = db_conn
+        self.http_session = http_session
+        if not self.http_session:
+            self.http_session = shared_pool()
         # Values for triage method
-        self._triage_quick = False
+        self._triage_mode = "standard"
         self._triage_method = self.triage_standard
         # FileIndex creation values
         self._fileindex_creator_thread = None
@@ -28,14 +62,64 @@ class PageCrawler(object):
         # PageScrapper values
         self.scraper_threads_max = 5
         self._scraper_threads = []
-        self._urls_to_scrape = queue.Queue()
+        # The links on a page are triaged concurrently by a shared pool of
+        # threads, so no more than triage_fanout HEAD requests are in flight
+        self.triage_fanout = 10
+        # Pages are triaged while they download, and reading stops while more
+        # than triage_backlog of their links are waiting on triage
+        self.triage_backlog = 1000
+        self._triage_executor = None
+        # With parse_workers above 0, pages are read whole and parsed in a
+        # pool of that many processes, so parsing isn't held to one core by
+        # the GIL. Otherwise they are parsed as they stream in.
+        self.parse_workers = 0
+        self._parse_executor = None
+        # The frontier counts outstanding pages, so the control loop knows we
+        # are out of work the moment the last page has been scraped. Both the
+        # frontier and triage keep a record of the URLs they've seen, so
+        # symlink loops and cross linked listings are only requested once.
+        self._urls_to_scrape = CrawlFrontier()
+        self.limit_visited()
+        # The frontier is saved to the index database as the crawl goes, and
+        # setting resume picks up the pages a previous crawl didn't finish
+        self.resume = False
+        self._frontier_store = None
+        # Maps page urls to the PageValidators they were last served with.
+        # Pages are requested conditionally, and an unchanged page is not
+        # scraped, along with everything below it.
+        self._validators = {}
+        # Maps page urls to the validators they were served with this crawl,
+        # which are only saved once the page is done
+        self._served_validators = {}
+        # Hosts serving nginx json or xml, or Caddy JSON listings are read
+        # without an html parser, and their files are indexed without HEAD
+        # requests, since the listing gives exact sizes and times
+        self.listing_formats = ListingFormats()
+        # Transient failures are retried following retry_policy. Hosts that
+        # keep failing are cut off by the circuit breaker, and work that can't
+        # be done is set aside in retry_queue rather than waiting on timeouts.
+        # It is saved to the database, and setting retry tries it again.
+        self.retry_policy = RetryPolicy()
+        self.circuit_breaker = CircuitBreaker()
+        self.retry_queue = []
+        self.retry = False
+        # Counters, timings and queue depths, for a MetricsWriter to report
+        self.metrics = CrawlMetrics()
+        self.metrics.gauge("frontier_queued", lambda: len(self._urls_to_scrape))
+        self.metrics.gauge("frontier_outstanding", lambda: self._urls_to_scrape.outstanding)
+        self.metrics.gauge("fileindex_queued", lambda: self._fileindex_heads.qsize())
+        self.metrics.gauge("visited_urls", lambda: len(self.visited))
+        self.metrics.gauge("retry_queued", lambda: len(self.retry_queue))
+        self.reporter = ProgressReporter(self.metrics)
+        # Everything found is saved from the fileindex creator thread, in
+        # batches of writer.batch_size with one transaction each
+        self.writer = IndexWriter(db_conn, self.metrics, reporter=self.reporter)
+        # Reaching any of the budget's caps stops the crawl as Ctrl-C would,
+        # saving everything found so far. stopped_by names the cap reached.
+        self.budget = CrawlBudget()
+        self.stopped_by = None
         # Thread exit is used to break all the threads out of their loop
         self._thread_exit = False
-        # Thread idle is used to determine when to stop the control loop. When
-        # all the threads are idle, and self._urls_to_scrape is empty, then we
-        # are out of work to do, and should finish execution.
-        self._thread_idle_lock = Lock()
-        self._thread_idle = []
         # Adds any provided url targets to a list to be triaged at once the
         # scraper is started
         if url_targets:
@@ -49,67 +133,479 @@ class PageCrawler(object):
         thus changing the method we triage new URLs. That method results in
         fewer head requests, thus speading the indexing processs. Cool huh!!
         """
-        return self._triage_quick
+        return self._triage_mode == "quick"
 
     @quick.setter
     def quick(self, value):
-        self._triage_quick = value
-        if self._triage_quick:
-            self._triage_method = self.triage_quick
+        if value:
+            self.triage_mode = "quick"
         else:
-            self._triage_method = self.triage_standard
+            self.triage_mode = "standard"
+
+    @property
+    def triage_mode(self):
+        """Name of the triage method, one of 'standard', 'quick' or 'listing'
+
+        The listing mode reads sizes and dates off of directory listing pages
+        and only makes HEAD requests for the links it can't account for.
+        """
+        return self._triage_mode
+
+    @triage_mode.setter
+    def triage_mode(self, value):
+        triage_methods = {"standard": self.triage_standard,
+                          "quick": self.triage_quick,
+                          "listing": self.triage_listing}
+        if value not in triage_methods:
+            message = "Triage mode must be one of: 'standard', 'quick', 'listing'. Got mode '{}'.".format(value)
+            raise ValueError(message)
+        self._triage_mode = value
+        self._triage_method = triage_methods[value]
+
+    @property
+    def max_depth(self):
+        """How many directory levels below the index targets will be scraped
+
+        The index targets are at depth 0, so a max_depth of 0 indexes only the
+        files listed on the target pages. None means there is no limit.
+        """
+        return self._urls_to_scrape.max_depth
+
+    @max_depth.setter
+    def max_depth(self, value):
+        self._urls_to_scrape.max_depth = value
 
     def add_index_targets(self, index_targets):
+        urls = []
         for item in index_targets:
             if is_url(item):
-                self._triage_method(item)
+                urls.append(item)
             elif isinstance(item, int) or item.isdigit():
-                index_entry = self.db_conn.query(FileIndex).get(int(item))
-                self._triage_method(index_entry.url)
+                urls.append(self.db_conn.query(FileIndex).get(int(item)).url)
+        if self.db_conn is not None:
+            # End the read, so the writer thread takes over a clean session
+            self.db_conn.commit()
+        for url in urls:
+            if self.visited.add(url):
+                self.triage_one(url)
+
+    def limit_visited(self, max_bytes=None, error_rate=None):
+        """Builds the visited sets, so together they use at most max_bytes
+
+        One set records every link triaged and the other every page put on
+        the frontier.
+        """
+        self.visited, self._urls_to_scrape.visited = visited_sets(2, max_bytes, error_rate)
 
     def fileindex_creator(self):
-        # Pull head objects from the queue and save them. Continue until the
-        # thread exit flag is set, at which poit
-        while not self._thread_exit:
-            try:
-                head = self._fileindex_heads.get(timeout=.1)
-                save_head(self.db_conn, head.as_fileindex())
-            except queue.Empty:
-                pass
+        # The only thread to use the database session once the crawl starts.
+        # Pull head objects from the queue and save them in batches until the
+        # thread exit flag is set and every queued head has been saved.
+        # Frontier updates share the queue, so a page is only saved as done
+        # after the heads triaged from it.
+        self.writer.drain(self._fileindex_heads, lambda: self._thread_exit)
 
-    def set_idle_status(self, thread_id, status):
-        # This is used to set the idle status of threads. This handles the lock
-        # acquisition process safely
-        self._thread_idle_lock.acquire()
-        self._thread_idle[thread_id] = status
-        self._thread_idle_lock.release()
+    def schedule_page(self, url, depth=0):
+        """Puts a page on the frontier to be scraped
+        """
+        if self._urls_to_scrape.put(url, depth):
+            self.record_page(url, depth, FrontierStore.pending)
+
+    def record_page(self, url, depth, state):
+        if self._frontier_store is not None:
+            self._fileindex_heads.put(FrontierUpdate(url, depth, state))
+
+    def load_frontier(self):
+        """Fills the frontier with the pages a previous crawl didn't finish
+
+        Every page it found is marked as visited, and the ones it finished
+        aren't scraped again.
+        """
+        for url, depth, state in self._frontier_store.entries():
+            self.visited.add(url)
+            if state == FrontierStore.done:
+                self._urls_to_scrape.visited.add(url)
+            else:
+                self._urls_to_scrape.put(url, depth)
+
+    def over_budget(self):
+        """True once the crawl has reached one of its budget's caps
+        """
+        if self.stopped_by is None:
+            self.stopped_by = self.budget.exceeded(self.metrics)
+            if self.stopped_by is not None:
+                self._thread_exit = True
+        return self.stopped_by is not None
 
     def page_scraper(self, thread_num):
-        http_session = httplib2.Http(disable_ssl_certificate_validation=True)
-        while not self._thread_exit:
+        while not self._thread_exit and not self.over_budget():
             try:
-                target_url = self._urls_to_scrape.get(timeout=.1)
-                print("Thread {} got url {}".format(thread_num, target_url))
-                # Indicate to the controller that this thread is not idle
-                self.set_idle_status(thread_num, False)
-                response = http_session.request(target_url)
-                new_urls = parse_urls(target_url, response[1])
-                for i, e in enumerate(new_urls):
-                    if not self._thread_exit:
-                        print("Thread {} triaging new url {} of {}.".format(thread_num, i+1, len(new_urls)))
-                        self._triage_method(e, http_session=http_session)
-                    else:
-                        break
-                self.set_idle_status(thread_num, True)
+                target_url, depth = self._urls_to_scrape.get(timeout=.1)
             except queue.Empty:
-                pass
-            except:
-                self.set_idle_status(thread_num, True)
-                raise
+                continue
+            try:
+                self.scrape_one(thread_num, target_url, depth)
+            finally:
+                self._urls_to_scrape.task_done()
+
+    def scrape_one(self, thread_num, target_url, depth):
+        """Scrapes a page taken off of the frontier, retrying it if need be
+        """
+        try:
+            self.reporter.log("Thread {} got url {}", VERBOSE, thread_num, target_url)
+            self.record_page(target_url, depth, FrontierStore.in_flight)
+            self.attempt(target_url, self.scrape_page, thread_num, target_url, depth)
+            self.page_done(target_url, depth)
+            self.metrics.count("pages_scraped")
+        except Exception as error:
+            # A dead thread would leave its pages outstanding forever, so
+            # report the failure and move on to the next page
+            self._served_validators.pop(target_url, None)
+            if self.retry_policy.is_transient(error):
+                self.defer(target_url, depth, "page", error)
+            else:
+                self.reporter.log("Scrape failed ({}) URL: {}", NORMAL, error, target_url)
+                self.metrics.count("scrape_failures")
+
+    def scrape_page(self, thread_num, target_url, depth):
+        """Gets a page and triages every new link on it
+        """
+        http_session = self.http_session
+        headers = self.listing_formats.headers(target_url)
+        headers.update(self.conditional_headers(target_url) or {})
+        # Listing mode needs the whole page to line links up with their sizes
+        # and dates, so only the other modes stream
+        streaming = self.triage_mode != "listing" and self._parse_executor is None
+        if streaming and hasattr(http_session, "stream"):
+            found = self.scrape_streaming(target_url, depth, headers)
+            if found is None:
+                self.reporter.log("Thread {} skipping unchanged url {}", VERBOSE, thread_num, target_url)
+            else:
+                self.reporter.log("Thread {} triaged {} new urls.", VERBOSE, thread_num, found)
+            return
+        with self.metrics.timer("get_latency_seconds"):
+            response = http_session.request(target_url, headers=headers)
+        self.metrics.count("get_requests")
+        self.metrics.count("bytes_received", len(response[1]))
+        if self.page_unchanged(target_url, response[0]):
+            self.reporter.log("Thread {} skipping unchanged url {}", VERBOSE, thread_num, target_url)
+            return
+        self.retry_policy.check_status(response[0].get("status", 0))
+        content_type = response[0].get("content-type")
+        self.listing_formats.record(target_url, content_type)
+        listing = self.triage_mode == "listing"
+        with self.metrics.timer("parse_seconds"):
+            if self._parse_executor is not None:
+                parsing = self._parse_executor.submit(parse_page, target_url, response[1],
+                                                      listing, content_type)
+                new_urls, hints = parsing.result()
+            else:
+                new_urls, hints = parse_page(target_url, response[1], listing, content_type)
+        if self.listing_formats.retry_as_html(target_url, headers, content_type, new_urls):
+            return self.scrape_page(thread_num, target_url, depth)
+        new_urls = self.new_links(new_urls, depth + 1)
+        self.reporter.log("Thread {} triaging {} new urls.", VERBOSE, thread_num, len(new_urls))
+        self.triage_batch(new_urls, depth + 1, hints)
+
+    def attempt(self, url, action, *args):
+        """Calls action, retrying it with backoff while it fails transiently
+
+        Raises HostUnavailable without calling action if the circuit breaker
+        for the url's host is open, and the last error once the tries run out.
+        """
+        host = urllib.parse.urlparse(url).hostname
+        for attempt in range(self.retry_policy.attempts):
+            if not self.circuit_breaker.allow(host):
+                raise HostUnavailable("Host {} is failing".format(host))
+            try:
+                result = action(*args)
+            except Exception as error:
+                if not self.retry_policy.is_transient(error):
+                    # The host answered, it just wasn't something we could use
+                    self.circuit_breaker.record_success(host)
+                    raise
+                self.circuit_breaker.record_failure(host)
+                if attempt + 1 >= self.retry_policy.attempts or self._thread_exit:
+                    raise
+                time.sleep(self.retry_policy.delay(attempt))
+            else:
+                self.circuit_breaker.record_success(host)
+                return result
+
+    def defer(self, url, depth, kind, error):
+        """Sets a url aside in the retry queue
+        """
+        self.reporter.log("Deferred ({}) URL: {}", VERBOSE, error, url)
+        self.metrics.count("deferred")
+        item = RetryItem(url, depth, kind, str(error))
+        self.retry_queue.append(item)
+        if self._frontier_store is not None:
+            self._fileindex_heads.put(item)
+
+    def load_retries(self):
+        """Triages and scrapes the urls an earlier crawl set aside
+        """
+        futures = []
+        for item in self._frontier_store.take_retries():
+            self.visited.add(item.url)
+            if item.kind == "page":
+                self.schedule_page(item.url, item.depth)
+            else:
+                futures.extend(self.triage_submit([item.url], item.depth))
+        concurrent.futures.wait(futures)
+
+    def page_done(self, url, depth):
+        # Triage is skipped once the crawl is stopping, so a page finished
+        # after that point may have links that were never looked at
+        validators = self._served_validators.pop(url, None)
+        if not self._thread_exit:
+            self.record_page(url, depth, FrontierStore.done)
+            if validators is not None and self._frontier_store is not None:
+                self._fileindex_heads.put(validators)
+
+    def conditional_headers(self, url):
+        """Builds the headers asking for a page only if it has changed
+        """
+        validators = self._validators.get(url)
+        if validators is None:
+            return None
+        headers = {}
+        if validators.etag:
+            headers["If-None-Match"] = validators.etag
+        if validators.last_modified:
+            headers["If-Modified-Since"] = validators.last_modified
+        return headers or None
+
+    def page_unchanged(self, url, response_head):
+        """True if the server said the page hasn't changed since the last crawl
+
+        Otherwise the validators the page was served with are kept, and saved
+        for the next crawl once every link on the page has been triaged.
+        """
+        if int(response_head.get("status", 0)) == 304:
+            return True
+        etag = response_head.get("etag")
+        last_modified = response_head.get("last-modified")
+        if etag or last_modified:
+            self._served_validators[url] = PageValidators(url, etag, last_modified)
+        return False
+
+    def load_validators(self):
+        """Loads the validators saved by earlier crawls
+
+        Pages an interrupted crawl didn't finish may have links it never
+        triaged, so they and every directory above them are requested in
+        full. Otherwise a 304 would skip over those links for good.
+        """
+        self._validators = self._frontier_store.validators()
+        for url, _, state in self._frontier_store.entries():
+            if state == FrontierStore.done:
+                continue
+            self._validators.pop(url, None)
+            path_start = url.find("/", url.find("://") + 3)
+            while path_start != -1:
+                self._validators.pop(url[:path_start + 1], None)
+                path_start = url.find("/", path_start + 1)
+
+    def scrape_streaming(self, target_url, depth, headers=None):
+        """Triages the links on a page while the page is still downloading
+
+        The body is read in chunks and fed to a LinkStreamParser, and each
+        link is handed to triage as soon as its anchor has been parsed. Only
+        one chunk and the links not yet triaged are held at a time, so memory
+        use doesn't grow with the size of the page. Returns once every link
+        has been triaged, and gives the number of new links found, or None if
+        the page hadn't changed.
+        """
+        headers = headers or {}
+        started = time.monotonic()
+        with self.http_session.stream(target_url, headers=headers) as (response_head, chunks):
+            # Streamed GETs are timed until the response headers arrive
+            self.metrics.observe("get_latency_seconds", time.monotonic() - started)
+            self.metrics.count("get_requests")
+            if self.page_unchanged(target_url, response_head):
+                return None
+            self.retry_policy.check_status(response_head.get("status", 0))
+            content_type = response_head.get("content-type")
+            self.listing_formats.record(target_url, content_type)
+            # The connection is held under the final url's host
+            held_url = response_head.get("content-location", target_url)
+            if not listing_format(content_type):
+                return self.scrape_chunks(target_url, depth, chunks, held_url)
+            found = self.scrape_structured(target_url, depth, chunks, content_type, headers, held_url)
+        if found is None:
+            # Asked for again as html, once the connection is back in the pool
+            headers = dict((k, v) for k, v in headers.items() if k != "Accept")
+            return self.scrape_streaming(target_url, depth, headers)
+        return found
+
+    def scrape_chunks(self, target_url, depth, chunks, held_url=None):
+        """Triages the links in an html page's chunks, and returns how many
+
+        held_url is the url of the streamed connection the chunks come from,
+        whose slot is lent while waiting on the triage backlog.
+        """
+        parser = LinkStreamParser(target_url)
+        pending = []
+        found = 0
+        parse_time = 0.0
+        try:
+            for chunk in chunks:
+                self.metrics.count("bytes_received", len(chunk))
+                parse_started = time.monotonic()
+                links = parser.feed(chunk)
+                parse_time += time.monotonic() - parse_started
+                new_urls = self.new_links(links, depth + 1)
+                found += len(new_urls)
+                pending.extend(self.triage_submit(new_urls, depth + 1))
+                pending = self.wait_for_backlog(pending, held_url)
+            parse_started = time.monotonic()
+            links = parser.close()
+            self.metrics.observe("parse_seconds", parse_time + time.monotonic() - parse_started)
+            new_urls = self.new_links(links, depth + 1)
+            found += len(new_urls)
+            pending.extend(self.triage_submit(new_urls, depth + 1))
+        finally:
+            # Links submitted before the stream failed are still being
+            # triaged, and have to be finished before the page is retried
+            with self.lend_slot(held_url):
+                concurrent.futures.wait(pending)
+        return found
+
+    def scrape_structured(self, target_url, depth, chunks, content_type, headers=None,
+                          held_url=None):
+        """Triages every entry of a json or xml listing, and returns how many
+
+        Returns None without triaging anything if the listing was empty and
+        the page should be asked for again as html. held_url is the url of a
+        streamed connection still held for the page, whose slot is lent while
+        the entries are triaged.
+        """
+        body = []
+        for chunk in chunks:
+            self.metrics.count("bytes_received", len(chunk))
+            body.append(chunk)
+        with self.metrics.timer("parse_seconds"):
+            new_urls, hints = parse_page(target_url, b"".join(body), content_type=content_type)
+        if self.listing_formats.retry_as_html(target_url, headers or {}, content_type, new_urls):
+            return None
+        new_urls = self.new_links(new_urls, depth + 1)
+        with self.lend_slot(held_url):
+            self.triage_batch(new_urls, depth + 1, hints)
+        return len(new_urls)
+
+    def wait_for_backlog(self, futures, held_url=None):
+        """Blocks while more than triage_backlog links are waiting on triage
+
+        held_url is the url of the streamed connection the caller holds, whose
+        slot is lent while it blocks. Returns the futures that are still
+        running.
+        """
+        futures = [i for i in futures if not i.done()]
+        if len(futures) <= self.triage_backlog:
+            return futures
+        with self.lend_slot(held_url):
+            while len(futures) > self.triage_backlog:
+                _, not_done = concurrent.futures.wait(
+                    futures, return_when=concurrent.futures.FIRST_COMPLETED)
+                futures = list(not_done)
+        return futures
+
+    def lend_slot(self, url):
+        """Lends the host slot of the connection held for url, if there is one
+
+        Only connection pools hand out slots, so other sessions get a block
+        that does nothing.
+        """
+        if url is None or not hasattr(self.http_session, "lend"):
+            return contextlib.nullcontext()
+        return self.http_session.lend(url)
+
+    def new_links(self, urls, depth):
+        """Filters found links down to the ones worth triaging at depth
+        """
+        # Links ending in a slash one level too deep would only be refused by
+        # the frontier, so don't spend a request on them
+        if self._urls_to_scrape.beyond_depth(depth):
+            urls = [i for i in urls if i[-1] != "/"]
+        return [i for i in urls if self.visited.add(i)]
+
+    def triage_one(self, url, depth=0, hint=None):
+        if self._thread_exit or self.over_budget():
+            return
+        triage_method = self._triage_method
+        if self.trusted_hint(hint):
+            triage_method = self.triage_listing
+        try:
+            self.attempt(url, triage_method, url, self.http_session, depth, hint)
+        except Exception as error:
+            if self.retry_policy.is_transient(error):
+                self.defer(url, depth, "triage", error)
+            else:
+                self.reporter.log("Index failed ({}) URL: {}", NORMAL, error, url)
+                self.metrics.count("triage_failures")
+
+    def trusted_hint(self, hint):
+        """True if a link can be triaged from what its listing said about it
+
+        Structured listings are exact, so they are always trusted. Html
+        listings are only trusted in listing mode.
+        """
+        if hint is None or not hint.is_complete():
+            return False
+        return hint.exact or self.triage_mode == "listing"
+
+    def triage_submit(self, urls, depth=0, hints=None):
+        """Starts triaging links found on a page, and returns their futures
+
+        Links that can be triaged without a request (everything in quick mode,
+        and fully described listing entries in listing mode) are done in place.
+        The rest are handed to the triage executor.
+        """
+        if hints is None:
+            hints = {}
+        remote_urls = []
+        for url in urls:
+            hint = hints.get(url)
+            if self.quick or self.trusted_hint(hint):
+                self.triage_one(url, depth, hint)
+            else:
+                remote_urls.append(url)
+        if self._triage_executor is None:
+            for url in remote_urls:
+                self.triage_one(url, depth, hints.get(url))
+            return []
+        return [self._triage_executor.submit(self.triage_one, url, depth, hints.get(url))
+                for url in remote_urls]
+
+    def triage_batch(self, urls, depth=0, hints=None):
+        """Triages all of the links found on one page
+
+        This returns once all of them have been triaged. That way the page
+        stays outstanding in the frontier until every directory it links to
+        has been put.
+        """
+        concurrent.futures.wait(self.triage_submit(urls, depth, hints))
 
     def run(self):
         """Watches the URL lists and delegates work to threads
         """
+        self._triage_executor = concurrent.futures.ThreadPoolExecutor(max_workers=self.triage_fanout)
+        if self.parse_workers > 0:
+            # Forking a process that is already running threads can deadlock
+            # the children, so the workers are started fresh
+            self._parse_executor = concurrent.futures.ProcessPoolExecutor(
+                max_workers=self.parse_workers, mp_context=multiprocessing.get_context("spawn"))
+        if self.db_conn is not None:
+            self._frontier_store = FrontierStore(self.db_conn)
+            self.load_validators()
+            if self.resume:
+                self.load_frontier()
+            else:
+                self._frontier_store.clear()
+            if self.retry:
+                self.load_retries()
+        self.reporter.start()
         # Triage any initial targets we were giving upon instantiation
         self.add_index_targets(self.url_targets)
         # Start the head saving thread
@@ -118,67 +614,100 @@ class PageCrawler(object):
         # Create all of the threads for scraping pages
         for i in range(self.scraper_threads_max):
             # Here len(self._scraper_threads) is being used to create the ID for
-            # the thread that's being created. This thread ID is used to track
-            # the position within self._thread_idle, where the thread will update
-            # its idle status.
+            # the thread that's being created.
             new_thread_id = len(self._scraper_threads)
             scraper_thread = Thread(target=self.page_scraper, args=(new_thread_id,))
             self._scraper_threads.append(scraper_thread)
-            self._thread_idle_lock.acquire()
-            self._thread_idle.append(True)
-            self._thread_idle_lock.release()
             scraper_thread.start()
 
+        finished = False
         try:
-            while sum(self._thread_idle) != self.scraper_threads_max:
-                print('idle: ' + str(self._thread_idle))
-                sleep(1)
+            # The timeout keeps the main thread responsive to Ctrl-C and the
+            # budget. The wait returns as soon as the last outstanding page is
+            # finished.
+            while not self._urls_to_scrape.wait(timeout=1):
+                if self.over_budget():
+                    break
+            finished = not self.over_budget()
         except KeyboardInterrupt:
-            print("\nWaiting for threads to exit gracefully...")
-            self._thread_exit = True
+            self.reporter.log("\nWaiting for threads to exit gracefully...", NORMAL)
 
         self._thread_exit = True
+        self._urls_to_scrape.close()
         # Join with all the scraper threads
         for i in self._scraper_threads:
             i.join()
+        self._triage_executor.shutdown(wait=True)
+        if self._parse_executor is not None:
+            self._parse_executor.shutdown(wait=True)
+            self._parse_executor = None
         # Wait for the fileindex creator thread to finish
         self._fileindex_creator_thread.join()
+        self.reporter.stop()
+        # A finished crawl has nothing to resume
+        if finished and self._frontier_store is not None:
+            self._frontier_store.clear()
+        if self.stopped_by is not None:
+            message = "Stopped after reaching the {} budget. Index with --resume to carry on."
+            self.reporter.log(message, QUIET, self.stopped_by)
+        if self.retry_queue:
+            message = "{} urls were set aside after failing. Index with --retry to try them again."
+            self.reporter.log(message, QUIET, len(self.retry_queue))
 
-    def triage_standard(self, url, http_session=None):
+    def triage_standard(self, url, http_session=None, depth=0, hint=None):
         """Handles the URLs that are dumped into self.url_triage_bucket
         """
         # Get the head information about the URL. This will be necessary
         # for deciding what to do with the resource (crawl it/database it)
-        head = HttpHead.from_url(url, http_session)
+        with self.metrics.timer("head_latency_seconds"):
+            head = HttpHead.from_url(url, http_session)
+        self.metrics.count("head_requests")
+        self.retry_policy.check_status(head.status)
         if head.status != 200:
             # TODO: Write a test that triggers this
-            print("Index failed (HTTP Error %d) URL: %s" % (head.status, url))
-        elif head.is_html() and not head.last_modified:
-            # If the content type is "text/html", and does not have a
-            # "last-modified" date, then it's a page we want to crawl.
-            self._urls_to_scrape.put(url)
+            self.reporter.log("Index failed (HTTP Error {}) URL: {}", NORMAL, head.status, url)
+        elif head.is_listing() and (head.url[-1] == "/" or not head.last_modified):
+            # Directories are pages we want to crawl, whatever validators they
+            # send. Any other "text/html" page is only crawled if it does not
+            # have a "last-modified" date.
+            self.schedule_page(url, depth)
         else:
             # The content type indicates it is some sort of file, so we
             # should add it to the index database.
             self._fileindex_heads.put(head)
 
-    def triage_quick(self, url):
+    def triage_quick(self, url, http_session=None, depth=0, hint=None):
         """Triages URLs without making HEAD requests
         """
         if url[-1] == "/":
             # We think this might be another directory index to look at
-            self._urls_to_scrape.put(url)
+            self.schedule_page(url, depth)
         else:
             # This might be just a file, don't get any information about
             # it and just add the data we have about it to the file_heads
             head = HttpHead(url, {})
             self._fileindex_heads.put(head)
 
+    def triage_listing(self, url, http_session=None, depth=0, hint=None):
+        """Triages URLs from what their directory listing said about them
+
+        Directories are scraped, and files with both a size and a date on the
+        listing are indexed without any request. Anything else falls back to
+        triage_standard.
+        """
+        if hint is None or not hint.is_complete():
+            self.triage_standard(url, http_session, depth)
+        elif hint.is_directory:
+            self.schedule_page(url, depth)
+        else:
+            self._fileindex_heads.put(HttpHead(url, hint.as_head_dict()))
+
 class SearchEngine(object):
     def __init__(self, db_conn=None, search_terms=None):
         self.db_conn = db_conn
         self._exclusivity = sqlalchemy.and_
         self.filters = []
+        self.subtrees = []
         if search_terms is not None:
             for i in search_terms:
                 self.add_filter(i)
@@ -197,6 +726,21 @@ class SearchEngine(object):
     def add_filter(self, value):
         self.filters.append(FileIndex.name.like("%%%s%%" % value))
 
+    def add_subtree(self, url):
+        """Limits the results to files under the directory at url
+
+        Every directory below it has a path starting with its own, so they're
+        found with a range scan over the host and path index.
+        """
+        if not url.endswith("/"):
+            url += "/"
+        host, path, _ = split_url(canonical_url(url))
+        directories = sqlalchemy.select([Directory.pkid]).where(Directory.host_pkid == Host.pkid)
+        # '0' sorts right after '/', so this is every path starting with path
+        directories = directories.where(Host.name == host).where(Directory.path >= path)
+        directories = directories.where(Directory.path < path[:-1] + "0")
+        self.subtrees.append(FileIndex.directory_pkid.in_(directories))
+
     def query(self, db_conn=None):
         # If the search engine wasn't provided a database, and the query wasn't
         # provided a database, then raise a ValueError. This is a programming
@@ -210,6 +754,8 @@ class SearchEngine(object):
             db_conn = self.db_conn
 
         results = db_conn.query(FileIndex).filter(self._exclusivity(*self.filters))
+        # Subtrees narrow the results whether the terms are inclusive or not
+        results = results.filter(*self.subtrees)
         return results.all()
 
 class HttpHead(object):
@@ -247,6 +793,13 @@ class HttpHead(object):
         """
         return self.content_type.startswith("text/html")
 
+    def is_listing(self):
+        """Determines if resource is a page to scrape for links
+
+        That is any html page, and directories served as a json or xml listing.
+        """
+        return self.is_html() or (self.url[-1] == "/" and listing_format(self.content_type) is not None)
+
     def as_fileindex(self):
         file_entry = FileIndex(url=self.url, domain=self.domain,
                                name=self.name, content_type=self.content_type,
@@ -261,10 +814,10 @@ class HttpHead(object):
 
         The dict is contains keys and values with data provided by the HEAD
         request response from the web server. The request is made using the
-        provided http_session
+        provided http_session, or the shared connection pool if there isn't one
         """
         if not http_session:
-            http_session = httplib2.Http(disable_ssl_certificate_validation=True)
+            http_session = shared_pool()
         # There are several types of error that can happen here, but for some reason I was only "handling"
         # socket errors. It might be best to just let error raise out of this function and be handled by
         # the function above...
@@ -283,16 +836,18 @@ class HttpHead(object):
         return cls(url, response[0])
 
 class DownloadManager(object):
-    def __init__(self, db_wrapper, download_ids, no_index=False):
+    def __init__(self, db_wrapper, download_ids, no_index=False, http_session=None):
         self.db_wrapper = db_wrapper
         self.queue = download_ids
         self.no_index = no_index
+        self.http_session = http_session
+        if not self.http_session:
+            self.http_session = shared_pool()
 
     def download_url(self, url):
         filename = url_to_filename(url)
         # Download the file
-        http_session = httplib2.Http(disable_ssl_certificate_validation=True)
-        response = http_session.request(url)
+        response = self.http_session.request(url)
         head = HttpHead(url, response[0])
         if head.status != 200:
             print("Failed to download file (HTTP Status %d): %s" % (head.status, url))
@@ -320,59 +875,151 @@ def save_head(db_conn, head, commit=True):
     """Saves FileIndex object to database
 
     Will save the given FileIndex object (head) to the database referenced by
-    session db_conn. This checks to make sure the entry does not already exist
-    to prevent duplicate entries. If an existing record exists, it will be
-    updated.
+    session db_conn. Files are keyed by their canonical url, so if the file is
+    already indexed its record is updated instead of adding a duplicate.
     """
-    filters = []
-    filters.append(FileIndex.name.like("%%%s%%" % head.name))
-    filters.append(FileIndex.url.like("%%%s%%" % head.url))
-    results = db_conn.query(FileIndex).filter(sqlalchemy.and_(*filters))
-    if results.count() < 1:
-        # This entry hasn't been seen before. Save the new entry
-        db_conn.add(head)
-    elif results.count() == 1:
-        # The entry already exists, update the records
-        old_head = results.first()
-        old_head.content_type = head.content_type
-        old_head.content_length = head.content_length
-        old_head.last_modified = head.last_modified
-        old_head.last_indexed = head.last_indexed
-        # TODO: The following line should only print when verbose = True
-        # print 'Updating pre-existing index'
-    else:
-        # There are multiple entries
-        print("There were multiple entires (this is bad). URL index not saved.")
-        print("URL: {}\nNumber of results: {}".format(head.url, results.count()))
-        print("\nResults:")
-        for i in results:
-            print(i.name, i.url)
-        return
+    upsert_fileindexes(db_conn, [head])
     if commit:
         db_conn.commit()
 
+class AnchorCollector(object):
+    """lxml parser target that collects anchor hrefs
+
+    lxml calls these methods as it parses, and since nothing is kept but the
+    href values, no element tree is ever built.
+    """
+    def __init__(self):
+        self.hrefs = []
+
+    def start(self, tag, attrib):
+        if tag == "a":
+            href = attrib.get("href")
+            if href is not None:
+                self.hrefs.append(href)
+
+    def end(self, tag):
+        pass
+
+    def data(self, data):
+        pass
+
+    def close(self):
+        return self.hrefs
+
+class LinkStreamParser(object):
+    """Incremental version of parse_urls for pages read in chunks
+
+    Each call to feed() takes the next chunk of the body and returns the full
+    urls of the links completed by it, built and filtered the same way as
+    parse_urls. Bodies are decoded as UTF-8 until that fails, and as cp1252
+    from then on.
+    """
+    def __init__(self, url):
+        self.url = url
+        self._collector = AnchorCollector()
+        self._parser = lxml.etree.HTMLParser(target=self._collector)
+        self._decoder = codecs.getincrementaldecoder("utf-8")()
+
+    def _decode(self, chunk, final=False):
+        if not isinstance(chunk, bytes):
+            return chunk
+        try:
+            return self._decoder.decode(chunk, final)
+        except UnicodeDecodeError as error:
+            # The decoder may still hold the start of a character split over
+            # the last chunk, and everything before the error is good UTF-8
+            data = self._decoder.getstate()[0] + chunk
+            self._decoder = codecs.getincrementaldecoder("cp1252")(errors="replace")
+            return data[:error.start].decode("utf-8") + self._decoder.decode(data[error.start:], final)
+
+    def _drain(self):
+        hrefs = self._collector.hrefs
+        self._collector.hrefs = []
+        return [self.url + href for href in hrefs if not bad_anchor(href)]
+
+    def feed(self, chunk):
+        text = self._decode(chunk)
+        if text:
+            self._parser.feed(text)
+        return self._drain()
+
+    def close(self):
+        """Finishes the page and returns any links that were still buffered
+        """
+        text = self._decode(b"", final=True)
+        try:
+            if text:
+                self._parser.feed(text)
+            self._parser.close()
+        except lxml.etree.LxmlError:
+            # Nothing was ever fed, or the page ended too early to make sense of
+            pass
+        return self._drain()
+
+def decode_html(html):
+    """Decodes a page body the same way BeautifulSoup would
+    """
+    if not isinstance(html, bytes):
+        return html
+    try:
+        return html.decode("utf-8")
+    except UnicodeDecodeError:
+        return UnicodeDammit(html).unicode_markup
+
+def extract_hrefs(html):
+    """Returns the href of every anchor on the page, in document order
+    """
+    parser = lxml.etree.HTMLParser(target=AnchorCollector())
+    parser.feed(decode_html(html))
+    return parser.close()
+
+def extract_hrefs_soup(html):
+    """Slower BeautifulSoup version of extract_hrefs for malformed pages
+    """
+    soup = BeautifulSoup(html, "lxml")
+    return [anchor['href'] for anchor in soup.find_all('a', href=True)]
+
 def parse_urls(url, html):
     """Gets all useful urls on a page
     """
     #print "Searching directory: %s" % url
+    # Collect the href of every 'a' dom element without building a tree. If
+    # lxml can't make sense of the page, fall back to BeautifulSoup.
+    try:
+        hrefs = extract_hrefs(html)
+    except (lxml.etree.LxmlError, ValueError):
+        hrefs = extract_hrefs_soup(html)
     url_list = []
-    # Parse the html we get from the site and then itterate over all 'a'
-    # dom elements that have an href in them.
-    soup = BeautifulSoup(html, "lxml")
-    for anchor in soup.find_all('a', href=True):
+    for href in hrefs:
         # Skip this anchor if it's one we should ignore
-        if bad_anchor(anchor['href']):
+        if bad_anchor(href):
             continue
         # build the full url and add it to the url bucket
-        new_url = url + anchor['href']
-        url_list.append(new_url)
+        url_list.append(url + href)
     return url_list
 
+def parse_page(url, html, listing=False, content_type=None):
+    """Gets the links on a page as a tuple of (urls, hints)
+
+    With listing set, hints is the dict returned by parse_listing. Otherwise
+    it is empty. Pages whose content type is json or xml are read as
+    structured listings, which always give hints. This runs in the parse
+    worker processes, so everything it returns has to be picklable.
+    """
+    structured_format = listing_format(content_type)
+    if structured_format:
+        hints = parse_structured_listing(url, html, structured_format)
+        return list(hints.keys()), hints
+    if listing:
+        hints = parse_listing(url, html)
+        return list(hints.keys()), hints
+    return parse_urls(url, html), {}
+
 def http_get(url, http_session=None):
     """Returns GET request data from the provided URL
     """
     if not http_session:
-        http_session = httplib2.Http(disable_ssl_certificate_validation=True)
+        http_session = shared_pool()
     return http_session.request(url)
 
 def bad_anchor(anchor):
@@ -386,7 +1033,7 @@ def bad_anchor(anchor):
     """
     static_anchors = ["../", "/", "?C=N;O=D", "?C=M;O=A", "?C=S;O=A",\
         "?C=D;O=A"]
-    if anchor in static_anchors:
+    if not anchor or anchor in static_anchors:
         return True
     if anchor[0] == "#":
         return True
@@ -0,0 +1,232 @@
+import time
+import queue
+import urllib.parse
+from collections import OrderedDict
+import sqlalchemy
+from opendir_dl.metrics import CrawlMetrics
+from opendir_dl.progress import NORMAL
+from opendir_dl.frontier import FrontierStore
+from opendir_dl.frontier import FrontierUpdate
+from opendir_dl.frontier import PageValidators
+from opendir_dl.frontier import RetryItem
+
+DEFAULT_PORTS = {"http": 80, "https": 443}
+
+# Files are keyed by their directory, name and leaf, so saving one that is
+# already indexed updates its row in place. The datetime parameters are typed
+# so they're stored the same way the ORM stores them.
+UPSERT_FILEINDEX = sqlalchemy.text("""
+    INSERT INTO fileindex (directory_pkid, name, leaf, content_type_pkid, last_indexed, last_modified, content_length)
+    VALUES (:directory_pkid, :name, :leaf, :content_type_pkid, :last_indexed, :last_modified, :content_length)
+    ON CONFLICT (directory_pkid, name, coalesce(leaf, '/')) DO UPDATE SET
+        content_type_pkid = excluded.content_type_pkid,
+        content_length = excluded.content_length,
+        last_modified = excluded.last_modified,
+        last_indexed = excluded.last_indexed
+""").bindparams(sqlalchemy.bindparam("last_indexed", type_=sqlalchemy.DateTime),
+                 sqlalchemy.bindparam("last_modified", type_=sqlalchemy.DateTime))
+
+INSERT_HOST = sqlalchemy.text("INSERT INTO hosts (name, domain) VALUES (:name, :domain) ON CONFLICT (name) DO NOTHING")
+SELECT_HOST = sqlalchemy.text("SELECT pkid FROM hosts WHERE name = :name")
+INSERT_DIRECTORY = sqlalchemy.text("""
+    INSERT INTO directories (host_pkid, parent_pkid, path) VALUES (:host_pkid, :parent_pkid, :path)
+    ON CONFLICT (host_pkid, path) DO NOTHING""")
+SELECT_DIRECTORY = sqlalchemy.text("SELECT pkid FROM directories WHERE host_pkid = :host_pkid AND path = :path")
+INSERT_CONTENT_TYPE = sqlalchemy.text("INSERT INTO content_types (name) VALUES (:name) ON CONFLICT (name) DO NOTHING")
+SELECT_CONTENT_TYPE = sqlalchemy.text("SELECT pkid FROM content_types WHERE name = :name")
+
+def canonical_url(url):
+    """Returns the form of a url that files are keyed by in the index
+
+    The scheme and host are lowercased, default ports and fragments are
+    dropped, and an empty path becomes '/'. Urls that can't be parsed are
+    returned as they are.
+    """
+    parsed = urllib.parse.urlsplit(url)
+    try:
+        port = parsed.port
+    except ValueError:
+        return url
+    scheme = parsed.scheme.lower()
+    host = parsed.hostname or ""
+    if ":" in host:
+        host = "[{}]".format(host)
+    if port is not None and port != DEFAULT_PORTS.get(scheme):
+        host = "{}:{}".format(host, port)
+    userinfo = parsed.netloc.rpartition("@")[0]
+    if userinfo:
+        host = "{}@{}".format(userinfo, host)
+    return urllib.parse.urlunsplit((scheme, host, parsed.path or "/", parsed.query, ""))
+
+def split_url(url):
+    """Splits a url into the host, directory path and leaf it's stored under
+
+    The host is the scheme and network location, the directory path runs up to
+    and including the last '/' of the path, and the leaf is the rest of the
+    path along with any query.
+    """
+    parsed = urllib.parse.urlsplit(url)
+    host = ""
+    if parsed.scheme or parsed.netloc:
+        host = "{}://{}".format(parsed.scheme, parsed.netloc)
+    directory, _, leaf = (parsed.path or "/").rpartition("/")
+    if parsed.query:
+        leaf = "{}?{}".format(leaf, parsed.query)
+    return host, directory + "/", leaf
+
+class IndexKeys(object):
+    """Finds or creates the host, directory and content type rows of files
+
+    db_conn is a session or connection, and rows are created in its current
+    transaction. Keys are kept once found, so only new hosts, directories and
+    content types cost a query.
+    """
+    def __init__(self, db_conn):
+        self.db_conn = db_conn
+        self.clear()
+
+    def clear(self):
+        """Forgets every key, for when the rows they came from were rolled back
+        """
+        self.hosts = {}
+        self.directories = {}
+        self.content_types = {}
+
+    def host(self, name, domain):
+        if name not in self.hosts:
+            self.db_conn.execute(INSERT_HOST, {"name": name, "domain": domain})
+            self.hosts[name] = self.db_conn.execute(SELECT_HOST, {"name": name}).scalar()
+        return self.hosts[name]
+
+    def directory(self, host_pkid, path):
+        """Returns the key of a directory, creating it and those above it
+        """
+        key = (host_pkid, path)
+        if key not in self.directories:
+            parent_pkid = None
+            parent_path = path[:path[:-1].rfind("/") + 1]
+            if len(path) > 1 and parent_path:
+                parent_pkid = self.directory(host_pkid, parent_path)
+            values = {"host_pkid": host_pkid, "parent_pkid": parent_pkid, "path": path}
+            self.db_conn.execute(INSERT_DIRECTORY, values)
+            self.directories[key] = self.db_conn.execute(SELECT_DIRECTORY, values).scalar()
+        return self.directories[key]
+
+    def content_type(self, name):
+        if name is None:
+            return None
+        if name not in self.content_types:
+            self.db_conn.execute(INSERT_CONTENT_TYPE, {"name": name})
+            self.content_types[name] = self.db_conn.execute(SELECT_CONTENT_TYPE, {"name": name}).scalar()
+        return self.content_types[name]
+
+    def file_row(self, url, name, domain, content_type):
+        """Returns the columns that key a file at url, split into its rows
+        """
+        host, directory, leaf = split_url(url)
+        return {"directory_pkid": self.directory(self.host(host, domain), directory),
+                "name": name,
+                # The leaf is only kept when the name can't stand in for it
+                "leaf": None if leaf == name else leaf,
+                "content_type_pkid": self.content_type(content_type)}
+
+def upsert_fileindexes(db_conn, fileindexes, keys=None):
+    """Inserts FileIndex objects, updating the rows of any already indexed
+
+    Their urls are made canonical first. keys is the IndexKeys to look up
+    their hosts, directories and content types with. Nothing is committed.
+    """
+    keys = keys or IndexKeys(db_conn)
+    rows = []
+    for fileindex in fileindexes:
+        fileindex.url = canonical_url(fileindex.url)
+        row = keys.file_row(fileindex.url, fileindex.name, fileindex.domain, fileindex.content_type)
+        row.update({"last_indexed": fileindex.last_indexed,
+                    "last_modified": fileindex.last_modified,
+                    "content_length": fileindex.content_length})
+        rows.append(row)
+    if rows:
+        db_conn.execute(UPSERT_FILEINDEX, rows)
+
+class IndexWriter(object):
+    """Saves what a crawl finds to the index database, a batch at a time
+
+    Crawl threads put heads, FrontierUpdates, PageValidators and RetryItems on
+    a queue, and one thread drains it with this. Items are taken in batches of
+    up to batch_size, or whatever arrived within batch_seconds of the first,
+    and each batch is saved in a single transaction. Files that aren't indexed
+    yet are inserted, and the rows of the rest, matched by their directory,
+    name and leaf, are updated, so indexing isn't held to a commit for every
+    file. A batch that fails to save is rolled back and reported through
+    reporter, and the writer carries on with the next one. The session must
+    not be used by any other thread while the writer is draining.
+    """
+    def __init__(self, db_conn, metrics=None, batch_size=500, batch_seconds=0.5, reporter=None):
+        self.db_conn = db_conn
+        self.metrics = metrics or CrawlMetrics()
+        self.reporter = reporter
+        self.batch_size = batch_size
+        self.batch_seconds = batch_seconds
+        self.frontier_store = FrontierStore(db_conn)
+        self.keys = IndexKeys(db_conn)
+
+    def take_batch(self, items, stopping):
+        """Takes the next batch off the items queue
+
+        Returns an empty list if nothing arrived. The wait for a full batch is
+        cut short once stopping() is True, so the crawl isn't kept waiting.
+        """
+        try:
+            batch = [items.get(timeout=.1)]
+        except queue.Empty:
+            return []
+        deadline = time.monotonic() + self.batch_seconds
+        while len(batch) < self.batch_size:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(items.get(timeout=min(remaining, .1)))
+            except queue.Empty:
+                if stopping():
+                    break
+        return batch
+
+    def drain(self, items, stopping):
+        """Saves batches from the items queue until stopping() and it is empty
+        """
+        while not stopping() or not items.empty():
+            batch = self.take_batch(items, stopping)
+            if not batch:
+                continue
+            try:
+                self.write(batch)
+            except Exception as error:
+                self.db_conn.rollback()
+                # Keys found in the failed transaction may not exist anymore
+                self.keys.clear()
+                self.metrics.count("db_write_failures")
+                if self.reporter is not None:
+                    self.reporter.log("Failed to save {} items ({})", NORMAL, len(batch), error)
+
+    def write(self, batch):
+        """Saves every item in the batch in one transaction
+        """
+        if self.db_conn is None:
+            return
+        heads = OrderedDict()
+        with self.metrics.timer("db_write_seconds"):
+            for item in batch:
+                if isinstance(item, FrontierUpdate):
+                    self.frontier_store.record(*item, commit=False)
+                elif isinstance(item, PageValidators):
+                    self.frontier_store.record_validators(*item, commit=False)
+                elif isinstance(item, RetryItem):
+                    self.frontier_store.record_retry(*item, commit=False)
+                else:
+                    # A file found twice in one batch is saved as last seen
+                    heads[canonical_url(item.url)] = item.as_fileindex()
+            upsert_fileindexes(self.db_conn, list(heads.values()), self.keys)
+            self.db_conn.commit()
+        self.metrics.count("db_batches")
+        self.metrics.count("files_indexed", len(heads))
@@ -1,15 +1,18 @@
+import io
 import os
 import sys
+import json
+import time
 import threading
 import socketserver
-from http.server import HTTPServer
+from http.server import SimpleHTTPRequestHandler
 import httplib2
 import unittest
 import shutil
 sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'opendir_dl'))
 import opendir_dl
 
-class QuietHTTPServer(HTTPServer):
+class QuietHTTPServer(SimpleHTTPRequestHandler):
     """Produces no logging output
 
     I defined this just to keep the test output pretty
@@ -17,10 +20,115 @@ class QuietHTTPServer(HTTPServer):
     def log_message(self, *args):
         pass
 
+class KeepAliveHTTPServer(QuietHTTPServer):
+    """Keeps connections open between requests
+    """
+    protocol_version = "HTTP/1.1"
+
+class SlowHTTPServer(QuietHTTPServer):
+    """Takes delay seconds to answer every request
+    """
+    delay = 0.5
+
+    def send_head(self):
+        time.sleep(self.delay)
+        return super(SlowHTTPServer, self).send_head()
+
+class ETagHTTPServer(QuietHTTPServer):
+    """Serves directory listings with an ETag, and honours If-None-Match
+
+    The method and path of every request is kept in requests.
+    """
+    etag = '"listing"'
+    requests = []
+
+    def send_head(self):
+        self.requests.append((self.command, self.path))
+        if self.path.endswith("/") and self.headers.get("If-None-Match") == self.etag:
+            self.send_response(304)
+            self.end_headers()
+            return None
+        return super(ETagHTTPServer, self).send_head()
+
+    def end_headers(self):
+        if self.path.endswith("/"):
+            self.send_header("ETag", self.etag)
+        super(ETagHTTPServer, self).end_headers()
+
+class LastModifiedHTTPServer(QuietHTTPServer):
+    """Serves directory listings with a Last-Modified date, and honours
+    If-Modified-Since
+
+    The method and path of every request is kept in requests.
+    """
+    last_modified = "Mon, 05 Oct 2026 10:00:00 GMT"
+    requests = []
+
+    def send_head(self):
+        self.requests.append((self.command, self.path))
+        if self.path.endswith("/") and self.headers.get("If-Modified-Since") == self.last_modified:
+            self.send_response(304)
+            self.end_headers()
+            return None
+        return super(LastModifiedHTTPServer, self).send_head()
+
+    def end_headers(self):
+        if self.path.endswith("/"):
+            self.send_header("Last-Modified", self.last_modified)
+        super(LastModifiedHTTPServer, self).end_headers()
+
+class FlakyHTTPServer(QuietHTTPServer):
+    """Answers 503 for every path in failing
+    """
+    failing = set()
+
+    def send_head(self):
+        if self.path in self.failing:
+            self.send_error(503)
+            return None
+        return super(FlakyHTTPServer, self).send_head()
+
+class JSONListingHTTPServer(QuietHTTPServer):
+    """Answers like nginx with autoindex_format json for every directory
+    """
+    def list_directory(self, path):
+        items = []
+        for name in sorted(os.listdir(path)):
+            full_path = os.path.join(path, name)
+            if os.path.isdir(full_path):
+                items.append({"name": name, "type": "directory", "mtime": self.date_time_string(0)})
+            else:
+                items.append({"name": name, "type": "file", "mtime": self.date_time_string(0),
+                              "size": os.path.getsize(full_path)})
+        encoded = json.dumps(items).encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(encoded)))
+        self.end_headers()
+        return io.BytesIO(encoded)
+
+class EmptyJSONListingHTTPServer(QuietHTTPServer):
+    """Answers every directory asked for as json with an empty json listing
+    """
+    def list_directory(self, path):
+        if "json" not in self.headers.get("Accept", ""):
+            return super(EmptyJSONListingHTTPServer, self).list_directory(path)
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", "2")
+        self.end_headers()
+        return io.BytesIO(b"[]")
+
+class ThreadingTCPServer(socketserver.ThreadingMixIn, socketserver.TCPServer):
+    # Kept-alive connections each hold a handler thread, so don't wait on them
+    # when the server is stopped
+    daemon_threads = True
+    block_on_close = False
+
 class ThreadedHTTPServer(object):
-    def __init__(self, host, port):
+    def __init__(self, host, port, handler=QuietHTTPServer):
         socketserver.TCPServer.allow_reuse_address = True
-        self.server = socketserver.TCPServer((host, port), QuietHTTPServer)
+        self.server = ThreadingTCPServer((host, port), handler)
         self.server_thread = threading.Thread(target=self.server.serve_forever)
         self.server_thread.daemon = True
         self.url = "http://{}:{}/".format(host, port)
@@ -0,0 +1,155 @@
+import os
+import sys
+import asyncio
+import tempfile
+import unittest
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'opendir_dl'))
+import opendir_dl
+import opendir_dl.aiocrawler
+from . import ThreadedHTTPServer
+from . import KeepAliveHTTPServer
+from . import SlowHTTPServer
+from . import JSONListingHTTPServer
+from . import EmptyJSONListingHTTPServer
+from . import TestWithConfig
+
+class AsyncHttpClientTest(unittest.TestCase):
+    def request(self, url, method):
+        client = opendir_dl.aiocrawler.AsyncHttpClient()
+        return asyncio.run(client.request(url, method))
+
+    def test_get(self):
+        with ThreadedHTTPServer("localhost", 8000) as server:
+            url = "{}test_resources/example_file.txt".format(server.url)
+            response = self.request(url, "GET")
+        self.assertEqual(response[0]["status"], '200')
+        with open("test_resources/example_file.txt", 'rb') as rfile:
+            self.assertEqual(response[1], rfile.read())
+
+    def test_head(self):
+        with ThreadedHTTPServer("localhost", 8000) as server:
+            url = "{}test_resources/example_file.txt".format(server.url)
+            response = self.request(url, "HEAD")
+        head = opendir_dl.utils.HttpHead(url, response[0])
+        self.assertEqual(head.status, 200)
+        self.assertEqual(head.content_length, 13)
+        self.assertEqual(response[1], b"")
+
+    def test_redirect(self):
+        # Directories without a trailing slash are redirected by the server
+        with ThreadedHTTPServer("localhost", 8000) as server:
+            url = "{}test_resources".format(server.url)
+            response = self.request(url, "GET")
+        self.assertEqual(response[0]["status"], '200')
+        self.assertEqual(response[0]["content-location"], url + "/")
+
+    def test_keep_alive_reuse(self):
+        async def request_twice(url):
+            client = opendir_dl.aiocrawler.AsyncHttpClient()
+            await client.request(url, "HEAD")
+            response = await client.request(url, "GET")
+            idle_count = len(client._idle[("http", "localhost", 8000)])
+            client.close()
+            return response, idle_count
+        with ThreadedHTTPServer("localhost", 8000, KeepAliveHTTPServer) as server:
+            url = "{}test_resources/example_file.txt".format(server.url)
+            response, idle_count = asyncio.run(request_twice(url))
+        self.assertEqual(response[1], b"test content\n")
+        self.assertEqual(idle_count, 1)
+
+    def test_queued_requests_not_timed(self):
+        # A new host gets two requests at a time, so most of these wait far
+        # longer than the timeout for a turn, but none of them are slow
+        async def request_many(url):
+            client = opendir_dl.aiocrawler.AsyncHttpClient(timeout=1.5)
+            responses = await asyncio.gather(*[client.request(url, "HEAD") for i in range(12)])
+            client.close()
+            return responses
+        with ThreadedHTTPServer("localhost", 8000, SlowHTTPServer) as server:
+            url = "{}test_resources/example_file.txt".format(server.url)
+            responses = asyncio.run(request_many(url))
+        self.assertEqual([i[0]["status"] for i in responses], ["200"] * 12)
+
+class AsyncPageCrawlerTest(TestWithConfig):
+    def crawl(self, quick):
+        db = opendir_dl.databasing.DatabaseWrapper.from_fs(self.database_path)
+        with ThreadedHTTPServer("localhost", 8000) as server:
+            url = "{}test_resources/".format(server.url)
+            crawler = opendir_dl.aiocrawler.AsyncPageCrawler(db.db_conn, [url])
+            crawler.quick = quick
+            crawler.run()
+        return db.query(opendir_dl.models.FileIndex).filter_by(name="example_file.txt").one()
+
+    def test_standard_crawl(self):
+        entry = self.crawl(False)
+        self.assertEqual(entry.url, "http://localhost:8000/test_resources/example_file.txt")
+        self.assertEqual(entry.content_length, 13)
+        self.assertTrue(entry.content_type.startswith("text/plain"))
+
+    def test_quick_crawl(self):
+        entry = self.crawl(True)
+        self.assertEqual(entry.content_length, 0)
+
+    def test_same_urls_as_threaded(self):
+        crawlers = [lambda db_conn, url: opendir_dl.aiocrawler.AsyncPageCrawler(db_conn, [url]),
+                    lambda db_conn, url: opendir_dl.utils.PageCrawler(db_conn, [url])]
+        indexed = []
+        for new_crawler in crawlers:
+            with tempfile.NamedTemporaryFile(suffix=".db") as db_file:
+                db = opendir_dl.databasing.DatabaseWrapper(db_file.name)
+                db.connect()
+                with ThreadedHTTPServer("localhost", 8000) as server:
+                    new_crawler(db.db_conn, "{}test_resources/".format(server.url)).run()
+                indexed.append(set(i.url for i in db.query(opendir_dl.models.FileIndex)))
+        self.assertIn("http://localhost:8000/test_resources/example_file.txt", indexed[0])
+        self.assertEqual(indexed[0], indexed[1])
+
+    def test_structured_listing(self):
+        # Every file with a complete listing entry is saved without a HEAD, so
+        # the only one is for the page the crawl starts at
+        for triage_mode in ["standard", "listing"]:
+            with tempfile.NamedTemporaryFile(suffix=".db") as db_file:
+                db = opendir_dl.databasing.DatabaseWrapper(db_file.name)
+                db.connect()
+                with ThreadedHTTPServer("localhost", 8000, JSONListingHTTPServer) as server:
+                    url = "{}test_resources/".format(server.url)
+                    crawler = opendir_dl.aiocrawler.AsyncPageCrawler(db.db_conn, [url])
+                    crawler.triage_mode = triage_mode
+                    crawler.run()
+                names = sorted(i.name for i in db.query(opendir_dl.models.FileIndex))
+                self.assertEqual(names, sorted(os.listdir("test_resources")))
+                self.assertEqual(crawler.metrics.counter("head_requests"), 1)
+
+    def test_empty_structured_listing(self):
+        with tempfile.NamedTemporaryFile(suffix=".db") as db_file:
+            db = opendir_dl.databasing.DatabaseWrapper(db_file.name)
+            db.connect()
+            with ThreadedHTTPServer("localhost", 8000, EmptyJSONListingHTTPServer) as server:
+                url = "{}test_resources/".format(server.url)
+                crawler = opendir_dl.aiocrawler.AsyncPageCrawler(db.db_conn, [url])
+                crawler.run()
+            names = sorted(i.name for i in db.query(opendir_dl.models.FileIndex))
+        # The empty json listing was asked for again as html
+        self.assertEqual(names, sorted(os.listdir("test_resources")))
+        self.assertEqual(crawler.listing_formats.get(url), "html")
+
+    def test_concurrency_limit(self):
+        crawler = opendir_dl.aiocrawler.AsyncPageCrawler(None)
+        self.assertEqual(crawler.concurrency, 100)
+        self.assertEqual(crawler.url_targets, [])
+
+    def test_limit_visited(self):
+        crawler = opendir_dl.aiocrawler.AsyncPageCrawler(None)
+        crawler.limit_visited(4096, 0.01)
+        sets = [crawler.visited, crawler._scraped]
+        self.assertEqual(sum(i.max_bytes for i in sets), 4096)
+        self.assertEqual([i.error_rate for i in sets], [0.01, 0.01])
+
+    def test_budget(self):
+        db = opendir_dl.databasing.DatabaseWrapper.from_fs(self.database_path)
+        with ThreadedHTTPServer("localhost", 8000) as server:
+            crawler = opendir_dl.aiocrawler.AsyncPageCrawler(db.db_conn, [server.url])
+            crawler.budget.requests = 2
+            crawler.run()
+        self.assertEqual(crawler.stopped_by, "requests")
+        self.assertEqual(crawler.metrics.counter("pages_scraped"), 1)
@@ -0,0 +1,159 @@
+import os
+import sys
+import unittest
+from datetime import datetime
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'opendir_dl'))
+import opendir_dl
+import opendir_dl.autoindex
+
+APACHE_TABLE = """<html><body><h1>Index of /files</h1><table>
+<tr><th><a href="?C=N;O=D">Name</a></th><th><a href="?C=M;O=A">Last modified</a></th><th><a href="?C=S;O=A">Size</a></th></tr>
+<tr><td valign="top"><img src="/icons/back.gif" alt="[PARENTDIR]"></td><td><a href="/">Parent Directory</a></td><td>&nbsp;</td><td align="right">  - </td></tr>
+<tr><td valign="top"><img src="/icons/folder.gif" alt="[DIR]"></td><td><a href="docs/">docs/</a></td><td align="right">2016-10-16 21:14  </td><td align="right">  - </td></tr>
+<tr><td valign="top"><img src="/icons/text.gif" alt="[TXT]"></td><td><a href="notes.txt">notes.txt</a></td><td align="right">2016-10-16 21:14  </td><td align="right">1.5K</td></tr>
+</table></body></html>"""
+
+APACHE_PRE = """<html><body><h1>Index of /files</h1><pre><img src="/icons/blank.gif" alt="Icon "> <a href="?C=N;O=D">Name</a>                    <a href="?C=M;O=A">Last modified</a>      <a href="?C=S;O=A">Size</a>
+<hr><img src="/icons/back.gif" alt="[PARENTDIR]"> <a href="/">Parent Directory</a>                             -
+<img src="/icons/text.gif" alt="[TXT]"> <a href="notes.txt">notes.txt</a>               16-Oct-2016 21:14  2.0M
+<hr></pre></body></html>"""
+
+NGINX = """<html><head><title>Index of /files/</title></head><body><h1>Index of /files/</h1><hr><pre><a href="../">../</a>
+<a href="docs/">docs/</a>                                              16-Oct-2016 21:14                   -
+<a href="notes.txt">notes.txt</a>                                          16-Oct-2016 21:14:09              1536
+<a href="unknown.bin">unknown.bin</a>
+</pre><hr></body></html>"""
+
+LIGHTTPD = """<html><body><h2>Index of /files/</h2><div class="list"><table summary="Directory Listing">
+<thead><tr><th class="n">Name</th><th class="m">Last Modified</th><th class="s">Size</th><th class="t">Type</th></tr></thead>
+<tbody><tr class="d"><td class="n"><a href="../">..</a>/</td><td class="m">&nbsp;</td><td class="s">- &nbsp;</td><td class="t">Directory</td></tr>
+<tr><td class="n"><a href="notes.txt">notes.txt</a></td><td class="m">2016-Oct-16 21:14:09</td><td class="s">1.5K</td><td class="t">text/plain</td></tr>
+</tbody></table></div></body></html>"""
+
+NGINX_JSON = """[
+{ "name":"docs", "type":"directory", "mtime":"Sun, 16 Oct 2016 21:14:09 GMT" },
+{ "name":"notes file.txt", "type":"file", "mtime":"Sun, 16 Oct 2016 21:14:09 GMT", "size":1536 }
+]"""
+
+NGINX_XML = """<?xml version="1.0"?>
+<list>
+<directory mtime="2016-10-16T21:14:09Z">docs</directory>
+<file mtime="2016-10-16T21:14:09Z" size="1536">notes file.txt</file>
+</list>"""
+
+CADDY_JSON = """[{"name":"docs","size":4096,"url":"./docs/","mod_time":"2016-10-16T23:14:09.123456789+02:00","mode":2147484141,"is_dir":true,"is_symlink":false},
+{"name":"notes file.txt","size":1536,"url":"./notes%20file.txt","mod_time":"2016-10-16T23:14:09.123456789+02:00","mode":420,"is_dir":false,"is_symlink":false}]"""
+
+class ParseListingTest(unittest.TestCase):
+    url = "http://localhost/files/"
+
+    def test_apache_table(self):
+        entries = opendir_dl.autoindex.parse_listing(self.url, APACHE_TABLE)
+        self.assertEqual(list(entries.keys()), [self.url + "docs/", self.url + "notes.txt"])
+        notes = entries[self.url + "notes.txt"]
+        self.assertEqual(notes.size, 1536)
+        self.assertEqual(notes.last_modified, datetime(2016, 10, 16, 21, 14))
+        self.assertTrue(entries[self.url + "docs/"].is_directory)
+
+    def test_apache_pre(self):
+        entries = opendir_dl.autoindex.parse_listing(self.url, APACHE_PRE)
+        self.assertEqual(list(entries.keys()), [self.url + "notes.txt"])
+        self.assertEqual(entries[self.url + "notes.txt"].size, 2 * 1024 * 1024)
+
+    def test_nginx(self):
+        entries = opendir_dl.autoindex.parse_listing(self.url, NGINX)
+        notes = entries[self.url + "notes.txt"]
+        self.assertEqual(notes.size, 1536)
+        self.assertEqual(notes.last_modified, datetime(2016, 10, 16, 21, 14, 9))
+        self.assertTrue(notes.is_complete())
+        self.assertTrue(entries[self.url + "docs/"].is_complete())
+        self.assertFalse(entries[self.url + "unknown.bin"].is_complete())
+
+    def test_lighttpd(self):
+        entries = opendir_dl.autoindex.parse_listing(self.url, LIGHTTPD)
+        notes = entries[self.url + "notes.txt"]
+        self.assertEqual(notes.last_modified, datetime(2016, 10, 16, 21, 14, 9))
+        self.assertEqual(notes.content_type, "text/plain")
+
+    def test_matches_parse_urls(self):
+        for html in [APACHE_TABLE, APACHE_PRE, NGINX, LIGHTTPD]:
+            entries = opendir_dl.autoindex.parse_listing(self.url, html)
+            self.assertEqual(list(entries.keys()), opendir_dl.utils.parse_urls(self.url, html))
+
+    def test_empty(self):
+        self.assertEqual(len(opendir_dl.autoindex.parse_listing(self.url, "")), 0)
+
+class ListingEntryTest(unittest.TestCase):
+    def test_as_head(self):
+        entry = opendir_dl.autoindex.ListingEntry("http://localhost/notes.txt", 1536,
+                                                  datetime(2016, 10, 16, 21, 14, 9))
+        head = opendir_dl.utils.HttpHead(entry.url, entry.as_head_dict())
+        self.assertEqual(head.status, 200)
+        self.assertEqual(head.content_length, 1536)
+        self.assertEqual(head.content_type, "text/plain")
+        self.assertEqual(head.last_modified, datetime(2016, 10, 16, 21, 14, 9))
+
+    def test_parse_size(self):
+        self.assertEqual(opendir_dl.autoindex.parse_size("13"), 13)
+        self.assertEqual(opendir_dl.autoindex.parse_size(" 1.5K "), 1536)
+        self.assertEqual(opendir_dl.autoindex.parse_size("4 MiB"), 4 * 1024 * 1024)
+        self.assertEqual(opendir_dl.autoindex.parse_size("  - "), None)
+
+class StructuredListingTest(unittest.TestCase):
+    url = "http://localhost/files/"
+
+    def check_entries(self, entries):
+        self.assertEqual(list(entries.keys()), [self.url + "docs/", self.url + "notes%20file.txt"])
+        self.assertTrue(entries[self.url + "docs/"].is_directory)
+        notes = entries[self.url + "notes%20file.txt"]
+        self.assertEqual(notes.size, 1536)
+        self.assertEqual(notes.last_modified.replace(microsecond=0), datetime(2016, 10, 16, 21, 14, 9))
+        self.assertTrue(notes.exact)
+        self.assertTrue(notes.is_complete())
+
+    def test_nginx_json(self):
+        self.check_entries(opendir_dl.autoindex.parse_json_listing(self.url, NGINX_JSON))
+
+    def test_nginx_xml(self):
+        self.check_entries(opendir_dl.autoindex.parse_xml_listing(self.url, NGINX_XML))
+
+    def test_caddy_json(self):
+        self.check_entries(opendir_dl.autoindex.parse_json_listing(self.url, CADDY_JSON))
+
+    def test_not_a_listing(self):
+        self.assertEqual(len(opendir_dl.autoindex.parse_json_listing(self.url, '{"error": 1}')), 0)
+        self.assertEqual(len(opendir_dl.autoindex.parse_json_listing(self.url, "<html>")), 0)
+        self.assertEqual(len(opendir_dl.autoindex.parse_xml_listing(self.url, "<html>")), 0)
+
+    def test_listing_format(self):
+        self.assertEqual(opendir_dl.autoindex.listing_format("application/json; charset=utf-8"), "json")
+        self.assertEqual(opendir_dl.autoindex.listing_format("text/xml"), "xml")
+        self.assertEqual(opendir_dl.autoindex.listing_format("text/html"), None)
+        self.assertEqual(opendir_dl.autoindex.listing_format(None), None)
+
+    def test_parse_page(self):
+        urls, hints = opendir_dl.utils.parse_page(self.url, NGINX_JSON, content_type="application/json")
+        self.assertEqual(urls, [self.url + "docs/", self.url + "notes%20file.txt"])
+        self.assertEqual(hints[self.url + "notes%20file.txt"].size, 1536)
+
+class ListingFormatsTest(unittest.TestCase):
+    def test_probe_once(self):
+        formats = opendir_dl.autoindex.ListingFormats()
+        self.assertTrue("Accept" in formats.headers("http://localhost/a/"))
+        formats.record("http://localhost/a/", "text/html")
+        self.assertEqual(formats.headers("http://localhost/b/"), {})
+        formats.record("http://other/a/", "application/json")
+        self.assertEqual(formats.get("http://other/b/"), "json")
+        self.assertTrue("Accept" in formats.headers("http://other/b/"))
+
+    def test_retry_as_html(self):
+        formats = opendir_dl.autoindex.ListingFormats()
+        url = "http://localhost/a/"
+        headers = formats.headers(url)
+        formats.record(url, "application/json")
+        self.assertFalse(formats.retry_as_html(url, headers, "application/json", [url + "b"]))
+        self.assertFalse(formats.retry_as_html(url, headers, "text/html", []))
+        self.assertTrue(formats.retry_as_html(url, headers, "application/json", []))
+        self.assertEqual(formats.headers(url), {})
+        # Pages asked for as html aren't asked for again
+        self.assertFalse(formats.retry_as_html(url, {}, "application/json", []))
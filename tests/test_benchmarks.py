@@ -0,0 +1,73 @@
+import os
+import sys
+import unittest
+import httplib2
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+import opendir_dl
+import opendir_dl.autoindex
+import benchmarks.crawl
+import benchmarks.synthetic
+
+class SyntheticTreeTest(unittest.TestCase):
+    def test_counts(self):
+        tree = benchmarks.synthetic.SyntheticTree(width=2, depth=2, files=3)
+        self.assertEqual(tree.directory_count(), 7)
+        self.assertEqual(tree.file_count(), 21)
+
+    def test_bad_style(self):
+        with self.assertRaises(ValueError):
+            benchmarks.synthetic.SyntheticTree(style="iis")
+
+    def test_parse_path(self):
+        tree = benchmarks.synthetic.SyntheticTree(width=2, depth=1, files=3, name_length=8)
+        directory = tree.name("d", 1)
+        self.assertEqual(tree.parse_path("/"), "directory")
+        self.assertEqual(tree.parse_path("/{}/".format(directory)), "directory")
+        self.assertEqual(tree.parse_path("/{}/{}".format(directory, tree.name("f", 2, ".bin"))), "file")
+        self.assertEqual(tree.parse_path("/{}/".format(tree.name("d", 2))), None)
+        self.assertEqual(tree.parse_path("/{}/{}/".format(directory, directory)), None)
+        self.assertEqual(tree.parse_path("/d1/"), None)
+
+    def test_listings_parse(self):
+        for style in benchmarks.synthetic.SyntheticTree.styles:
+            tree = benchmarks.synthetic.SyntheticTree(width=2, depth=1, files=3, style=style)
+            entries = opendir_dl.autoindex.parse_listing("http://localhost/", tree.listing("/"))
+            self.assertEqual(len(entries), 5)
+            files = [v for k, v in entries.items() if not k.endswith("/")]
+            self.assertEqual([i.size for i in files], [1024] * 3)
+            # The bottom level has no subdirectories
+            entries = opendir_dl.autoindex.parse_listing("http://localhost/d/", tree.listing("/d/"))
+            self.assertEqual(len(entries), 3)
+
+    def test_server(self):
+        tree = benchmarks.synthetic.SyntheticTree(width=1, depth=1, files=1, file_size=10)
+        with benchmarks.synthetic.SyntheticServer(tree) as server:
+            http = httplib2.Http()
+            head, _ = http.request(server.url + tree.name("f", 0, ".bin"), "HEAD")
+            self.assertEqual(head["content-length"], "10")
+            self.assertIn("last-modified", head)
+            head, content = http.request(server.url)
+            self.assertEqual(head["content-type"], "text/html;charset=UTF-8")
+            self.assertIn(tree.name("d", 0).encode("utf-8"), content)
+            head, _ = http.request(server.url + "missing")
+            self.assertEqual(head.status, 404)
+
+class CompareTest(unittest.TestCase):
+    def test_regressions(self):
+        baseline = {"apache-quick": {"files_per_second": 100.0, "peak_rss_mb": 50.0},
+                    "nginx-quick": {"files_per_second": 100.0, "peak_rss_mb": 50.0}}
+        results = {"apache-quick": {"files_per_second": 95.0, "peak_rss_mb": 60.0},
+                   "nginx-quick": {"files_per_second": 80.0, "peak_rss_mb": 50.0},
+                   "apache-standard": {"files_per_second": 1.0, "peak_rss_mb": 500.0}}
+        regressions = benchmarks.crawl.compare(results, baseline, 10)
+        self.assertEqual(len(regressions), 2)
+        self.assertTrue(regressions[0].startswith("apache-quick peak_rss_mb"))
+        self.assertTrue(regressions[1].startswith("nginx-quick files_per_second"))
+
+    def test_run_case(self):
+        options = {"width": 2, "depth": 1, "files": 3, "style": "nginx"}
+        result = benchmarks.crawl.run_case(options, "quick")
+        self.assertEqual(result["pages"], 3)
+        self.assertEqual(result["files"], 9)
+        self.assertEqual(result["saved"], 9)
+        self.assertGreater(result["files_per_second"], 0)
@@ -0,0 +1,29 @@
+import os
+import sys
+import unittest
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'opendir_dl'))
+import opendir_dl
+import opendir_dl.budget
+import opendir_dl.metrics
+
+class CrawlBudgetTest(unittest.TestCase):
+    def setUp(self):
+        self.metrics = opendir_dl.metrics.CrawlMetrics()
+        self.metrics.count("pages_scraped", 2)
+        self.metrics.count("get_requests", 2)
+        self.metrics.count("head_requests", 3)
+        self.metrics.count("bytes_received", 2048)
+
+    def test_unlimited(self):
+        budget = opendir_dl.budget.CrawlBudget()
+        self.assertFalse(budget.is_limited())
+        self.assertEqual(budget.exceeded(self.metrics), None)
+
+    def test_caps(self):
+        self.assertEqual(opendir_dl.budget.CrawlBudget(pages=2).exceeded(self.metrics), "pages")
+        self.assertEqual(opendir_dl.budget.CrawlBudget(pages=3).exceeded(self.metrics), None)
+        self.assertEqual(opendir_dl.budget.CrawlBudget(files=1).exceeded(self.metrics), None)
+        self.assertEqual(opendir_dl.budget.CrawlBudget(requests=5).exceeded(self.metrics), "requests")
+        self.assertEqual(opendir_dl.budget.CrawlBudget(bytes=2048).exceeded(self.metrics), "bytes")
+        self.assertEqual(opendir_dl.budget.CrawlBudget(seconds=0).exceeded(self.metrics), "time")
+        self.assertTrue(opendir_dl.budget.CrawlBudget(seconds=0).is_limited())
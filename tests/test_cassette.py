@@ -0,0 +1,105 @@
+import os
+import sys
+import tempfile
+import unittest
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'opendir_dl'))
+import opendir_dl
+import opendir_dl.cassette
+from opendir_dl.throttle import TransientError
+from . import ThreadedHTTPServer
+from . import ETagHTTPServer
+
+class FailingSession(object):
+    def request(self, uri, method="GET", body=None, headers=None):
+        raise ConnectionRefusedError("Connection refused")
+
+class CassetteTest(unittest.TestCase):
+    def setUp(self):
+        self.cassette_file = tempfile.NamedTemporaryFile(suffix=".cassette")
+        self.path = self.cassette_file.name
+
+    def tearDown(self):
+        self.cassette_file.close()
+
+    def crawl(self, http_session, url):
+        with tempfile.NamedTemporaryFile(suffix=".db") as db_file:
+            db = opendir_dl.databasing.DatabaseWrapper(db_file.name)
+            db.connect()
+            crawler = opendir_dl.utils.PageCrawler(db.db_conn, [url], http_session)
+            crawler.run()
+            return sorted((i.url, i.content_length) for i in db.query(opendir_dl.models.FileIndex))
+
+    def test_record_and_replay(self):
+        with ThreadedHTTPServer("localhost", 8000) as server:
+            url = "{}test_resources/".format(server.url)
+            session = opendir_dl.cassette.RecordingSession(opendir_dl.httppool.HttpPool(), self.path)
+            recorded = self.crawl(session, url)
+            session.close()
+        # The server is gone, so everything has to come from the cassette
+        replay = opendir_dl.cassette.ReplaySession(self.path)
+        self.assertGreater(len(replay), 0)
+        self.assertEqual(self.crawl(replay, url), recorded)
+        self.assertTrue(("{}example_file.txt".format(url), 13) in recorded)
+
+    def test_replay_same_database(self):
+        # Recording saves the pages' validators, so the replay asks for them
+        # conditionally and still gets the recorded responses
+        with tempfile.NamedTemporaryFile(suffix=".db") as db_file:
+            db = opendir_dl.databasing.DatabaseWrapper(db_file.name)
+            db.connect()
+            with ThreadedHTTPServer("localhost", 8000, ETagHTTPServer) as server:
+                url = "{}test_resources/".format(server.url)
+                session = opendir_dl.cassette.RecordingSession(opendir_dl.httppool.HttpPool(), self.path)
+                opendir_dl.utils.PageCrawler(db.db_conn, [url], session).run()
+                session.close()
+            recorded = db.query(opendir_dl.models.FileIndex).count()
+            replay = opendir_dl.cassette.ReplaySession(self.path)
+            crawler = opendir_dl.utils.PageCrawler(db.db_conn, [url], replay)
+            crawler.run()
+            self.assertEqual(crawler.metrics.counter("scrape_failures"), 0)
+            self.assertEqual(crawler.retry_queue, [])
+            self.assertEqual(db.query(opendir_dl.models.FileIndex).count(), recorded)
+
+    def test_replay_order(self):
+        session = opendir_dl.cassette.RecordingSession(None, self.path)
+        session.record("http://localhost/", "GET", None, {"status": "200"}, b"first", 0.01)
+        session.record("http://localhost/", "GET", None, {"status": "200"}, b"second", 0.01)
+        session.record("http://localhost/", "GET", {"Range": "bytes=0-1"}, {"status": "206"}, b"fi", 0.01)
+        session.close()
+        replay = opendir_dl.cassette.ReplaySession(self.path, latency=True)
+        self.assertEqual(replay.request("http://localhost/")[1], b"first")
+        self.assertEqual(replay.request("http://localhost/")[1], b"second")
+        self.assertEqual(replay.request("http://localhost/")[1], b"second")
+        head, content = replay.request("http://localhost/", headers={"range": "bytes=0-1"})
+        self.assertEqual(head.status, 206)
+        with replay.stream("http://localhost/", chunk_size=2) as (head, chunks):
+            self.assertEqual(list(chunks), [b"se", b"co", b"nd"])
+
+    def test_conditional_headers(self):
+        session = opendir_dl.cassette.RecordingSession(None, self.path)
+        session.record("http://localhost/", "GET", None, {"status": "200"}, b"content", 0.01)
+        session.record("http://localhost/", "GET", {"If-None-Match": '"a"'}, {"status": "304"}, b"", 0.01)
+        session.close()
+        replay = opendir_dl.cassette.ReplaySession(self.path)
+        # Conditional headers are matched when they were recorded
+        self.assertEqual(replay.request("http://localhost/", headers={"If-None-Match": '"a"'})[0].status, 304)
+        self.assertEqual(replay.request("http://localhost/")[0].status, 200)
+        # and fall back to any recording of the same url when they weren't
+        head, content = replay.request("http://localhost/", headers={"If-None-Match": '"b"'})
+        self.assertEqual(content, b"content")
+
+    def test_miss(self):
+        session = opendir_dl.cassette.RecordingSession(None, self.path)
+        session.close()
+        replay = opendir_dl.cassette.ReplaySession(self.path)
+        with self.assertRaises(opendir_dl.cassette.CassetteMiss):
+            replay.request("http://localhost/", "HEAD")
+
+    def test_failures_replayed(self):
+        session = opendir_dl.cassette.RecordingSession(FailingSession(), self.path)
+        with self.assertRaises(ConnectionRefusedError):
+            session.request("http://localhost/")
+        session.close()
+        replay = opendir_dl.cassette.ReplaySession(self.path)
+        with self.assertRaises(TransientError):
+            replay.request("http://localhost/")
@@ -1,6 +1,7 @@
 import os
 import sys
 import hashlib
+import tempfile
 import unittest
 import appdirs
 sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'opendir_dl'))
@@ -177,6 +178,85 @@ class CommandIndexTest(TestWithConfig):
             instance.arguments["<resource>"] = [server.url]
             instance.run()
 
+    def indexed_urls(self, **arguments):
+        """Indexes test_resources/ into a new database with arguments set, and
+        returns the urls of the files that were saved
+        """
+        with tempfile.NamedTemporaryFile(suffix=".db") as db_file:
+            with ThreadedHTTPServer("localhost", 8000) as server:
+                instance = opendir_dl.commands.IndexCommand()
+                instance.config = self.config
+                instance.arguments["--db"] = db_file.name
+                instance.arguments["<resource>"] = ["{}test_resources/".format(server.url)]
+                instance.arguments.update(arguments)
+                instance.run()
+            db = opendir_dl.databasing.DatabaseWrapper.from_fs(db_file.name)
+            urls = set(i.url for i in db.query(opendir_dl.models.FileIndex))
+            db.close()
+        return urls
+
+    def test_async_engine(self):
+        urls = self.indexed_urls(**{"--engine": "async", "--concurrency": "10"})
+        self.assertIn("http://localhost:8000/test_resources/example_file.txt", urls)
+        self.assertEqual(urls, self.indexed_urls())
+
+    def test_invalid_engine(self):
+        instance = opendir_dl.commands.IndexCommand()
+        instance.config = self.config
+        instance.arguments["--engine"] = "notanengine"
+        instance.arguments["<resource>"] = ["http://localhost:8000/"]
+        with self.assertRaises(ValueError) as context:
+            instance.run()
+        expected_error = "Index engine must be one of: 'threaded', 'async'. Got engine 'notanengine'."
+        self.assertEqual(str(context.exception), expected_error)
+
+    def test_resume_async(self):
+        instance = opendir_dl.commands.IndexCommand()
+        instance.config = self.config
+        instance.arguments["--engine"] = "async"
+        instance.arguments["--resume"] = True
+        instance.arguments["<resource>"] = ["http://localhost:8000/"]
+        with self.assertRaises(ValueError) as context:
+            instance.run()
+        expected_error = "Only the 'threaded' index engine can resume. Got engine 'async'."
+        self.assertEqual(str(context.exception), expected_error)
+
+    def test_listen_without_authkey(self):
+        instance = opendir_dl.commands.IndexCommand()
+        instance.config = self.config
+        instance.arguments["--listen"] = "localhost:9100"
+        instance.arguments["<resource>"] = ["http://localhost:8000/"]
+        with self.assertRaises(ValueError) as context:
+            instance.run()
+        expected_error = "Listening for workers on other machines needs an authkey."
+        self.assertEqual(str(context.exception), expected_error)
+
+    def test_index_workers(self):
+        urls = self.indexed_urls(**{"--quick": True, "--workers": "2"})
+        self.assertIn("http://localhost:8000/test_resources/example_file.txt", urls)
+        self.assertEqual(urls, self.indexed_urls(**{"--quick": True}))
+
+    def test_bad_max_bytes(self):
+        instance = opendir_dl.commands.IndexCommand()
+        instance.config = self.config
+        instance.arguments["--max-bytes"] = "lots"
+        instance.arguments["<resource>"] = ["http://localhost:8000/"]
+        with self.assertRaises(ValueError) as context:
+            instance.run()
+        expected_error = "Max bytes must be a size like '500M'. Got 'lots'."
+        self.assertEqual(str(context.exception), expected_error)
+
+    def test_replay_async(self):
+        instance = opendir_dl.commands.IndexCommand()
+        instance.config = self.config
+        instance.arguments["--engine"] = "async"
+        instance.arguments["--replay"] = "crawl.cassette"
+        instance.arguments["<resource>"] = ["http://localhost:8000/"]
+        with self.assertRaises(ValueError) as context:
+            instance.run()
+        expected_error = "Only the 'threaded' index engine can record or replay. Got engine 'async'."
+        self.assertEqual(str(context.exception), expected_error)
+
     def test_index_404status(self):
         with ThreadedHTTPServer("localhost", 8000) as server:
             url = "%s/test_resources/missing_file.txt" % server.url
@@ -1,5 +1,8 @@
 import os
 import sys
+import shutil
+import sqlite3
+import tempfile
 import unittest
 import appdirs
 sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'opendir_dl'))
@@ -8,6 +11,17 @@ from . import ThreadedHTTPServer
 from . import TestWithConfig
 
 class DatabaseWrapperTest(unittest.TestCase):
+    def setUp(self):
+        # Connecting migrates a database in place, so tests open a copy of
+        # the fixture rather than the fixture itself
+        self_path = os.path.realpath(__file__)
+        cur_dir = "/".join(self_path.split("/")[:-1])
+        self.db_file = tempfile.NamedTemporaryFile(suffix=".db")
+        shutil.copy(cur_dir + '/test_resources/test_sqlite3.db', self.db_file.name)
+
+    def tearDown(self):
+        self.db_file.close()
+
     def test_provided_source(self):
         db = opendir_dl.databasing.DatabaseWrapper("sqlite3.db")
         self.assertEquals(db.source, "sqlite3.db")
@@ -47,10 +61,7 @@ class DatabaseWrapperTest(unittest.TestCase):
         self.assertEquals(db.query(opendir_dl.models.FileIndex).count(), 14)
 
     def test_from_fs(self):
-        self_path = os.path.realpath(__file__)
-        cur_dir = "/".join(self_path.split("/")[:-1])
-        db_path = cur_dir + '/test_resources/test_sqlite3.db'
-        db = opendir_dl.databasing.DatabaseWrapper.from_fs(db_path)
+        db = opendir_dl.databasing.DatabaseWrapper.from_fs(self.db_file.name)
         self.assertTrue(db.is_connected())
         self.assertEquals(db.query(opendir_dl.models.FileIndex).count(), 14)
 
@@ -78,6 +89,77 @@ class DatabaseWrapperTest(unittest.TestCase):
                 db = opendir_dl.databasing.DatabaseWrapper.from_url(url)
         self.assertEqual(str(context.exception), expected_error)
 
+    def test_url_key_upgrade(self):
+        # A database from before urls were unique, with a file saved twice
+        with tempfile.NamedTemporaryFile(suffix=".db") as db_file:
+            connection = sqlite3.connect(db_file.name)
+            connection.executescript("""
+                CREATE TABLE fileindex (pkid INTEGER PRIMARY KEY, url VARCHAR, name VARCHAR, domain VARCHAR,
+                    last_indexed DATETIME, content_type VARCHAR, last_modified DATETIME, content_length INTEGER);
+                CREATE TABLE tags (pkid INTEGER PRIMARY KEY, name VARCHAR);
+                CREATE TABLE associations (left_pkid INTEGER, right_pkid INTEGER);
+                INSERT INTO fileindex (pkid, url, name, content_length) VALUES (1, 'http://localhost/a.txt', 'a.txt', 1);
+                INSERT INTO fileindex (pkid, url, name, content_length) VALUES (2, 'http://localhost/a.txt', 'a.txt', 2);
+                INSERT INTO fileindex (pkid, url, name, content_length) VALUES (3, 'http://localhost/b.txt', 'b.txt', 3);
+                INSERT INTO tags (pkid, name) VALUES (1, 'tagged');
+                INSERT INTO associations (left_pkid, right_pkid) VALUES (1, 1);
+            """)
+            connection.commit()
+            connection.close()
+            db = opendir_dl.databasing.DatabaseWrapper(db_file.name)
+            db.connect()
+            rows = db.query(opendir_dl.models.FileIndex).order_by(opendir_dl.models.FileIndex.pkid).all()
+            self.assertEqual([(i.pkid, i.content_length) for i in rows], [(2, 2), (3, 3)])
+            self.assertEqual([i.name for i in rows[0].tags], ["tagged"])
+            # Saving the file again updates its row
+            head = opendir_dl.utils.HttpHead("http://localhost/a.txt", {"content-length": "5"})
+            opendir_dl.utils.save_head(db.db_conn, head.as_fileindex())
+            self.assertEqual(db.query(opendir_dl.models.FileIndex).get(2).content_length, 5)
+            self.assertEqual(db.query(opendir_dl.models.FileIndex).count(), 2)
+            db.close()
+
+class SqlitePragmasTest(unittest.TestCase):
+    def test_default_workload(self):
+        pragmas = opendir_dl.databasing.sqlite_pragmas({"type": "filesystem", "resource": "default.db"})
+        self.assertEqual(pragmas, opendir_dl.databasing.SQLITE_WORKLOADS["default"])
+
+    def test_overrides(self):
+        database_dict = {"workload": "search", "sqlite": {"mmap_size": 0, "synchronous": "FULL"}}
+        pragmas = opendir_dl.databasing.sqlite_pragmas(database_dict)
+        self.assertEqual(pragmas["mmap_size"], 0)
+        self.assertEqual(pragmas["synchronous"], "FULL")
+        self.assertEqual(pragmas["journal_mode"], "wal")
+
+    def test_plain_workload(self):
+        self.assertEqual(opendir_dl.databasing.sqlite_pragmas({"workload": "plain"}), {})
+
+    def test_bad_settings(self):
+        bad_dicts = [{"workload": "fast"},
+                     {"sqlite": {"page_size": 4096}},
+                     {"sqlite": {"journal_mode": "wal; DROP TABLE fileindex"}},
+                     {"sqlite": {"cache_size": "lots"}},
+                     {"sqlite": {"mmap_size": True}}]
+        for database_dict in bad_dicts:
+            with self.assertRaises(ValueError):
+                opendir_dl.databasing.sqlite_pragmas(database_dict)
+
+    def test_applied(self):
+        pragmas = opendir_dl.databasing.sqlite_pragmas({"workload": "crawl", "sqlite": {"cache_size": -1000}})
+        with tempfile.NamedTemporaryFile(suffix=".db") as db_file:
+            db = opendir_dl.databasing.DatabaseWrapper(db_file.name, pragmas)
+            db.connect()
+            self.assertEqual(db.db_conn.execute("PRAGMA journal_mode").scalar(), "wal")
+            self.assertEqual(db.db_conn.execute("PRAGMA synchronous").scalar(), 1)
+            self.assertEqual(db.db_conn.execute("PRAGMA cache_size").scalar(), -1000)
+            self.assertEqual(db.db_conn.execute("PRAGMA wal_autocheckpoint").scalar(), 10000)
+            db.close()
+
+    def test_sqlite_version(self):
+        opendir_dl.databasing.check_sqlite_version("3.24.0")
+        opendir_dl.databasing.check_sqlite_version("3.40.1")
+        with self.assertRaises(ValueError):
+            opendir_dl.databasing.check_sqlite_version("3.22.0")
+
 class DatabaseOpenerTest(TestWithConfig):
     def test_provided_none(self):
         db_wrapper = opendir_dl.databasing.database_opener(self.config)
@@ -90,7 +172,7 @@ class DatabaseOpenerTest(TestWithConfig):
         self.assertTrue(db_wrapper.is_connected())
 
     def test_provided_filesystem(self):
-        db_path = "test_resources/test_sqlite3.db"
+        db_path = self.database_path
         db_wrapper = opendir_dl.databasing.database_opener(self.config, db_path)
         self.assertTrue(db_wrapper.is_connected())
 
@@ -103,6 +185,27 @@ class DatabaseOpenerTest(TestWithConfig):
         db_wrapper = opendir_dl.databasing.database_opener(self.config, db_name)
         self.assertTrue(db_wrapper.is_connected())
 
+    def test_named_db_workload(self):
+        db_name = "named_workload_test"
+        instance = opendir_dl.commands.DatabaseCreateCommand()
+        instance.config = self.config
+        instance.arguments["<name>"] = [db_name]
+        instance.arguments["--workload"] = "search"
+        instance.run()
+        self.assertEqual(self.config.databases[db_name]["workload"], "search")
+        db_wrapper = opendir_dl.databasing.database_opener(self.config, db_name)
+        self.assertEqual(db_wrapper.pragmas["mmap_size"], 2147483648)
+        self.assertEqual(db_wrapper.db_conn.execute("PRAGMA cache_size").scalar(), -262144)
+
+    def test_named_db_bad_workload(self):
+        instance = opendir_dl.commands.DatabaseCreateCommand()
+        instance.config = self.config
+        instance.arguments["<name>"] = ["bad_workload_test"]
+        instance.arguments["--workload"] = "fast"
+        with self.assertRaises(ValueError):
+            instance.run()
+        self.assertNotIn("bad_workload_test", self.config.databases)
+
     def tests_not_matching(self):
         provided_string = "abc_doesnt-match a database"
         with self.assertRaises(ValueError) as context:
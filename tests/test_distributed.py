@@ -0,0 +1,90 @@
+import os
+import sys
+import tempfile
+import unittest
+import threading
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'opendir_dl'))
+import opendir_dl
+import opendir_dl.distributed
+from . import ThreadedHTTPServer
+
+class ShardTest(unittest.TestCase):
+    def test_shard_by_host(self):
+        first = opendir_dl.distributed.shard_for("http://example.com/a/", 8)
+        second = opendir_dl.distributed.shard_for("http://example.com/b/c.txt", 8)
+        self.assertEqual(first, second)
+        self.assertTrue(0 <= first < 8)
+
+    def test_parse_address(self):
+        self.assertEqual(opendir_dl.distributed.parse_address("10.0.0.2:9000"), ("10.0.0.2", 9000))
+        self.assertEqual(opendir_dl.distributed.parse_address(":9000"), ("localhost", 9000))
+        self.assertEqual(opendir_dl.distributed.parse_address("/tmp/crawl.sock"), "/tmp/crawl.sock")
+
+class CoordinatorTest(unittest.TestCase):
+    def test_put(self):
+        coordinator = opendir_dl.distributed.Coordinator(None, shards=2)
+        coordinator.max_depth = 1
+        self.assertTrue(coordinator.put("page", "http://example.com/a/", 1))
+        self.assertFalse(coordinator.put("page", "http://example.com/a/", 1))
+        self.assertFalse(coordinator.put("page", "http://example.com/a/b/", 2))
+        self.assertEqual(coordinator.metrics.snapshot()["gauges"]["frontier_queued"], 1)
+
+    def test_orphan_shards_shared(self):
+        coordinator = opendir_dl.distributed.Coordinator(None, shards=2)
+        url = "http://example.com/a/"
+        shard = opendir_dl.distributed.shard_for(url, 2)
+        coordinator.put("page", url)
+        owner = opendir_dl.distributed.WorkerSlot(None, 1 - shard)
+        coordinator._slots.append(owner)
+        # Nobody owns the url's shard, so the other worker takes it
+        self.assertEqual(coordinator.next_item(owner), ("page", url, 0))
+        coordinator.put("page", "http://example.com/b/")
+        coordinator._slots.append(opendir_dl.distributed.WorkerSlot(None, shard))
+        self.assertEqual(coordinator.next_item(owner), None)
+
+    def test_remote_worker(self):
+        with tempfile.NamedTemporaryFile(suffix=".db") as db_file:
+            db = opendir_dl.databasing.DatabaseWrapper(db_file.name)
+            db.connect()
+            with ThreadedHTTPServer("localhost", 8000) as server:
+                coordinator = opendir_dl.distributed.Coordinator(
+                    db.db_conn, ["{}test_resources/".format(server.url)], ("localhost", 0), b"secret")
+                coordinator.quick = True
+                coordinator.listen()
+                coordinator_thread = threading.Thread(target=coordinator.run)
+                coordinator_thread.start()
+                worker = opendir_dl.distributed.ShardWorker(coordinator.address, b"secret")
+                worker.run()
+                coordinator_thread.join()
+            url = "{}test_resources/example_file.txt".format(server.url)
+            self.assertEqual(db.query(opendir_dl.models.FileIndex).filter_by(url=url).count(), 1)
+            self.assertEqual(worker.triage_mode, "quick")
+
+    def test_local_workers(self):
+        with tempfile.NamedTemporaryFile(suffix=".db") as db_file:
+            db = opendir_dl.databasing.DatabaseWrapper(db_file.name)
+            db.connect()
+            with ThreadedHTTPServer("localhost", 8000) as server:
+                coordinator = opendir_dl.distributed.Coordinator(db.db_conn, [server.url], shards=2)
+                coordinator.local_workers = 2
+                coordinator.quick = True
+                coordinator.max_depth = 1
+                coordinator.run()
+            url = "{}test_resources/example_file.txt".format(server.url)
+            self.assertEqual(db.query(opendir_dl.models.FileIndex).filter_by(url=url).count(), 1)
+            self.assertGreater(coordinator.metrics.counter("pages_scraped"), 1)
+
+    def test_budget(self):
+        with ThreadedHTTPServer("localhost", 8000) as server:
+            coordinator = opendir_dl.distributed.Coordinator(None, [server.url], ("localhost", 0), b"secret")
+            coordinator.quick = True
+            coordinator.budget.pages = 1
+            coordinator.listen()
+            coordinator_thread = threading.Thread(target=coordinator.run)
+            coordinator_thread.start()
+            worker = opendir_dl.distributed.ShardWorker(coordinator.address, b"secret")
+            worker.run()
+            coordinator_thread.join()
+        self.assertEqual(coordinator.stopped_by, "pages")
+        # The worker's requests were counted by the coordinator
+        self.assertGreater(coordinator.metrics.counter("get_requests"), 0)
@@ -0,0 +1,125 @@
+import os
+import sys
+import queue
+import threading
+import unittest
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'opendir_dl'))
+import opendir_dl
+import opendir_dl.frontier
+import opendir_dl.databasing
+
+class BloomFilterTest(unittest.TestCase):
+    def test_add_and_contains(self):
+        bloom = opendir_dl.frontier.BloomFilter(1000)
+        self.assertTrue(bloom.add("http://localhost/a"))
+        self.assertFalse(bloom.add("http://localhost/a"))
+        self.assertTrue("http://localhost/a" in bloom)
+        self.assertFalse("http://localhost/b" in bloom)
+        self.assertEqual(len(bloom), 1)
+
+    def test_false_positive_rate(self):
+        bloom = opendir_dl.frontier.BloomFilter(5000, error_rate=0.01)
+        for i in range(5000):
+            bloom.add("http://localhost/file{}".format(i))
+        false_positives = sum(1 for i in range(5000) if "http://localhost/other{}".format(i) in bloom)
+        self.assertLess(false_positives, 5000 * 0.03)
+
+    def test_memory_cap(self):
+        bloom = opendir_dl.frontier.BloomFilter(10 ** 8, max_bytes=1024)
+        self.assertEqual(bloom.size_bytes, 1024)
+        bloom = opendir_dl.frontier.BloomFilter.for_memory(4096, 0.001)
+        self.assertEqual(bloom.size_bytes, 4096)
+        self.assertGreater(bloom.capacity, 2000)
+
+class VisitedSetTest(unittest.TestCase):
+    def test_exact(self):
+        visited = opendir_dl.frontier.VisitedSet()
+        self.assertTrue(visited.add("http://localhost/a/"))
+        self.assertFalse(visited.add("http://localhost/a/"))
+        self.assertFalse(visited.add("http://localhost/a/#top"))
+        self.assertTrue("http://localhost/a/" in visited)
+        self.assertFalse(visited.probabilistic)
+
+    def test_switch_to_bloom(self):
+        visited = opendir_dl.frontier.VisitedSet(exact_limit=10, max_bytes=4096)
+        urls = ["http://localhost/file{}".format(i) for i in range(20)]
+        for url in urls:
+            self.assertTrue(visited.add(url))
+        self.assertTrue(visited.probabilistic)
+        for url in urls:
+            self.assertTrue(url in visited)
+            self.assertFalse(visited.add(url))
+        self.assertEqual(len(visited), 20)
+
+class CrawlFrontierTest(unittest.TestCase):
+    def test_put_and_get(self):
+        frontier = opendir_dl.frontier.CrawlFrontier()
+        self.assertTrue(frontier.put("http://localhost/a/", 2))
+        self.assertEqual(len(frontier), 1)
+        self.assertEqual(frontier.get(), ("http://localhost/a/", 2))
+        self.assertEqual(len(frontier), 0)
+
+    def test_get_empty(self):
+        frontier = opendir_dl.frontier.CrawlFrontier()
+        with self.assertRaises(queue.Empty):
+            frontier.get(timeout=0)
+
+    def test_max_depth(self):
+        frontier = opendir_dl.frontier.CrawlFrontier(max_depth=1)
+        self.assertTrue(frontier.put("http://localhost/", 0))
+        self.assertTrue(frontier.put("http://localhost/a/", 1))
+        self.assertFalse(frontier.put("http://localhost/a/b/", 2))
+        self.assertTrue(frontier.beyond_depth(2))
+        self.assertEqual(frontier.outstanding, 2)
+
+    def test_visited(self):
+        frontier = opendir_dl.frontier.CrawlFrontier(visited=opendir_dl.frontier.VisitedSet())
+        self.assertTrue(frontier.put("http://localhost/a/"))
+        self.assertFalse(frontier.put("http://localhost/a/"))
+        self.assertEqual(frontier.outstanding, 1)
+
+    def test_outstanding_work(self):
+        frontier = opendir_dl.frontier.CrawlFrontier()
+        frontier.put("http://localhost/")
+        frontier.get()
+        # The entry has left the queue but is still being worked on
+        self.assertEqual(len(frontier), 0)
+        self.assertFalse(frontier.wait(timeout=0))
+        frontier.task_done()
+        self.assertTrue(frontier.wait(timeout=0))
+
+    def test_wait_wakes_on_last_task(self):
+        frontier = opendir_dl.frontier.CrawlFrontier()
+        frontier.put("http://localhost/")
+        frontier.get()
+        timer = threading.Timer(0.1, frontier.task_done)
+        timer.start()
+        self.assertTrue(frontier.wait(timeout=5))
+        timer.join()
+
+    def test_close(self):
+        frontier = opendir_dl.frontier.CrawlFrontier()
+        frontier.put("http://localhost/")
+        frontier.close()
+        self.assertFalse(frontier.wait(timeout=0))
+        with self.assertRaises(queue.Empty):
+            frontier.get()
+
+class FrontierStoreTest(unittest.TestCase):
+    def setUp(self):
+        self.db = opendir_dl.databasing.DatabaseWrapper('')
+        self.db.connect()
+        self.store = opendir_dl.frontier.FrontierStore(self.db.db_conn)
+
+    def test_record(self):
+        self.store.record("http://localhost/", 0, "pending")
+        self.store.record("http://localhost/a/", 1, "pending")
+        self.store.record("http://localhost/", 0, "done")
+        entries = sorted(self.store.entries())
+        self.assertEqual(entries, [("http://localhost/", 0, "done"),
+                                   ("http://localhost/a/", 1, "pending")])
+
+    def test_clear(self):
+        self.store.record("http://localhost/", 0, "pending")
+        self.store.clear()
+        self.assertEqual(self.store.entries(), [])
@@ -0,0 +1,125 @@
+import os
+import sys
+import time
+import threading
+import unittest
+from urllib.parse import urlparse
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'opendir_dl'))
+import opendir_dl
+import opendir_dl.httppool
+from . import ThreadedHTTPServer
+from . import KeepAliveHTTPServer
+
+class HttpPoolTest(unittest.TestCase):
+    def setUp(self):
+        self.pool = opendir_dl.httppool.HttpPool()
+        self.key = ("http", "localhost", 8000)
+
+    def tearDown(self):
+        self.pool.close()
+
+    def test_host_key(self):
+        key = opendir_dl.httppool.HttpPool.host_key(urlparse("https://example.com/dir/"))
+        self.assertEqual(key, ("https", "example.com", 443))
+
+    def test_keep_alive_reuse(self):
+        with ThreadedHTTPServer("localhost", 8000, KeepAliveHTTPServer) as server:
+            url = "{}test_resources/example_file.txt".format(server.url)
+            first = self.pool.request(url)
+            second = self.pool.request(url, "HEAD")
+            self.assertEqual(self.pool.connection_count(self.key), 1)
+            self.pool.close()
+        self.assertEqual(first[0]["status"], '200')
+        self.assertEqual(first[1], b"test content\n")
+        self.assertEqual(second[0]["content-length"], '13')
+        self.assertEqual(second[1], b"")
+
+    def test_connection_close_not_reused(self):
+        # The default test server speaks HTTP/1.0 and closes every connection
+        with ThreadedHTTPServer("localhost", 8000) as server:
+            response = self.pool.request(server.url)
+        self.assertEqual(response[0]["status"], '200')
+        self.assertEqual(self.pool.connection_count(), 0)
+
+    def test_idle_eviction(self):
+        self.pool.idle_timeout = 0
+        with ThreadedHTTPServer("localhost", 8000, KeepAliveHTTPServer) as server:
+            self.pool.request(server.url)
+            self.pool.evict_idle()
+            self.assertEqual(self.pool.connection_count(), 0)
+
+    def test_per_host_limit(self):
+        self.pool.max_per_host = 1
+        connection, reused = self.pool.acquire(self.key)
+        self.assertFalse(reused)
+        acquired = threading.Event()
+        def second_acquire():
+            self.pool.acquire(self.key)
+            acquired.set()
+        waiting_thread = threading.Thread(target=second_acquire)
+        waiting_thread.start()
+        # The second thread has to wait for the first connection to be released
+        self.assertFalse(acquired.wait(0.2))
+        self.pool.release(self.key, connection)
+        self.assertTrue(acquired.wait(1))
+        waiting_thread.join()
+
+    def test_lend(self):
+        self.pool.max_per_host = 1
+        connection, _ = self.pool.acquire(self.key)
+        acquired = threading.Event()
+        def second_acquire():
+            second, _ = self.pool.acquire(self.key)
+            acquired.set()
+            time.sleep(0.2)
+            self.pool.release(self.key, second)
+        waiting_thread = threading.Thread(target=second_acquire)
+        with self.pool.lend("http://localhost:8000/dir/"):
+            # The lent slot lets the second connection through
+            waiting_thread.start()
+            self.assertTrue(acquired.wait(1))
+        # Taking the slot back waited for the second connection, so the host
+        # never has more than its limit counted
+        self.assertFalse(waiting_thread.is_alive())
+        waiting_thread.join()
+        self.pool.release(self.key, connection)
+
+    def test_adaptive_limit(self):
+        self.assertEqual(self.pool.host_limit(self.key), 2)
+        for _ in range(3):
+            self.pool.report(self.key, 200, 0.01)
+        self.assertEqual(self.pool.host_limit(self.key), 3)
+        self.pool.report(self.key, 503, 0.01)
+        self.assertEqual(self.pool.host_limit(self.key), 1)
+
+    def test_not_adaptive(self):
+        pool = opendir_dl.httppool.HttpPool(adaptive=False)
+        pool.report(self.key, 503, 0.01)
+        self.assertEqual(pool.host_limit(self.key), pool.max_per_host)
+
+    def test_redirect(self):
+        with ThreadedHTTPServer("localhost", 8000) as server:
+            url = "{}test_resources".format(server.url)
+            response = self.pool.request(url)
+        self.assertEqual(response[0]["status"], '200')
+        self.assertEqual(response[0]["content-location"], url + "/")
+
+    def test_stream(self):
+        with ThreadedHTTPServer("localhost", 8000, KeepAliveHTTPServer) as server:
+            url = "{}test_resources/example_file.txt".format(server.url)
+            with self.pool.stream(url, chunk_size=4) as (response, chunks):
+                chunks = list(chunks)
+            self.assertEqual(response["status"], '200')
+            self.assertEqual(chunks, [b"test", b" con", b"tent", b"\n"])
+            # The body was read to the end, so the connection is kept alive
+            self.assertEqual(self.pool.connection_count(self.key), 1)
+            with self.pool.stream(url, chunk_size=4) as (response, chunks):
+                next(chunks)
+            # The body was abandoned part way, so the connection is closed
+            self.assertEqual(self.pool.connection_count(self.key), 0)
+            self.pool.close()
+
+    def test_shared_pool(self):
+        pool = opendir_dl.httppool.shared_pool()
+        self.assertTrue(isinstance(pool, opendir_dl.httppool.HttpPool))
+        self.assertTrue(pool is opendir_dl.httppool.shared_pool())
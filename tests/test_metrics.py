@@ -0,0 +1,78 @@
+import os
+import sys
+import json
+import tempfile
+import unittest
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'opendir_dl'))
+import opendir_dl
+import opendir_dl.metrics
+
+class HistogramTest(unittest.TestCase):
+    def test_observe(self):
+        histogram = opendir_dl.metrics.Histogram([0.1, 1])
+        for value in [0.05, 0.5, 0.7, 5]:
+            histogram.observe(value)
+        self.assertEqual(histogram.count, 4)
+        self.assertAlmostEqual(histogram.sum, 6.25)
+        self.assertEqual(histogram.cumulative(), [(0.1, 1), (1, 3), (float("inf"), 4)])
+
+class CrawlMetricsTest(unittest.TestCase):
+    def setUp(self):
+        self.metrics = opendir_dl.metrics.CrawlMetrics()
+        self.metrics.count("get_requests")
+        self.metrics.count("bytes_received", 13)
+        self.metrics.observe("get_latency_seconds", 0.02)
+        self.metrics.gauge("frontier_queued", lambda: 7)
+
+    def test_snapshot(self):
+        snapshot = self.metrics.snapshot()
+        self.assertEqual(snapshot["counters"], {"get_requests": 1, "bytes_received": 13})
+        self.assertEqual(snapshot["gauges"], {"frontier_queued": 7})
+        self.assertEqual(snapshot["histograms"]["get_latency_seconds"]["count"], 1)
+
+    def test_timer(self):
+        with self.metrics.timer("parse_seconds"):
+            pass
+        self.assertEqual(self.metrics.snapshot()["histograms"]["parse_seconds"]["count"], 1)
+
+    def test_prometheus(self):
+        lines = self.metrics.prometheus().splitlines()
+        self.assertTrue("opendir_dl_get_requests_total 1" in lines)
+        self.assertTrue("opendir_dl_frontier_queued 7" in lines)
+        self.assertTrue('opendir_dl_get_latency_seconds_bucket{le="0.025"} 1' in lines)
+        self.assertTrue('opendir_dl_get_latency_seconds_bucket{le="+Inf"} 1' in lines)
+        self.assertTrue("opendir_dl_get_latency_seconds_count 1" in lines)
+
+class MetricsWriterTest(unittest.TestCase):
+    def test_jsonl(self):
+        metrics = opendir_dl.metrics.CrawlMetrics()
+        with tempfile.TemporaryDirectory() as temp_dir:
+            path = os.path.join(temp_dir, "metrics.jsonl")
+            writer = opendir_dl.metrics.MetricsWriter(metrics, path, interval=60)
+            writer.write()
+            metrics.count("head_requests", 5)
+            writer.write()
+            with open(path) as metrics_file:
+                lines = [json.loads(i) for i in metrics_file]
+        self.assertEqual(len(lines), 2)
+        self.assertEqual(lines[1]["counters"]["head_requests"], 5)
+        self.assertGreater(lines[1]["requests_per_second"], 0)
+
+    def test_prometheus(self):
+        metrics = opendir_dl.metrics.CrawlMetrics()
+        metrics.count("head_requests")
+        with tempfile.TemporaryDirectory() as temp_dir:
+            path = os.path.join(temp_dir, "metrics.prom")
+            writer = opendir_dl.metrics.MetricsWriter(metrics, path, "prometheus", interval=60)
+            writer.start()
+            writer.stop()
+            with open(path) as metrics_file:
+                self.assertTrue("opendir_dl_head_requests_total 1" in metrics_file.read())
+            self.assertEqual(os.listdir(temp_dir), ["metrics.prom"])
+
+    def test_invalid_format(self):
+        metrics = opendir_dl.metrics.CrawlMetrics()
+        with self.assertRaises(ValueError) as context:
+            opendir_dl.metrics.MetricsWriter(metrics, "metrics.txt", "csv")
+        expected_error = "Metrics format must be one of: 'jsonl', 'prometheus'. Got format 'csv'."
+        self.assertEqual(str(context.exception), expected_error)
@@ -0,0 +1,112 @@
+import os
+import sys
+import sqlite3
+import tempfile
+import unittest
+import sqlalchemy
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'opendir_dl'))
+import opendir_dl
+import opendir_dl.migrations
+
+# The tables as the first versions of opendir-dl created them
+OLD_SCHEMA = """
+    CREATE TABLE fileindex (pkid INTEGER PRIMARY KEY, url VARCHAR, name VARCHAR, domain VARCHAR,
+        last_indexed DATETIME, content_type VARCHAR, last_modified DATETIME, content_length INTEGER);
+    CREATE TABLE tags (pkid INTEGER PRIMARY KEY, name VARCHAR);
+    CREATE TABLE associations (left_pkid INTEGER, right_pkid INTEGER);
+    INSERT INTO fileindex (pkid, url, name) VALUES (1, 'http://localhost/a.txt', 'a.txt');
+"""
+
+# Files saved by versions before hosts, directories and content types were
+# stored once, with a tag on one of them
+VERSION_2_ROWS = """
+    INSERT INTO fileindex (pkid, url, name, domain, last_indexed, content_type, last_modified, content_length)
+    VALUES (7, 'http://localhost:8000/isos/debian.iso', 'debian.iso', 'localhost',
+            '2016-10-27 04:03:33.997490', 'application/x-iso9660-image', NULL, 300);
+    INSERT INTO fileindex (pkid, url, name, domain, last_indexed, content_type, last_modified, content_length)
+    VALUES (9, 'http://localhost:8000/view.php?file=a', 'view.php', 'localhost',
+            '2016-10-27 04:03:34.018469', 'text/html', NULL, 10);
+    INSERT INTO tags (pkid, name) VALUES (1, 'isos');
+    INSERT INTO associations (left_pkid, right_pkid) VALUES (7, 1);
+"""
+
+def index_names(engine, table):
+    # Read from sqlite_master, since inspect skips indexes on expressions
+    query = "SELECT name FROM sqlite_master WHERE type = 'index' AND tbl_name = ? AND sql IS NOT NULL"
+    return sorted(i[0] for i in engine.execute(query, table))
+
+class MigrateTest(unittest.TestCase):
+    def setUp(self):
+        self.db_file = tempfile.NamedTemporaryFile(suffix=".db")
+        self.engine = sqlalchemy.create_engine("sqlite:///%s" % self.db_file.name)
+
+    def tearDown(self):
+        self.engine.dispose()
+        self.db_file.close()
+
+    def version(self):
+        with self.engine.connect() as connection:
+            return opendir_dl.migrations.schema_version(connection)
+
+    def test_new_database(self):
+        applied = opendir_dl.migrations.migrate(self.engine)
+        self.assertEqual(applied, [i[0] for i in opendir_dl.migrations.MIGRATIONS])
+        self.assertEqual(self.version(), opendir_dl.migrations.latest_version())
+        self.assertIn("ix_fileindex_name", index_names(self.engine, "fileindex"))
+        # Nothing is left to do the next time it's opened
+        self.assertEqual(opendir_dl.migrations.migrate(self.engine), [])
+
+    def test_old_database(self):
+        connection = sqlite3.connect(self.db_file.name)
+        connection.executescript(OLD_SCHEMA)
+        connection.close()
+        opendir_dl.migrations.migrate(self.engine)
+        self.assertEqual(self.version(), opendir_dl.migrations.latest_version())
+        self.assertEqual(index_names(self.engine, "fileindex"),
+                         ["ix_fileindex_last_indexed", "ix_fileindex_name", "ux_fileindex_file"])
+        self.assertEqual(index_names(self.engine, "associations"),
+                         ["ix_associations_left_pkid", "ix_associations_right_pkid"])
+        self.assertEqual(index_names(self.engine, "tags"), ["ix_tags_name"])
+        # The rows are all still there
+        self.assertEqual(self.engine.execute("SELECT url FROM files").fetchall(), [("http://localhost/a.txt",)])
+
+    def test_partial_upgrade(self):
+        connection = sqlite3.connect(self.db_file.name)
+        connection.executescript(OLD_SCHEMA)
+        connection.close()
+        opendir_dl.models.MODELBASE.metadata.create_all(self.engine)
+        with self.engine.begin() as connection:
+            opendir_dl.migrations.unique_url_key(connection)
+            opendir_dl.migrations.record_version(connection, 1, "Unique url key on fileindex")
+        applied = opendir_dl.migrations.migrate(self.engine)
+        self.assertEqual(applied, [i[0] for i in opendir_dl.migrations.MIGRATIONS][1:])
+
+    def test_normalized_files(self):
+        connection = sqlite3.connect(self.db_file.name)
+        connection.executescript(OLD_SCHEMA)
+        connection.close()
+        opendir_dl.models.MODELBASE.metadata.create_all(self.engine)
+        with self.engine.begin() as connection:
+            connection.execute("DELETE FROM fileindex")
+            for statement in VERSION_2_ROWS.split(";")[:-1]:
+                connection.execute(statement)
+            opendir_dl.migrations.record_version(connection, 2, "Indexes for search, upserts and tag joins")
+        self.assertEqual(opendir_dl.migrations.migrate(self.engine), [3])
+        rows = self.engine.execute("SELECT * FROM files ORDER BY pkid").fetchall()
+        self.assertEqual([tuple(i) for i in rows],
+                         [(7, "http://localhost:8000/isos/debian.iso", "debian.iso", "localhost",
+                           "2016-10-27 04:03:33.997490", "application/x-iso9660-image", None, 300),
+                          (9, "http://localhost:8000/view.php?file=a", "view.php", "localhost",
+                           "2016-10-27 04:03:34.018469", "text/html", None, 10)])
+        # Tags still point at the same files
+        tagged = self.engine.execute("SELECT left_pkid FROM associations").fetchall()
+        self.assertEqual(tagged, [(7,)])
+        paths = self.engine.execute("SELECT path FROM directories ORDER BY path").fetchall()
+        self.assertEqual(paths, [("/",), ("/isos/",)])
+
+    def test_newer_database(self):
+        opendir_dl.migrations.migrate(self.engine)
+        with self.engine.begin() as connection:
+            opendir_dl.migrations.record_version(connection, opendir_dl.migrations.latest_version() + 1, "From the future")
+        with self.assertRaises(ValueError):
+            opendir_dl.migrations.migrate(self.engine)
@@ -0,0 +1,88 @@
+import io
+import os
+import sys
+import time
+import unittest
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'opendir_dl'))
+import opendir_dl
+import opendir_dl.metrics
+import opendir_dl.progress
+from opendir_dl.progress import QUIET
+from opendir_dl.progress import NORMAL
+from opendir_dl.progress import VERBOSE
+
+class TerminalStream(io.StringIO):
+    def isatty(self):
+        return True
+
+class ProgressReporterTest(unittest.TestCase):
+    def setUp(self):
+        self.metrics = opendir_dl.metrics.CrawlMetrics()
+        self.metrics.count("pages_scraped", 3)
+        self.metrics.count("files_indexed", 40)
+        self.metrics.gauge("frontier_queued", lambda: 5)
+
+    def test_levels(self):
+        stream = io.StringIO()
+        reporter = opendir_dl.progress.ProgressReporter(level=NORMAL, stream=stream)
+        reporter.log("every url")
+        reporter.log("a failure", NORMAL)
+        reporter.log("the summary", QUIET)
+        self.assertEqual(stream.getvalue(), "a failure\nthe summary\n")
+
+    def test_lazy_format(self):
+        class Unformattable(object):
+            def __format__(self, spec):
+                raise AssertionError("Formatted a dropped message")
+        stream = io.StringIO()
+        reporter = opendir_dl.progress.ProgressReporter(level=NORMAL, stream=stream)
+        reporter.log("every url {}", VERBOSE, Unformattable())
+        reporter.log("a failure ({}) URL: {}", NORMAL, "timed out", "http://localhost/")
+        self.assertEqual(stream.getvalue(), "a failure (timed out) URL: http://localhost/\n")
+
+    def test_verbose(self):
+        stream = io.StringIO()
+        reporter = opendir_dl.progress.ProgressReporter(level=VERBOSE, stream=stream)
+        reporter.log("every url")
+        self.assertEqual(stream.getvalue(), "every url\n")
+
+    def test_status_line(self):
+        reporter = opendir_dl.progress.ProgressReporter(self.metrics)
+        line = reporter.status_line()
+        self.assertTrue(line.startswith("3 pages, 40 files indexed, 5 queued"))
+        self.assertFalse("deferred" in line)
+        self.metrics.count("deferred", 2)
+        self.assertTrue(reporter.status_line().endswith("2 deferred"))
+
+    def test_running(self):
+        stream = TerminalStream()
+        reporter = opendir_dl.progress.ProgressReporter(self.metrics, stream=stream)
+        reporter.interval = 0.01
+        reporter.start()
+        time.sleep(0.05)
+        reporter.log("a failure {}", NORMAL, 1)
+        reporter.log("every url")
+        reporter.stop()
+        output = stream.getvalue()
+        self.assertTrue("a failure 1\n" in output)
+        self.assertFalse("every url" in output)
+        self.assertTrue(output.endswith("MB\n"))
+        # Messages are written above the status line, which is redrawn in place
+        self.assertTrue("\r\x1b[K" in output)
+
+    def test_quiet(self):
+        stream = TerminalStream()
+        reporter = opendir_dl.progress.ProgressReporter(self.metrics, level=QUIET, stream=stream)
+        reporter.start()
+        reporter.log("a failure", NORMAL)
+        reporter.stop()
+        self.assertEqual(stream.getvalue(), "")
+
+    def test_not_a_terminal(self):
+        stream = io.StringIO()
+        reporter = opendir_dl.progress.ProgressReporter(self.metrics, stream=stream)
+        reporter.refresh()
+        self.assertEqual(stream.getvalue(), "")
+        reporter.refresh(final=True)
+        self.assertTrue(stream.getvalue().startswith("3 pages"))
+        self.assertFalse("\r" in stream.getvalue())
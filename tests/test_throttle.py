@@ -0,0 +1,103 @@
+import os
+import sys
+import unittest
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'opendir_dl'))
+import opendir_dl
+import opendir_dl.throttle
+
+class AdaptiveLimitTest(unittest.TestCase):
+    def test_additive_increase(self):
+        limit = opendir_dl.throttle.AdaptiveLimit(initial=2, maximum=10)
+        for _ in range(10):
+            limit.record(200, 0.01)
+        self.assertGreater(limit.current, 2)
+        for _ in range(1000):
+            limit.record(200, 0.01)
+        self.assertEqual(limit.current, 10)
+
+    def test_multiplicative_decrease(self):
+        limit = opendir_dl.throttle.AdaptiveLimit(initial=8, maximum=10)
+        limit.record(503, 0.01)
+        self.assertEqual(limit.current, 4)
+        limit = opendir_dl.throttle.AdaptiveLimit(initial=8, maximum=10)
+        limit.record(None)
+        self.assertEqual(limit.current, 4)
+
+    def test_burst_of_failures(self):
+        limit = opendir_dl.throttle.AdaptiveLimit(initial=8, maximum=10)
+        # The other requests in flight when the host started failing only
+        # count once
+        for _ in range(8):
+            limit.record(429, 0.01)
+        self.assertEqual(limit.current, 4)
+        limit.record(429, 0.01)
+        self.assertEqual(limit.current, 2)
+
+    def test_minimum(self):
+        limit = opendir_dl.throttle.AdaptiveLimit(initial=2, maximum=10)
+        for _ in range(20):
+            limit.record(None)
+        self.assertEqual(limit.current, 1)
+
+    def test_slow_responses_hold(self):
+        limit = opendir_dl.throttle.AdaptiveLimit(initial=2, maximum=10)
+        limit.record(200, 0.01)
+        before = limit.limit
+        limit.record(200, 1.0)
+        self.assertEqual(limit.limit, before)
+
+    def test_other_errors_count_as_answers(self):
+        limit = opendir_dl.throttle.AdaptiveLimit(initial=2, maximum=10)
+        limit.record(404, 0.01)
+        self.assertGreater(limit.limit, 2)
+
+class RetryPolicyTest(unittest.TestCase):
+    def test_delay(self):
+        policy = opendir_dl.throttle.RetryPolicy(base_delay=1, max_delay=3)
+        for attempt in range(5):
+            delay = policy.delay(attempt)
+            self.assertGreaterEqual(delay, 0)
+            self.assertLessEqual(delay, min(3, 2 ** attempt))
+
+    def test_transient(self):
+        policy = opendir_dl.throttle.RetryPolicy()
+        self.assertTrue(policy.is_transient(TimeoutError()))
+        self.assertTrue(policy.is_transient(ConnectionRefusedError()))
+        self.assertFalse(policy.is_transient(ValueError()))
+
+    def test_check_status(self):
+        policy = opendir_dl.throttle.RetryPolicy()
+        policy.check_status(200)
+        policy.check_status("404")
+        with self.assertRaises(opendir_dl.throttle.TransientError) as context:
+            policy.check_status("503")
+        self.assertEqual(str(context.exception), "HTTP Error 503")
+
+class CircuitBreakerTest(unittest.TestCase):
+    def test_opens(self):
+        breaker = opendir_dl.throttle.CircuitBreaker(failure_threshold=2, reset_timeout=60)
+        breaker.record_failure("localhost")
+        self.assertTrue(breaker.allow("localhost"))
+        breaker.record_failure("localhost")
+        self.assertFalse(breaker.allow("localhost"))
+        self.assertTrue(breaker.allow("otherhost"))
+
+    def test_success_resets(self):
+        breaker = opendir_dl.throttle.CircuitBreaker(failure_threshold=2)
+        breaker.record_failure("localhost")
+        breaker.record_success("localhost")
+        breaker.record_failure("localhost")
+        self.assertTrue(breaker.allow("localhost"))
+
+    def test_half_open(self):
+        breaker = opendir_dl.throttle.CircuitBreaker(failure_threshold=1, reset_timeout=0)
+        breaker.record_failure("localhost")
+        # Only one request is let through to probe the host
+        self.assertTrue(breaker.allow("localhost"))
+        self.assertFalse(breaker.allow("localhost"))
+        breaker.record_failure("localhost")
+        self.assertTrue(breaker.is_open("localhost"))
+        self.assertTrue(breaker.allow("localhost"))
+        breaker.record_success("localhost")
+        self.assertFalse(breaker.is_open("localhost"))
+        self.assertTrue(breaker.allow("localhost"))
@@ -1,13 +1,22 @@
 import os
 import sys
+import time
 import tempfile
 import unittest
+import threading
+import contextlib
+import concurrent.futures
 from urllib.parse import urlparse
 from datetime import datetime
 import sqlalchemy
 sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'opendir_dl'))
 import opendir_dl
 from . import ThreadedHTTPServer
+from . import ETagHTTPServer
+from . import FlakyHTTPServer
+from . import LastModifiedHTTPServer
+from . import JSONListingHTTPServer
+from . import EmptyJSONListingHTTPServer
 from . import TestWithConfig
 
 class IsUrlTest(unittest.TestCase):
@@ -143,6 +152,72 @@ class ParseUrlsTest(unittest.TestCase):
         self.assertTrue(isinstance(url_list, list))
         self.assertEqual(len(url_list), 0)
 
+    def test_matches_soup(self):
+        url = "http://localhost/"
+        pages = [b"<html><body><a href=\"a.txt\">a</a><A HREF='B.txt'>b</A>"
+                 b"<a name=\"top\">no href</a><a href=\"\">empty</a><a href=\"../\">up</a></body></html>",
+                 "<pre><a href=\"caf\u00e9.txt\">caf\u00e9.txt</a>\n<a href=\"dir/\">dir/</a></pre>".encode("utf-8"),
+                 "<table><tr><td><a href=\"x.bin\">x</td><td><a href=\"y.bin\">y</a></table>",
+                 ""]
+        for html in pages:
+            soup_urls = [url + i for i in opendir_dl.utils.extract_hrefs_soup(html)
+                         if not opendir_dl.utils.bad_anchor(i)]
+            self.assertEqual(opendir_dl.utils.parse_urls(url, html), soup_urls)
+
+    def test_unicode_href(self):
+        url = "http://localhost/"
+        html = "<a href=\"caf\u00e9.txt\">x</a>".encode("utf-8")
+        self.assertEqual(opendir_dl.utils.parse_urls(url, html), ["http://localhost/caf\u00e9.txt"])
+
+class ParsePageTest(unittest.TestCase):
+    url = "http://localhost/"
+
+    def test_urls(self):
+        html = "<a href=\"a.txt\">a</a><a href=\"dir/\">dir/</a>"
+        new_urls, hints = opendir_dl.utils.parse_page(self.url, html)
+        self.assertEqual(new_urls, opendir_dl.utils.parse_urls(self.url, html))
+        self.assertEqual(hints, {})
+
+    def test_listing(self):
+        html = "<pre><a href=\"a.txt\">a.txt</a>  16-Oct-2016 21:14  13\n</pre>"
+        new_urls, hints = opendir_dl.utils.parse_page(self.url, html, listing=True)
+        self.assertEqual(new_urls, ["http://localhost/a.txt"])
+        self.assertEqual(hints["http://localhost/a.txt"].size, 13)
+
+class LinkStreamParserTest(unittest.TestCase):
+    url = "http://localhost/"
+
+    def test_matches_parse_urls(self):
+        html = "".join("<a href=\"caf\u00e9{}.txt\">x</a>\n".format(i) for i in range(500))
+        html = "<html><body><a href=\"../\">up</a>{}</body></html>".format(html).encode("utf-8")
+        parser = opendir_dl.utils.LinkStreamParser(self.url)
+        streamed = []
+        # Small chunks split tags and multibyte characters alike
+        for i in range(0, len(html), 7):
+            streamed.extend(parser.feed(html[i:i + 7]))
+        # Links come out while the page is still being fed
+        self.assertGreater(len(streamed), 0)
+        streamed.extend(parser.close())
+        self.assertEqual(streamed, opendir_dl.utils.parse_urls(self.url, html))
+
+    def test_not_utf8(self):
+        parser = opendir_dl.utils.LinkStreamParser(self.url)
+        urls = parser.feed("<a href=\"caf\u00e9.txt\">x</a>".encode("cp1252")) + parser.close()
+        self.assertEqual(urls, ["http://localhost/caf\u00e9.txt"])
+
+    def test_split_before_fallback(self):
+        # The UTF-8 href is split mid-character just before the page turns
+        # out not to be UTF-8
+        parser = opendir_dl.utils.LinkStreamParser(self.url)
+        urls = parser.feed(b"<a href=\"caf\xc3")
+        urls += parser.feed(b"\xa9.txt\">x</a><a href=\"\xff.txt\">y</a>")
+        urls += parser.close()
+        self.assertEqual(urls, ["http://localhost/caf\u00e9.txt", "http://localhost/\u00ff.txt"])
+
+    def test_empty(self):
+        parser = opendir_dl.utils.LinkStreamParser(self.url)
+        self.assertEqual(parser.close(), [])
+
 class BadAnchorTest(unittest.TestCase):
     def test_good_anchor(self):
         href = "filename.txt"
@@ -159,12 +234,35 @@ class BadAnchorTest(unittest.TestCase):
         is_bad = opendir_dl.utils.bad_anchor(href)
         self.assertTrue(is_bad)
 
+    def test_empty_anchor(self):
+        self.assertTrue(opendir_dl.utils.bad_anchor(""))
+
     def test_leading_slash(self):
         href = "/filename.txt"
         is_bad = opendir_dl.utils.bad_anchor(href)
         self.assertTrue(is_bad)
 
 class PageCrawlerTest(TestWithConfig):
+    def set_up(self):
+        super(PageCrawlerTest, self).set_up()
+        self.db_file = tempfile.NamedTemporaryFile(suffix=".db")
+        self.db = opendir_dl.databasing.DatabaseWrapper(self.db_file.name)
+        self.db.connect()
+
+    def tear_down(self):
+        self.db.close()
+        self.db_file.close()
+        super(PageCrawlerTest, self).tear_down()
+
+    def crawl(self, server, path="", **options):
+        """Runs a PageCrawler from path on the server, with options set on it
+        """
+        crawler = opendir_dl.utils.PageCrawler(self.db.db_conn, [server.url + path])
+        for name, value in options.items():
+            setattr(crawler, name, value)
+        crawler.run()
+        return crawler
+
     # The following function has been commented out because the property url_triage_bucked has
     # been refactored out while implementing threads
 
@@ -198,12 +296,267 @@ class PageCrawlerTest(TestWithConfig):
         self.assertFalse(crawler.quick)
         self.assertEqual(crawler.__dict__['_triage_method'], crawler.triage_standard)
 
-class SearchEngineTest(unittest.TestCase):
+    def test_invalid_triage_mode(self):
+        crawler = opendir_dl.utils.PageCrawler(None, ["http://localhost/"])
+        with self.assertRaises(ValueError) as context:
+            crawler.triage_mode = "notamode"
+        expected_error = "Triage mode must be one of: 'standard', 'quick', 'listing'. Got mode 'notamode'."
+        self.assertEqual(str(context.exception), expected_error)
+
+    def test_listing_triage(self):
+        crawler = opendir_dl.utils.PageCrawler(None, ["http://localhost/"])
+        crawler.triage_mode = "listing"
+        entries = [opendir_dl.autoindex.ListingEntry("http://localhost/dir/"),
+                   opendir_dl.autoindex.ListingEntry("http://localhost/a.txt", 10, datetime(2016, 1, 1))]
+        hints = dict((i.url, i) for i in entries)
+        # Neither entry needs a request, so nothing is sent anywhere
+        crawler.triage_batch(list(hints.keys()), 1, hints)
+        self.assertEqual(crawler._urls_to_scrape.get(timeout=0), ("http://localhost/dir/", 1))
+        head = crawler._fileindex_heads.get(timeout=0)
+        self.assertEqual(head.content_length, 10)
+        self.assertEqual(head.last_modified, datetime(2016, 1, 1))
+
+    def test_concurrent_triage(self):
+        crawler = opendir_dl.utils.PageCrawler(None, ["http://localhost/"])
+        crawler.triage_fanout = 4
+        crawler._triage_executor = concurrent.futures.ThreadPoolExecutor(max_workers=crawler.triage_fanout)
+        in_flight = []
+        in_flight_max = []
+        lock = threading.Lock()
+        def slow_triage(url, http_session=None, depth=0, hint=None):
+            with lock:
+                in_flight.append(url)
+                in_flight_max.append(len(in_flight))
+            time.sleep(0.05)
+            with lock:
+                in_flight.remove(url)
+        crawler._triage_method = slow_triage
+        urls = ["http://localhost/file{}".format(i) for i in range(12)]
+        crawler.triage_batch(urls, 1)
+        crawler._triage_executor.shutdown()
+        self.assertEqual(len(in_flight_max), 12)
+        self.assertEqual(max(in_flight_max), 4)
+
+    def test_parse_workers(self):
+        with ThreadedHTTPServer("localhost", 8000) as server:
+            self.crawl(server, quick=True, parse_workers=2)
+        url = "{}test_resources/example_file.txt".format(server.url)
+        self.assertEqual(self.db.query(opendir_dl.models.FileIndex).filter_by(url=url).count(), 1)
+
+    def test_budget(self):
+        with ThreadedHTTPServer("localhost", 8000) as server:
+            crawler = self.crawl(server, quick=True, budget=opendir_dl.budget.CrawlBudget(pages=1))
+        self.assertEqual(crawler.stopped_by, "pages")
+        # The root page's files were saved, but the crawl went no deeper
+        root_file = "{}test_utils.py".format(server.url)
+        self.assertEqual(self.db.query(opendir_dl.models.FileIndex).filter_by(url=root_file).count(), 1)
+        url = "{}test_resources/example_file.txt".format(server.url)
+        self.assertEqual(self.db.query(opendir_dl.models.FileIndex).filter_by(url=url).count(), 0)
+        # It didn't finish, so it can be resumed
+        store = opendir_dl.frontier.FrontierStore(self.db.db_conn)
+        self.assertNotEqual(store.entries(), [])
+
+    def test_json_listing(self):
+        with ThreadedHTTPServer("localhost", 8000, JSONListingHTTPServer) as server:
+            crawler = self.crawl(server, "test_resources/")
+        url = "{}test_resources/example_file.txt".format(server.url)
+        entry = self.db.query(opendir_dl.models.FileIndex).filter_by(url=url).one()
+        self.assertEqual(entry.content_length, os.path.getsize(os.path.join("test_resources", "example_file.txt")))
+        self.assertEqual(crawler.listing_formats.get(url), "json")
+        # Sizes and dates came from the listing, so nothing needed a HEAD
+        self.assertEqual(crawler.metrics.counter("head_requests"), 1)
+
+    def test_empty_json_listing(self):
+        # Streamed pages, and pages read whole for listing mode
+        for triage_mode in ["standard", "listing"]:
+            with ThreadedHTTPServer("localhost", 8000, EmptyJSONListingHTTPServer) as server:
+                crawler = self.crawl(server, "test_resources/", triage_mode=triage_mode)
+            url = "{}test_resources/example_file.txt".format(server.url)
+            self.assertEqual(self.db.query(opendir_dl.models.FileIndex).filter_by(url=url).count(), 1)
+            # The empty listing was asked for again as html
+            self.assertEqual(crawler.listing_formats.get(url), "html")
+            self.assertEqual(crawler.metrics.counter("get_requests"), 2)
+
+    def test_metrics(self):
+        with ThreadedHTTPServer("localhost", 8000) as server:
+            crawler = self.crawl(server, "test_resources/")
+        snapshot = crawler.metrics.snapshot()
+        self.assertGreater(snapshot["counters"]["get_requests"], 0)
+        self.assertGreater(snapshot["counters"]["head_requests"], 0)
+        self.assertGreater(snapshot["counters"]["bytes_received"], 0)
+        self.assertGreater(snapshot["counters"]["files_indexed"], 0)
+        for name in ["get_latency_seconds", "head_latency_seconds", "parse_seconds", "db_write_seconds"]:
+            self.assertGreater(snapshot["histograms"][name]["count"], 0)
+        self.assertEqual(snapshot["gauges"]["frontier_outstanding"], 0)
+
+    def test_resume(self):
+        with ThreadedHTTPServer("localhost", 8000) as server:
+            # A previous crawl finished the root page, but was stopped
+            # before it got to test_resources/
+            store = opendir_dl.frontier.FrontierStore(self.db.db_conn)
+            store.record(server.url, 0, "done")
+            store.record("{}test_resources/".format(server.url), 1, "in_flight")
+            self.crawl(server, quick=True, resume=True)
+        url = "{}test_resources/example_file.txt".format(server.url)
+        self.assertEqual(self.db.query(opendir_dl.models.FileIndex).filter_by(url=url).count(), 1)
+        # The root page wasn't scraped again
+        root_file = "{}test_utils.py".format(server.url)
+        self.assertEqual(self.db.query(opendir_dl.models.FileIndex).filter_by(url=root_file).count(), 0)
+        # The crawl finished, so there is nothing left to resume
+        self.assertEqual(store.entries(), [])
+
+    def test_unchanged_pages_skipped(self):
+        with ThreadedHTTPServer("localhost", 8000, ETagHTTPServer) as server:
+            del ETagHTTPServer.requests[:]
+            for _ in range(2):
+                self.crawl(server, quick=True)
+                indexed = self.db.query(opendir_dl.models.FileIndex).count()
+                requests = list(ETagHTTPServer.requests)
+                del ETagHTTPServer.requests[:]
+        self.assertGreater(indexed, 0)
+        # The root page came back 304, so nothing below it was requested
+        self.assertEqual(requests, [("GET", "/")])
+        self.assertEqual(self.db.query(opendir_dl.models.FileIndex).count(), indexed)
+
+    def test_listing_with_last_modified(self):
+        # Listings sending Last-Modified are still scraped rather than indexed
+        # as files, and are skipped with If-Modified-Since when recrawled
+        with ThreadedHTTPServer("localhost", 8000, LastModifiedHTTPServer) as server:
+            del LastModifiedHTTPServer.requests[:]
+            for _ in range(2):
+                self.crawl(server, "test_resources/")
+                urls = set(i.url for i in self.db.query(opendir_dl.models.FileIndex))
+                requests = list(LastModifiedHTTPServer.requests)
+                del LastModifiedHTTPServer.requests[:]
+        self.assertIn("{}test_resources/example_file.txt".format(server.url), urls)
+        self.assertNotIn("{}test_resources/".format(server.url), urls)
+        self.assertEqual(requests, [("HEAD", "/test_resources/"), ("GET", "/test_resources/")])
+
+    def crawl_interrupted(self, resume):
+        # The first crawl runs out of requests partway through the page's
+        # links, so the page must not be skipped as unchanged afterwards
+        with tempfile.TemporaryDirectory(dir=".") as root:
+            for i in range(30):
+                open(os.path.join(root, "file{}.txt".format(i)), "w").close()
+            path = os.path.basename(root) + "/"
+            with ThreadedHTTPServer("localhost", 8000, ETagHTTPServer) as server:
+                crawler = self.crawl(server, path, budget=opendir_dl.budget.CrawlBudget(requests=5))
+                self.assertEqual(crawler.stopped_by, "requests")
+                self.assertLess(self.db.query(opendir_dl.models.FileIndex).count(), 30)
+                self.crawl(server, path, resume=resume)
+        self.assertEqual(self.db.query(opendir_dl.models.FileIndex).count(), 30)
+
+    def test_interrupted_then_resumed(self):
+        self.crawl_interrupted(True)
+
+    def test_interrupted_then_crawled_again(self):
+        self.crawl_interrupted(False)
+
+    def test_retry(self):
+        url = "http://localhost:8000/test_resources/example_file.txt"
+        query = self.db.query(opendir_dl.models.FileIndex).filter_by(url=url)
+        FlakyHTTPServer.failing = set(["/test_resources/example_file.txt"])
+        with ThreadedHTTPServer("localhost", 8000, FlakyHTTPServer) as server:
+            retry_policy = opendir_dl.throttle.RetryPolicy(base_delay=0)
+            crawler = self.crawl(server, "test_resources/", retry_policy=retry_policy)
+            self.assertEqual(query.count(), 0)
+            self.assertEqual([i.url for i in crawler.retry_queue], [url])
+            # The server has recovered, so the url gets indexed this time
+            FlakyHTTPServer.failing = set()
+            self.crawl(server, "test_resources/", retry=True)
+        self.assertEqual(query.count(), 1)
+        self.assertEqual(opendir_dl.frontier.FrontierStore(self.db.db_conn).take_retries(), [])
+
+    def test_backlog_on_one_host(self):
+        # Pages hold their connection while their links are triaged, so with
+        # more links than triage_backlog the triage HEADs to the same host
+        # must still get a connection while every page is streaming
+        with tempfile.TemporaryDirectory(dir=".") as root:
+            for i in range(3):
+                directory = os.path.join(root, "dir{}".format(i))
+                os.mkdir(directory)
+                for j in range(40):
+                    open(os.path.join(directory, "file{}.txt".format(j)), "w").close()
+            pool = opendir_dl.httppool.HttpPool(max_per_host=2)
+            with ThreadedHTTPServer("localhost", 8000) as server:
+                options = {"http_session": pool, "triage_backlog": 5}
+                crawl = threading.Thread(target=self.crawl, args=(server, os.path.basename(root) + "/"),
+                                         kwargs=options, daemon=True)
+                crawl.start()
+                crawl.join(timeout=60)
+                self.assertFalse(crawl.is_alive())
+            pool.close()
+        self.assertEqual(self.db.query(opendir_dl.models.FileIndex).count(), 120)
+
+    def test_stream_fails_mid_body(self):
+        class BrokenStream(object):
+            @contextlib.contextmanager
+            def stream(self, uri, chunk_size=65536, headers=None):
+                def chunks():
+                    yield b'<a href="a.txt">a</a><a href="b.txt">b</a><a href="c'
+                    raise ConnectionResetError("Connection reset mid-body")
+                yield {"status": "200", "content-type": "text/html"}, chunks()
+        triaged = []
+        def triage_one(url, depth, hint):
+            time.sleep(0.2)
+            triaged.append(url)
+        crawler = opendir_dl.utils.PageCrawler(None, [], BrokenStream())
+        crawler.triage_one = triage_one
+        crawler._triage_executor = concurrent.futures.ThreadPoolExecutor(max_workers=2)
+        with self.assertRaises(ConnectionResetError):
+            crawler.scrape_streaming("http://localhost/", 0)
+        # The links found before the failure were triaged before it came back
+        self.assertEqual(sorted(triaged), ["http://localhost/a.txt", "http://localhost/b.txt"])
+        crawler._triage_executor.shutdown()
+
+    def test_limit_visited(self):
+        crawler = opendir_dl.utils.PageCrawler(None, ["http://localhost/"])
+        crawler.limit_visited(4096, 0.01)
+        sets = [crawler.visited, crawler._urls_to_scrape.visited]
+        for visited in sets:
+            self.assertEqual(visited.error_rate, 0.01)
+            # Past the exact limit, every set is a bloom filter of its share
+            visited.exact_limit = 10
+            for i in range(20):
+                visited.add("http://localhost/file{}".format(i))
+        self.assertLessEqual(sum(i._bloom.size_bytes for i in sets), 4096)
+
+    def test_attempt(self):
+        crawler = opendir_dl.utils.PageCrawler(None, ["http://localhost/"])
+        crawler.retry_policy.base_delay = 0
+        calls = []
+        def flaky():
+            calls.append(1)
+            if len(calls) < 3:
+                raise ConnectionResetError()
+            return "ok"
+        self.assertEqual(crawler.attempt("http://localhost/", flaky), "ok")
+        self.assertEqual(len(calls), 3)
+        # Non transient errors aren't retried
+        def broken():
+            calls.append(1)
+            raise KeyError()
+        with self.assertRaises(KeyError):
+            crawler.attempt("http://localhost/", broken)
+        self.assertEqual(len(calls), 4)
+
+    def crawl_depth(self, max_depth):
+        with ThreadedHTTPServer("localhost", 8000) as server:
+            self.crawl(server, quick=True, max_depth=max_depth)
+        url = "{}test_resources/example_file.txt".format(server.url)
+        return self.db.query(opendir_dl.models.FileIndex).filter_by(url=url).count()
+
+    def test_max_depth(self):
+        # example_file.txt is inside test_resources/, one level below the root
+        self.assertEqual(self.crawl_depth(0), 0)
+
+    def test_max_depth_below(self):
+        self.assertEqual(self.crawl_depth(1), 1)
+
+class SearchEngineTest(TestWithConfig):
     def test_query(self):
-        self_path = os.path.realpath(__file__)
-        cur_dir = "/".join(self_path.split("/")[:-1])
-        db_path = cur_dir + '/test_resources/test_sqlite3.db'
-        db = opendir_dl.databasing.DatabaseWrapper.from_fs(db_path)
+        # A copy of the fixture, since connecting migrates it in place
+        db = opendir_dl.databasing.DatabaseWrapper.from_fs(self.database_path)
         search = opendir_dl.utils.SearchEngine(db, ['example'])
         self.assertTrue(len(search.filters), 1)
         results = search.query()
@@ -229,6 +582,19 @@ class SearchEngineTest(unittest.TestCase):
         with self.assertRaises(ValueError) as context:
             search.query()
 
+    def test_subtree(self):
+        db = opendir_dl.databasing.DatabaseWrapper('')
+        db.connect()
+        heads = [opendir_dl.utils.HttpHead(url, {"status": "200", "content-type": "text/plain"})
+                 for url in ["http://localhost/isos/a.txt", "http://localhost/isos/old/b.txt",
+                             "http://localhost/isos0/c.txt", "http://localhost/isosx/d.txt",
+                             "http://otherhost/isos/e.txt"]]
+        opendir_dl.writer.upsert_fileindexes(db.db_conn, [i.as_fileindex() for i in heads])
+        search = opendir_dl.utils.SearchEngine(db, ["txt"])
+        search.add_subtree("http://LOCALHOST:80/isos")
+        self.assertEqual(sorted(i.name for i in search.query()), ["a.txt", "b.txt"])
+        db.close()
+
 class HttpGetTest(unittest.TestCase):
     def test_localhost(self):
         with ThreadedHTTPServer("localhost", 8000) as server:
@@ -238,7 +604,7 @@ class HttpGetTest(unittest.TestCase):
 class DownloadManagerTest(TestWithConfig):
     def test_nonexistant_index(self):
         target_index = 404
-        db_path = "test_resources/test_sqlite3.db"
+        db_path = self.database_path
         db_wrapper = opendir_dl.databasing.database_opener(self.config, db_path)
         dl_man = opendir_dl.utils.DownloadManager(db_wrapper, target_index)
         with self.assertRaises(ValueError) as context:
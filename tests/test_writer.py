@@ -0,0 +1,132 @@
+import os
+import sys
+import queue
+import unittest
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'opendir_dl'))
+import opendir_dl
+import opendir_dl.databasing
+import opendir_dl.frontier
+import opendir_dl.models
+import opendir_dl.utils
+import opendir_dl.writer
+
+def make_head(url, length):
+    return opendir_dl.utils.HttpHead(url, {"status": "200", "content-length": str(length),
+                                           "content-type": "text/plain"})
+
+class CanonicalUrlTest(unittest.TestCase):
+    def test_canonical_url(self):
+        canonical_url = opendir_dl.writer.canonical_url
+        self.assertEqual(canonical_url("HTTP://LocalHost:80/Dir/File.txt#top"), "http://localhost/Dir/File.txt")
+        self.assertEqual(canonical_url("https://example.com:443"), "https://example.com/")
+        self.assertEqual(canonical_url("http://user:pw@Example.com:8000/a?b=c"), "http://user:pw@example.com:8000/a?b=c")
+        self.assertEqual(canonical_url("http://[::1]:8080/"), "http://[::1]:8080/")
+        self.assertEqual(canonical_url("http://localhost:bad/"), "http://localhost:bad/")
+
+    def test_split_url(self):
+        split_url = opendir_dl.writer.split_url
+        self.assertEqual(split_url("http://localhost:8000/a/b.txt"), ("http://localhost:8000", "/a/", "b.txt"))
+        self.assertEqual(split_url("http://localhost/a/"), ("http://localhost", "/a/", ""))
+        self.assertEqual(split_url("http://localhost/view?f=a/b"), ("http://localhost", "/", "view?f=a/b"))
+
+class IndexWriterTest(unittest.TestCase):
+    def setUp(self):
+        self.db = opendir_dl.databasing.DatabaseWrapper('')
+        self.db.connect()
+        self.writer = opendir_dl.writer.IndexWriter(self.db.db_conn)
+
+    def tearDown(self):
+        self.db.close()
+
+    def test_batch_size(self):
+        items = queue.Queue()
+        for i in range(5):
+            items.put(i)
+        self.writer.batch_size = 2
+        self.assertEqual(self.writer.take_batch(items, lambda: False), [0, 1])
+        self.assertEqual(self.writer.take_batch(items, lambda: False), [2, 3])
+        self.assertEqual(self.writer.take_batch(items, lambda: False), [4])
+        self.assertEqual(self.writer.take_batch(items, lambda: False), [])
+
+    def test_batch_stopping(self):
+        items = queue.Queue()
+        items.put(0)
+        # The batch isn't held open for the time window once stopping
+        self.writer.batch_seconds = 30
+        self.assertEqual(self.writer.take_batch(items, lambda: True), [0])
+
+    def test_write(self):
+        url = "http://localhost/file.txt"
+        self.writer.write([make_head(url, 10), make_head("http://localhost/other.txt", 5)])
+        self.writer.write([make_head(url, 20), make_head(url, 30)])
+        rows = self.db.query(opendir_dl.models.FileIndex).filter_by(url=url).all()
+        self.assertEqual(len(rows), 1)
+        self.assertEqual(rows[0].content_length, 30)
+        self.assertEqual(self.db.query(opendir_dl.models.FileIndex).count(), 2)
+        self.assertEqual(self.writer.metrics.counter("files_indexed"), 3)
+        self.assertEqual(self.writer.metrics.counter("db_batches"), 2)
+
+    def test_substring_urls(self):
+        # A url containing another isn't mistaken for it
+        self.writer.write([make_head("http://localhost/file.txt", 1)])
+        self.writer.write([make_head("http://localhost/file.txt.bak", 2)])
+        self.assertEqual(self.db.query(opendir_dl.models.FileIndex).count(), 2)
+
+    def test_canonical_key(self):
+        self.writer.write([make_head("http://LOCALHOST:80/file.txt", 1)])
+        self.writer.write([make_head("http://localhost/file.txt#part", 2)])
+        rows = self.db.query(opendir_dl.models.FileIndex).all()
+        self.assertEqual([(i.url, i.content_length) for i in rows], [("http://localhost/file.txt", 2)])
+
+    def test_frontier_items(self):
+        url = "http://localhost/dir/"
+        batch = [opendir_dl.frontier.FrontierUpdate(url, 1, "pending"),
+                 opendir_dl.frontier.FrontierUpdate(url, 1, "done"),
+                 opendir_dl.frontier.PageValidators(url, "etag", None),
+                 opendir_dl.frontier.RetryItem("http://localhost/gone/", 2, "page", "timeout")]
+        self.writer.write(batch)
+        store = opendir_dl.frontier.FrontierStore(self.db.db_conn)
+        self.assertEqual(store.entries(), [(url, 1, "done")])
+        self.assertEqual(store.validators()[url].etag, "etag")
+        self.assertEqual([i.url for i in store.take_retries()], ["http://localhost/gone/"])
+
+    def test_drain(self):
+        items = queue.Queue()
+        for i in range(7):
+            items.put(make_head("http://localhost/file{}.txt".format(i), i))
+        self.writer.batch_size = 3
+        self.writer.drain(items, lambda: True)
+        self.assertEqual(self.db.query(opendir_dl.models.FileIndex).count(), 7)
+        self.assertEqual(self.writer.metrics.counter("db_batches"), 3)
+
+    def test_normalized(self):
+        self.writer.write([make_head("http://localhost/dir/a.txt", 1), make_head("http://localhost/dir/sub/b.txt", 2),
+                           make_head("http://localhost/view.php?file=a", 3)])
+        self.assertEqual(self.db.query(opendir_dl.models.Host).count(), 1)
+        self.assertEqual(self.db.query(opendir_dl.models.ContentType).count(), 1)
+        sub = self.db.query(opendir_dl.models.Directory).filter_by(path="/dir/sub/").one()
+        self.assertEqual(sub.parent.path, "/dir/")
+        self.assertEqual(sub.parent.parent.path, "/")
+        # Urls are put back together when read, and can still be queried
+        rows = self.db.query(opendir_dl.models.FileIndex).order_by(opendir_dl.models.FileIndex.url).all()
+        self.assertEqual([i.url for i in rows], ["http://localhost/dir/a.txt", "http://localhost/dir/sub/b.txt",
+                                                 "http://localhost/view.php?file=a"])
+        self.assertEqual([i.leaf for i in rows], [None, None, "view.php?file=a"])
+        self.assertEqual({(i.domain, i.content_type) for i in rows}, {("localhost", "text/plain")})
+
+    def test_failed_batch(self):
+        self.writer.write([make_head("http://localhost/file.txt", 1)])
+        bad = make_head("http://localhost/new/bad.txt", 1)
+        bad.content_length = object()
+        items = queue.Queue()
+        items.put(make_head("http://localhost/new/good.txt", 1))
+        items.put(bad)
+        # The batch can't be saved, but the writer goes on to the next one
+        self.writer.drain(items, lambda: True)
+        self.assertEqual(self.writer.metrics.counter("db_write_failures"), 1)
+        self.assertEqual(self.writer.keys.directories, {})
+        self.assertEqual(self.db.query(opendir_dl.models.Directory).filter_by(path="/new/").count(), 0)
+        items.put(make_head("http://localhost/new/good.txt", 2))
+        self.writer.drain(items, lambda: True)
+        rows = self.db.query(opendir_dl.models.FileIndex).order_by(opendir_dl.models.FileIndex.url).all()
+        self.assertEqual([i.url for i in rows], ["http://localhost/file.txt", "http://localhost/new/good.txt"])